@@ -0,0 +1,96 @@
+import argparse
+import timeit
+
+from services.AttributeParser import get_parser as get_attribute_parser
+
+# Micro-benchmark of the single-pass AttributeParser against the line-by-attribute scan it replaced
+# Usage: python -m benchmarks.attribute_parser [--iterations N] [--attributes N]
+# The legacy scan costs one pass per watched attribute, so the speedup grows with the watch list
+# Measured with Python 3.11 on a single core x86_64 Xeon VM (5 runs of 20000 iterations each; timings vary between runs):
+# about 1.1-1.5x with 3 watched attributes (the default) and 1.4-2.8x, typically about 2.1x, with 8
+
+REPORT = """=== START OF READ SMART DATA SECTION ===
+SMART Attributes Data Structure revision number: 16
+Vendor Specific SMART Attributes with Thresholds:
+ID# ATTRIBUTE_NAME          FLAG     VALUE WORST THRESH TYPE      UPDATED  WHEN_FAILED RAW_VALUE
+  1 Raw_Read_Error_Rate     0x000b   100   100   016    Pre-fail  Always       -       0
+  2 Throughput_Performance  0x0004   129   129   054    Old_age   Offline      -       112
+  3 Spin_Up_Time            0x0007   163   163   024    Pre-fail  Always       -       394 (Average 380)
+  4 Start_Stop_Count        0x0012   100   100   000    Old_age   Always       -       412
+  5 Reallocated_Sector_Ct   0x0033   001   001   005    Pre-fail  Always   FAILING_NOW 2048
+  7 Seek_Error_Rate         0x000a   100   100   067    Old_age   Always       -       0
+  8 Seek_Time_Performance   0x0004   128   128   020    Old_age   Offline      -       18
+  9 Power_On_Hours          0x0012   097   097   000    Old_age   Always       -       23567
+ 10 Spin_Retry_Count        0x0012   100   100   060    Old_age   Always       -       0
+ 12 Power_Cycle_Count       0x0032   100   100   000    Old_age   Always       -       412
+ 22 Helium_Level            0x0023   100   100   025    Pre-fail  Always       -       100
+192 Power-Off_Retract_Count 0x0032   100   100   000    Old_age   Always       -       1138
+193 Load_Cycle_Count        0x0012   100   100   000    Old_age   Always       -       1138
+194 Temperature_Celsius     0x0002   171   171   000    Old_age   Always       -       38 (Min/Max 20/45)
+196 Reallocated_Event_Count 0x0032   100   100   000    Old_age   Always       -       4
+197 Current_Pending_Sector  0x0022   100   100   000    Old_age   Always       -       8
+198 Offline_Uncorrectable   0x0008   100   100   000    Old_age   Offline      -       0
+199 UDMA_CRC_Error_Count    0x000a   200   200   000    Old_age   Always       -       0
+"""
+
+ATTRIBUTES = [
+    "reallocated_sector_ct",
+    "reallocated_event_count",
+    "current_pending_sector",
+    "offline_uncorrectable",
+    "udma_crc_error_count",
+    "spin_retry_count",
+    "seek_error_rate",
+    "raw_read_error_rate"]
+
+# Previous implementation from DriveThread, kept verbatim for comparison
+def legacy_parse(smart, report):
+    failing_attributes = {}
+
+    for line in report.split("\n"):
+        if (len(line.split()) > smart["when_failed"] + 1) and ("FAILING_NOW" in line.split()[smart["when_failed"]].upper()):
+            key = line.split()[smart["attribute_name"]].lower()
+            value = int(line.split()[smart["raw_value"]])
+            failing_attributes[key] = value
+
+    watched_attributes = {}
+    watch_list = set().union(*(d.keys() for d in smart["attributes"]))
+
+    for line in report.split("\n"):
+        if any(attribute.upper() in line.upper() for attribute in list(watch_list)):
+            key = line.split()[smart["attribute_name"]].lower()
+            value = int(line.split()[smart["raw_value"]])
+            watched_attributes[key] = value
+
+    return watched_attributes, failing_attributes
+
+def main():
+    arguments = argparse.ArgumentParser(description = "Compare attribute parsing implementations")
+    arguments.add_argument("--iterations", type = int, default = 20000)
+    arguments.add_argument("--attributes", type = int, default = 3, help = "number of watched attributes (max {})".format(len(ATTRIBUTES)))
+    options = arguments.parse_args()
+
+    smart = {
+        "attribute_name" : 1,
+        "when_failed" : 8,
+        "raw_value" : 9,
+        "attributes" : [{name : {"threshold" : 0}} for name in ATTRIBUTES[:options.attributes]]}
+
+    parser = get_attribute_parser(smart)
+
+    # Both implementations must agree before their timings mean anything
+    watched_attributes, failing_attributes = legacy_parse(smart, REPORT)
+    result = parser.parse(REPORT)
+    assert result["watched"] == watched_attributes, (result["watched"], watched_attributes)
+    assert result["failing"] == failing_attributes, (result["failing"], failing_attributes)
+
+    legacy = min(timeit.repeat(lambda: legacy_parse(smart, REPORT), number = options.iterations, repeat = 3))
+    single_pass = min(timeit.repeat(lambda: parser.parse(REPORT), number = options.iterations, repeat = 3))
+
+    print("Watched attributes: {}, report lines: {}, iterations: {}".format(options.attributes, len(REPORT.split("\n")), options.iterations))
+    print("    legacy        {:8.2f} us/report".format(legacy / options.iterations * 1e6))
+    print("    single pass   {:8.2f} us/report".format(single_pass / options.iterations * 1e6))
+    print("    speedup       {:8.2f}x".format(legacy / single_pass))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+import argparse
+import copy
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# End to end benchmark of smart_monitor.main without real disks
+# Every scenario runs the monitor in a child process against a fake smartctl on PATH, a temporary by-uuid tree
+# and a local SMTP sink, and records wall time, peak RSS, smartctl calls, SQL statements and delivered mail
+# Usage: python -m benchmarks.pipeline [--disks 10,100,1000,5000] [--latency S] [--output FILE] [--compare FILE]
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Recorded smartctl --json report of a healthy drive; the failing report is derived from it
+REPORT = {
+    "json_format_version" : [1, 0],
+    "smartctl" : {"version" : [7, 2], "exit_status" : 0},
+    "model_family" : "Western Digital Red",
+    "model_name" : "WDC WD80EFAX-68LHPN0",
+    "serial_number" : "7SGABCDE",
+    "firmware_version" : "83.H0A83",
+    "user_capacity" : {"bytes" : 8001563222016},
+    "rotation_rate" : 5400,
+    "smart_status" : {"passed" : True},
+    "ata_smart_attributes" : {"table" : [
+        {"id" : 1, "name" : "Raw_Read_Error_Rate", "value" : 100, "worst" : 100, "thresh" : 16, "when_failed" : "", "flags" : {"value" : 11, "prefailure" : True, "updated_online" : True}, "raw" : {"value" : 0, "string" : "0"}},
+        {"id" : 3, "name" : "Spin_Up_Time", "value" : 163, "worst" : 163, "thresh" : 24, "when_failed" : "", "flags" : {"value" : 7, "prefailure" : True, "updated_online" : True}, "raw" : {"value" : 394, "string" : "394 (Average 380)"}},
+        {"id" : 5, "name" : "Reallocated_Sector_Ct", "value" : 100, "worst" : 100, "thresh" : 5, "when_failed" : "", "flags" : {"value" : 51, "prefailure" : True, "updated_online" : True}, "raw" : {"value" : 0, "string" : "0"}},
+        {"id" : 9, "name" : "Power_On_Hours", "value" : 97, "worst" : 97, "thresh" : 0, "when_failed" : "", "flags" : {"value" : 18, "prefailure" : False, "updated_online" : True}, "raw" : {"value" : 23567, "string" : "23567"}},
+        {"id" : 194, "name" : "Temperature_Celsius", "value" : 171, "worst" : 171, "thresh" : 0, "when_failed" : "", "flags" : {"value" : 2, "prefailure" : False, "updated_online" : True}, "raw" : {"value" : 38, "string" : "38 (Min/Max 20/45)"}},
+        {"id" : 196, "name" : "Reallocated_Event_Count", "value" : 100, "worst" : 100, "thresh" : 0, "when_failed" : "", "flags" : {"value" : 50, "prefailure" : False, "updated_online" : True}, "raw" : {"value" : 0, "string" : "0"}},
+        {"id" : 197, "name" : "Current_Pending_Sector", "value" : 100, "worst" : 100, "thresh" : 0, "when_failed" : "", "flags" : {"value" : 34, "prefailure" : False, "updated_online" : True}, "raw" : {"value" : 0, "string" : "0"}}]}}
+
+# Fake smartctl; a shell script so the fake itself costs far less than the work being measured
+# FAKE_SMARTCTL_MODE picks the recorded report (healthy or failing) or hang, which never answers within the timeout
+# Devices with a marker in the broken directory cannot be opened
+FAKE_SMARTCTL = """#!/bin/sh
+for device in "$@"; do :; done
+echo "$*" >> "$FAKE_SMARTCTL_CALLS"
+
+[ "$FAKE_SMARTCTL_LATENCY" = "0" ] || sleep "$FAKE_SMARTCTL_LATENCY"
+[ "$FAKE_SMARTCTL_MODE" = "hang" ] && exec sleep 3600
+
+if [ -e "$FAKE_SMARTCTL_REPORTS/broken/${device##*/}" ]; then
+    echo "Smartctl open device: $device failed: No such device"
+    exit 2
+fi
+
+case "$*" in
+    *--json*) exec cat "$FAKE_SMARTCTL_REPORTS/$FAKE_SMARTCTL_MODE.json" ;;
+esac
+
+echo "=======> UNRECOGNIZED OPTION: json"
+exit 1
+"""
+
+# Minimal SMTP server that accepts and counts every message
+class SmtpSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0), SmtpHandler)
+        self.messages = 0
+        self.lock = threading.Lock()
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write(b"220 sink ESMTP\r\n")
+
+        for line in self.rfile:
+            command = line.strip().upper()
+
+            if command.startswith(b"DATA"):
+                self.wfile.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                for data in self.rfile:
+                    if data in (b".\r\n", b".\n"):
+                        break
+                with self.server.lock:
+                    self.server.messages += 1
+                self.wfile.write(b"250 OK\r\n")
+            elif command.startswith(b"QUIT"):
+                self.wfile.write(b"221 Bye\r\n")
+                return
+            else:
+                self.wfile.write(b"250 OK\r\n")
+
+def build_workspace(directory, disks, smtp_port, options):
+    for name in ("bin", "dev", "by-uuid", "sys", os.path.join("reports", "broken")):
+        os.makedirs(os.path.join(directory, name), exist_ok = True)
+
+    smartctl = os.path.join(directory, "bin", "smartctl")
+    with open(smartctl, "w") as fake:
+        fake.write(FAKE_SMARTCTL)
+    os.chmod(smartctl, 0o755)
+
+    # Mass failure: reallocated sectors are past their threshold and failing now on every drive
+    failing = copy.deepcopy(REPORT)
+    failing["smart_status"]["passed"] = False
+    for row in failing["ata_smart_attributes"]["table"]:
+        if row["id"] == 5:
+            row.update({"value" : 1, "when_failed" : "now", "raw" : {"value" : 2048, "string" : "2048"}})
+
+    for mode, report in (("healthy", REPORT), ("failing", failing)):
+        with open(os.path.join(directory, "reports", mode + ".json"), "w") as report_file:
+            json.dump(report, report_file)
+
+    # Devices that cannot be opened are picked with a fixed seed so runs are repeatable
+    broken = random.Random(options.seed).sample(range(disks), int(disks * options.error_rate))
+    for i in broken:
+        open(os.path.join(directory, "reports", "broken", "bench{:05d}".format(i)), "w").close()
+
+    # One whole-disk device per configured disk, linked from the by-uuid tree like udev does
+    entries = []
+    for i in range(disks):
+        device = os.path.join(directory, "dev", "bench{:05d}".format(i))
+        uuid = "{:08x}-0000-4000-8000-{:012x}".format(i, i)
+        open(device, "w").close()
+        os.symlink(os.path.join("..", "dev", os.path.basename(device)), os.path.join(directory, "by-uuid", uuid))
+        entries.append({"disk{}".format(i) : {"mount_point" : "/mnt/disk{}".format(i), "uuid" : uuid}})
+
+    config = {
+        "logging" : {"file" : None, "format" : None, "maxsize" : 0, "level" : "WARNING"},
+        "smtp" : {"hostname" : "127.0.0.1", "port" : smtp_port, "ssl" : False, "username" : None, "password" : None},
+        "email" : {"sender" : "monitor@localhost", "destination" : "admin@localhost", "drain_timeout" : 600, "digest" : options.digest},
+        "smart" : {
+            "report_values" : True, "report_initial_values" : True, "report_updated_values" : True,
+            "timeout" : options.timeout, "attribute_name" : 1, "when_failed" : 8, "raw_value" : 9,
+            "attributes" : [
+                {"reallocated_sector_ct" : {"threshold" : 0}},
+                {"reallocated_event_count" : {"threshold" : 0}},
+                {"current_pending_sector" : {"threshold" : 0}}]},
+        "scheduler" : {"engine" : options.engine, "workers" : options.workers},
+        "discovery" : {"by_uuid" : os.path.join(directory, "by-uuid"), "sysfs" : os.path.join(directory, "sys")},
+        "disks" : {"array" : entries}}
+
+    # JSON is valid YAML, so the configuration is written without needing a YAML emitter
+    with open(os.path.join(directory, "config.yml"), "w") as config_file:
+        json.dump(config, config_file)
+
+def run_monitor(directory, mode, options):
+    calls = os.path.join(directory, "calls.log")
+    stats = os.path.join(directory, "stats.json")
+    for filename in (calls, stats):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    environment = dict(os.environ)
+    environment.update({
+        "PATH" : os.path.join(directory, "bin") + os.pathsep + environment.get("PATH", ""),
+        "PYTHONPATH" : REPOSITORY,
+        "FAKE_SMARTCTL_CALLS" : calls,
+        "FAKE_SMARTCTL_REPORTS" : os.path.join(directory, "reports"),
+        "FAKE_SMARTCTL_LATENCY" : str(options.latency),
+        "FAKE_SMARTCTL_MODE" : mode})
+
+    started = time.monotonic()
+    with open(os.path.join(directory, "monitor.log"), "a") as log:
+        result = subprocess.run([sys.executable, "-m", "benchmarks.pipeline", "--child", stats, "--config", os.path.join(directory, "config.yml")],
+            cwd = directory, env = environment, stdout = log, stderr = subprocess.STDOUT)
+    elapsed = time.monotonic() - started
+
+    if result.returncode != 0 or not os.path.exists(stats):
+        raise RuntimeError("Monitor run failed; see {}".format(os.path.join(directory, "monitor.log")))
+
+    with open(stats) as stats_file:
+        measured = json.load(stats_file)
+    with open(calls) as calls_file:
+        measured["smartctl_calls"] = sum(1 for line in calls_file)
+
+    measured["wall_time"] = elapsed
+    return measured
+
+def run_scenario(sink, directory, disks, database, health, options):
+    path = os.path.join(directory, "database.db")
+    for filename in (path, path + "-wal", path + "-shm"):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    # A warm database already knows every drive from an earlier healthy run
+    if database == "warm":
+        run_monitor(directory, "healthy", options)
+
+    with sink.lock:
+        sink.messages = 0
+
+    measured = run_monitor(directory, health, options)
+
+    with sink.lock:
+        measured["messages"] = sink.messages
+
+    measured.update({"disks" : disks, "database" : database, "health" : health})
+    return measured
+
+# Runs inside the child process: counts SQL statements around smart_monitor.main and reports peak memory
+def run_child(stats, config):
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    import smart_monitor
+
+    statements = [0]
+    def count(connection, cursor, statement, parameters, context, executemany):
+        statements[0] += 1
+    event.listen(Engine, "before_cursor_execute", count)
+
+    sys.argv = ["smart_monitor.py", "--config", config]
+    smart_monitor.main()
+
+    with open(stats, "w") as stats_file:
+        json.dump({
+            "sql_statements" : statements[0],
+            "peak_rss_kb" : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}, stats_file)
+
+def get_revision():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd = REPOSITORY, capture_output = True, text = True).stdout.strip() or None
+    except OSError:
+        return None
+
+def get_key(result):
+    return (result["disks"], result["database"], result["health"])
+
+def print_header():
+    print("    {:>6}  {:<6}{:<10}{:>10}{:>12}{:>10}{:>12}{:>10}{:>12}".format("DISKS", "DB", "HEALTH", "WALL_S", "PEAK_RSS_MB", "SMARTCTL", "SQL", "MAIL", "VS_PREVIOUS"))
+
+def print_result(result, previous):
+    change = ""
+    for earlier in previous:
+        if get_key(earlier) == get_key(result) and earlier["wall_time"] > 0:
+            change = "{:+.1f}%".format((result["wall_time"] / earlier["wall_time"] - 1) * 100)
+
+    print("    {:>6}  {:<6}{:<10}{:>10.2f}{:>12.1f}{:>10}{:>12}{:>10}{:>12}".format(
+        result["disks"], result["database"], result["health"], result["wall_time"], result["peak_rss_kb"] / 1024.0,
+        result["smartctl_calls"], result["sql_statements"], result["messages"], change))
+
+def main():
+    arguments = argparse.ArgumentParser(description = "Benchmark the whole monitoring pipeline against fake disks")
+    arguments.add_argument("--disks", default = "10,100,1000,5000", help = "comma separated disk counts")
+    arguments.add_argument("--database", default = "cold,warm", help = "comma separated database states (cold, warm)")
+    arguments.add_argument("--health", default = "healthy,failing", help = "comma separated drive health (healthy, failing, hang)")
+    arguments.add_argument("--latency", type = float, default = 0.0, help = "seconds every fake smartctl call takes")
+    arguments.add_argument("--error-rate", type = float, default = 0.0, help = "fraction of devices that cannot be opened")
+    arguments.add_argument("--seed", type = int, default = 1)
+    arguments.add_argument("--timeout", type = float, default = 10, help = "smartctl timeout in seconds")
+    arguments.add_argument("--engine", default = "threads", choices = ["threads", "asyncio"])
+    arguments.add_argument("--workers", type = int, default = 8)
+    arguments.add_argument("--digest", default = "none", choices = ["none", "run", "group"])
+    arguments.add_argument("--output", help = "write results to this JSON file")
+    arguments.add_argument("--compare", help = "JSON results of an earlier run to compare wall times with")
+    arguments.add_argument("--keep", action = "store_true", help = "keep the temporary workspaces")
+    arguments.add_argument("--child", metavar = "STATS", help = argparse.SUPPRESS)
+    arguments.add_argument("--config", help = argparse.SUPPRESS)
+    options = arguments.parse_args()
+
+    if options.child:
+        run_child(options.child, options.config)
+        return
+
+    previous = []
+    if options.compare:
+        with open(options.compare) as compare_file:
+            previous = json.load(compare_file)["results"]
+
+    sink = SmtpSink()
+    threading.Thread(target = sink.serve_forever, daemon = True).start()
+
+    results = []
+    print_header()
+    try:
+        for disks in [int(count) for count in options.disks.split(",")]:
+            directory = tempfile.mkdtemp(prefix = "smart-monitor-bench-")
+            try:
+                build_workspace(directory, disks, sink.server_address[1], options)
+
+                for health in options.health.split(","):
+                    for database in options.database.split(","):
+                        result = run_scenario(sink, directory, disks, database, health, options)
+                        results.append(result)
+                        print_result(result, previous)
+            finally:
+                if options.keep:
+                    print("Workspace kept in {}".format(directory))
+                else:
+                    shutil.rmtree(directory, ignore_errors = True)
+    finally:
+        sink.shutdown()
+
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump({
+                "revision" : get_revision(),
+                "python" : platform.python_version(),
+                "created" : time.time(),
+                "options" : {key : value for key, value in vars(options).items() if key not in ("child", "config", "output", "compare", "keep")},
+                "results" : results}, output, indent = 2)
+        print("Results written to {}".format(options.output))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import argparse
+import random
+import time
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import StaticPool
+from services.DriveService import get_service as get_drive_service
+from services.HistoryService import get_service as get_history_service, DAY
+from services.TrendService import get_service as get_trend_service, is_available as is_trend_available, PROJECTION
+
+# Benchmark of the fleet wide trend analysis on a synthetic attribute history
+# Usage: python -m benchmarks.trend_engine [--drives N] [--years N] [--models N]
+
+ATTRIBUTES = ["reallocated_sector_ct", "reallocated_event_count", "current_pending_sector"]
+RAW_DAYS = 30
+
+def build_database(options, now):
+    engine = create_engine("sqlite://", poolclass = StaticPool, connect_args = {"check_same_thread" : False})
+    generator = random.Random(options.seed)
+
+    with engine.begin() as connection:
+        get_drive_service(connection).create_table()
+        get_history_service(connection).create_tables()
+
+        # Plain DB-API inserts; building millions of parameter dictionaries would dominate the setup time
+        cursor = connection.connection.cursor()
+        cursor.executemany("INSERT INTO attributes (id, name) VALUES (?, ?)", [(i + 1, name) for i, name in enumerate(ATTRIBUTES)])
+        cursor.executemany("INSERT INTO drives (id, uuid, name, code_group, model) VALUES (?, ?, ?, ?, ?)", [
+            (i + 1, "drive-{:06d}".format(i), "disk{}".format(i), "ARRAY", "MODEL-{}".format(i % options.models)) for i in range(options.drives)])
+
+        days = int(options.years * 365)
+        start = (int(now) // DAY) * DAY - days * DAY
+
+        # Most drives stay at zero; a few grow steadily and a few jumped once
+        rates = {}
+        for drive in range(1, options.drives + 1):
+            for attribute in range(1, len(ATTRIBUTES) + 1):
+                roll = generator.random()
+                rates[(drive, attribute)] = generator.uniform(0.05, 2.0) if roll < 0.02 else 0.0
+                if roll > 0.995:
+                    rates[(drive, attribute)] = -generator.randint(50, 500)
+
+        def value(key, day):
+            rate = rates[key]
+            return int(-rate) if rate < 0 else int(rate * day)
+
+        def daily_rows():
+            for (drive, attribute) in rates:
+                for day in range(days - RAW_DAYS):
+                    current = value((drive, attribute), day)
+                    yield (drive, attribute, start + day * DAY, current, current, current, 1)
+
+        def raw_rows():
+            for (drive, attribute) in rates:
+                for day in range(days - RAW_DAYS, days):
+                    yield (drive, attribute, start + day * DAY, value((drive, attribute), day))
+
+        cursor.executemany("INSERT INTO attribute_history_daily VALUES (?, ?, ?, ?, ?, ?, ?)", daily_rows())
+        cursor.executemany("INSERT INTO attribute_history VALUES (?, ?, ?, ?)", raw_rows())
+        cursor.executemany("INSERT INTO attribute_latest VALUES (?, ?, ?, ?)", [
+            (drive, attribute, start + (days - 1) * DAY, value((drive, attribute), days - 1)) for (drive, attribute) in rates])
+
+    return engine, len(rates) * days
+
+# Same projection computed one series at a time, used to check the vectorized results
+def loop_projections(engine, thresholds, settings, now):
+    window_start = now - settings["window_days"] * DAY
+    projections = set()
+
+    with engine.connect() as connection:
+        names = dict(connection.execute(text("SELECT id, name FROM attributes")).fetchall())
+        uuids = dict(connection.execute(text("SELECT id, uuid FROM drives")).fetchall())
+        latest = {(row[0], row[1]) : (row[2], row[3]) for row in connection.execute(text("SELECT drive_id, attribute_id, timestamp, raw_value FROM attribute_latest"))}
+
+        first = {}
+        for table, column in (("attribute_history_daily", "min_value"), ("attribute_history_hourly", "min_value"), ("attribute_history", "raw_value")):
+            for row in connection.execute(text("SELECT drive_id, attribute_id, timestamp, {} FROM {} WHERE timestamp >= {}".format(column, table, int(window_start)))):
+                key = (row[0], row[1])
+                if key not in first or row[2] < first[key][0]:
+                    first[key] = (row[2], row[3])
+
+    for key, (timestamp, current) in latest.items():
+        first_time, first_value = first.get(key, (timestamp, current))
+        rate = (current - first_value) / max((now - first_time) / DAY, 1.0)
+        limit = thresholds[names[key[1]]]
+
+        if rate > 0 and current <= limit and (limit - current) / rate <= settings["horizon_days"]:
+            projections.add((uuids[key[0]], names[key[1]]))
+
+    return projections
+
+def main():
+    arguments = argparse.ArgumentParser(description = "Benchmark the fleet wide trend analysis")
+    arguments.add_argument("--drives", type = int, default = 2000)
+    arguments.add_argument("--years", type = float, default = 2)
+    arguments.add_argument("--models", type = int, default = 10)
+    arguments.add_argument("--seed", type = int, default = 1)
+    options = arguments.parse_args()
+
+    if not is_trend_available():
+        print("NumPy is not installed; the trend analysis is not available")
+        return
+
+    now = time.time()
+    thresholds = {name : 100 for name in ATTRIBUTES}
+    settings = {"window_days" : 90, "horizon_days" : 30, "outlier_z" : 3.5, "min_peers" : 5}
+
+    started = time.monotonic()
+    engine, rows = build_database(options, now)
+    print("Drives: {}, attributes: {}, years: {}, history rows: {:,} (generated in {:.1f}s)".format(
+        options.drives, len(ATTRIBUTES), options.years, rows, time.monotonic() - started))
+
+    started = time.monotonic()
+    with engine.connect() as connection:
+        findings = get_trend_service(connection).analyze(thresholds, settings, now)
+    vectorized = time.monotonic() - started
+
+    started = time.monotonic()
+    projections = loop_projections(engine, thresholds, settings, now)
+    loop = time.monotonic() - started
+
+    # Both implementations must agree before their timings mean anything
+    assert projections == set((finding["uuid"], finding["attribute"]) for finding in findings if finding["kind"] == PROJECTION)
+
+    print("    projections   {:8d}".format(len(projections)))
+    print("    outliers      {:8d}".format(len(findings) - len(projections)))
+    print("    vectorized    {:8.2f} s".format(vectorized))
+    print("    per series    {:8.2f} s (projections only)".format(loop))
+
+if __name__ == "__main__":
+    main()
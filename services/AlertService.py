@@ -0,0 +1,53 @@
+import logging
+
+from sqlalchemy import text, bindparam
+
+LOGGER = logging.getLogger()
+
+SELECT_CHUNK_SIZE = 500
+
+def get_service(connection):
+    return AlertService(connection)
+
+# Remembers which alerts were already sent so an unchanged condition is not mailed on every run
+# Alerts are identified by a fingerprint of their drive and condition; a condition that clears is forgotten
+class AlertService():
+    def __init__(self, connection):
+        self.connection = connection
+
+    def create_table(self):
+        self.connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS sent_alerts ("
+            "fingerprint TEXT PRIMARY KEY, uuid TEXT NOT NULL, severity TEXT NOT NULL, first_sent REAL NOT NULL, last_seen REAL NOT NULL)"))
+        self.connection.execute(text("CREATE INDEX IF NOT EXISTS sent_alerts_uuid ON sent_alerts (uuid)"))
+
+    def __select_by_uuid(self, statement, uuids):
+        rows = []
+        statement = text(statement).bindparams(bindparam("uuids", expanding = True))
+
+        # Stay below SQLite's limit on bound parameters per statement
+        for i in range(0, len(uuids), SELECT_CHUNK_SIZE):
+            rows.extend(self.connection.execute(statement, {"uuids" : uuids[i:i + SELECT_CHUNK_SIZE]}).fetchall())
+
+        return rows
+
+    # Return the fingerprints of every alert already sent for the given drives
+    def get_sent(self, uuids):
+        return set(row[0] for row in self.__select_by_uuid("SELECT fingerprint FROM sent_alerts WHERE uuid IN :uuids", list(uuids)))
+
+    # Record the alerts raised for the given drives during a run
+    # Alerts have the following format: {"fingerprint" : "", "uuid" : "", "severity" : ""}
+    # Alerts of these drives that were not raised again have cleared and are forgotten so they are mailed if they come back
+    def update(self, uuids, alerts, now):
+        uuids = list(uuids)
+        active = set(alert["fingerprint"] for alert in alerts)
+
+        resolved = [{"fingerprint" : row[0]} for row in self.__select_by_uuid("SELECT fingerprint FROM sent_alerts WHERE uuid IN :uuids", uuids) if row[0] not in active]
+        if resolved:
+            self.connection.execute(text("DELETE FROM sent_alerts WHERE fingerprint = :fingerprint"), resolved)
+
+        if alerts:
+            self.connection.execute(text(
+                "INSERT INTO sent_alerts (fingerprint, uuid, severity, first_sent, last_seen) VALUES (:fingerprint, :uuid, :severity, :now, :now) "
+                "ON CONFLICT (fingerprint) DO UPDATE SET last_seen = excluded.last_seen"),
+                [{"fingerprint" : alert["fingerprint"], "uuid" : alert["uuid"], "severity" : alert["severity"], "now" : now} for alert in alerts])
@@ -0,0 +1,94 @@
+import logging
+import hashlib
+
+LOGGER = logging.getLogger()
+
+HEADER = "ATTRIBUTE_NAME"
+FAILING_NOW = "FAILING_NOW"
+
+def get_parser(smart):
+    return AttributeParser(smart)
+
+# Built once per configuration; parses SMART attribute tables in a single pass
+class AttributeParser():
+    def __init__(self, smart):
+        self.watch_list = frozenset(key.lower() for attribute in smart["attributes"] for key in attribute.keys())
+        self.attribute_name = int(smart.get("attribute_name", 1))
+        self.when_failed = int(smart.get("when_failed", 8))
+        self.raw_value = int(smart.get("raw_value", 9))
+
+    def __to_int(self, value):
+        if value.isdigit():
+            return int(value)
+
+        # Raw values may carry extra details (e.g. "35 (Min/Max 20/45)" or "1234h+05m"); keep the leading number
+        digits = ""
+        for character in value:
+            if not character.isdigit():
+                break
+            digits += character
+
+        return int(digits) if digits else 0
+
+    def __add(self, result, row):
+        result["rows"].append(row)
+
+        if row["name"] in self.watch_list:
+            result["watched"][row["name"]] = row["raw_value"]
+        if row["when_failed"] == FAILING_NOW:
+            result["failing"][row["name"]] = row["raw_value"]
+
+    # Select watched and failing attributes from rows that were already parsed (e.g. from JSON output)
+    def select(self, rows):
+        result = {"watched" : {}, "failing" : {}, "rows" : []}
+
+        for row in rows:
+            self.__add(result, row)
+
+        return result
+
+    # Digest of the part of a report that decisions are based on: watched attributes and anything failing now
+    # Attributes that change on every read (e.g. power on hours or temperature) are left out so unchanged drives match
+    def digest(self, smart_report):
+        digest = hashlib.sha1()
+
+        if smart_report["attributes"] is not None:
+            for row in smart_report["attributes"]:
+                if row["name"] in self.watch_list or row["when_failed"] == FAILING_NOW:
+                    digest.update("{} {} {}\n".format(row["name"], row["when_failed"], row["raw_value"]).encode())
+        else:
+            # Text lines are only normalized, not tokenized into columns
+            for line in smart_report["report"].split("\n"):
+                lowered = line.lower()
+                if "failing_now" in lowered or any(name in lowered for name in self.watch_list):
+                    digest.update((" ".join(lowered.split()) + "\n").encode())
+
+        return digest.hexdigest()
+
+    # Parse a text attribute table; every line is tokenized exactly once
+    def parse(self, report):
+        attribute_name = self.attribute_name
+        when_failed = self.when_failed
+        raw_value = self.raw_value
+        result = {"watched" : {}, "failing" : {}, "rows" : []}
+
+        for line in report.split("\n"):
+            tokens = line.split()
+
+            # Take column positions from the table header when present
+            if HEADER in tokens:
+                attribute_name = tokens.index(HEADER)
+                when_failed = tokens.index("WHEN_FAILED") if "WHEN_FAILED" in tokens else when_failed
+                raw_value = tokens.index("RAW_VALUE") if "RAW_VALUE" in tokens else raw_value
+                continue
+
+            if len(tokens) <= max(attribute_name, when_failed, raw_value) or not tokens[0].isdigit():
+                continue
+
+            self.__add(result, {
+                "id" : int(tokens[0]),
+                "name" : tokens[attribute_name].lower(),
+                "when_failed" : FAILING_NOW if FAILING_NOW in tokens[when_failed].upper() else tokens[when_failed],
+                "raw_value" : self.__to_int(tokens[raw_value])})
+
+        return result
@@ -0,0 +1,134 @@
+import logging
+import socket
+import struct
+import json
+import zlib
+import time
+import os
+
+LOGGER = logging.getLogger()
+
+# Frames are a 4 byte big endian length followed by zlib compressed JSON
+HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+PROTOCOL_VERSION = 1
+SPOOL_SUFFIX = ".batch"
+
+def get_service(address, port, spool_directory, host = None, token = None, timeout = 10, max_spool_batches = 1000):
+    return CollectorService(address, port, spool_directory, host or socket.gethostname(), token, timeout, max_spool_batches)
+
+def encode_frame(message):
+    payload = zlib.compress(json.dumps(message, separators = (",", ":")).encode())
+    return HEADER.pack(len(payload)) + payload
+
+def decode_payload(payload):
+    # Decompressed size is capped as well so a small frame cannot expand without bounds
+    decompressor = zlib.decompressobj()
+    data = decompressor.decompress(payload, MAX_FRAME_SIZE)
+    if decompressor.unconsumed_tail:
+        raise ValueError("Frame expands beyond the limit of {} bytes".format(MAX_FRAME_SIZE))
+
+    return json.loads(data.decode())
+
+def __read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) < size:
+        raise EOFError("Connection closed in the middle of a frame")
+
+    return data
+
+# Read one frame from a binary stream; returns None when the peer closed the connection between frames
+def read_frame(stream):
+    header = stream.read(HEADER.size)
+    if not header:
+        return None
+    if len(header) < HEADER.size:
+        raise EOFError("Connection closed in the middle of a frame")
+
+    size = HEADER.unpack(header)[0]
+    if size > MAX_FRAME_SIZE:
+        raise ValueError("Frame of {} bytes exceeds the limit of {} bytes".format(size, MAX_FRAME_SIZE))
+
+    return decode_payload(__read_exactly(stream, size))
+
+# Pushes attribute snapshots to an aggregator
+# Every batch is written to the spool directory first and only removed once the aggregator acknowledged it,
+# so batches collected while the aggregator is unreachable are delivered on a later push
+class CollectorService():
+    def __init__(self, address, port, spool_directory, host, token, timeout, max_spool_batches):
+        self.address = address
+        self.port = int(port)
+        self.spool_directory = spool_directory
+        self.host = host
+        self.token = token
+        self.timeout = float(timeout)
+        self.max_spool_batches = int(max_spool_batches)
+        self.sequence = 0
+
+        os.makedirs(self.spool_directory, exist_ok = True)
+
+    def __get_spooled(self):
+        # Batch names start with a zero padded timestamp, so name order is collection order
+        return sorted(name for name in os.listdir(self.spool_directory) if name.endswith(SPOOL_SUFFIX))
+
+    # Store a batch of snapshots for delivery; returns the batch id
+    def spool(self, snapshots):
+        self.sequence += 1
+        batch_id = "{}-{:.6f}-{}-{}".format(self.host, time.time(), os.getpid(), self.sequence)
+        name = "{:020.6f}-{}-{}{}".format(time.time(), os.getpid(), self.sequence, SPOOL_SUFFIX)
+
+        payload = encode_frame({
+            "version" : PROTOCOL_VERSION,
+            "id" : batch_id,
+            "host" : self.host,
+            "token" : self.token,
+            "created" : time.time(),
+            "snapshots" : snapshots})
+
+        # Written under a temporary name and renamed so a crash never leaves a partial batch behind
+        path = os.path.join(self.spool_directory, name)
+        with open(path + ".tmp", "wb") as batch:
+            batch.write(payload)
+            batch.flush()
+            os.fsync(batch.fileno())
+        os.replace(path + ".tmp", path)
+
+        # The oldest batches are dropped once the spool is full so a long outage cannot fill the disk
+        spooled = self.__get_spooled()
+        for name in spooled[:max(len(spooled) - self.max_spool_batches, 0)]:
+            LOGGER.warning("Collector -> Spool holds more than %s batches; dropping %s", self.max_spool_batches, name)
+            os.remove(os.path.join(self.spool_directory, name))
+
+        return batch_id
+
+    # Send spooled batches oldest first over one connection and remove every acknowledged batch
+    # Returns (sent, remaining); stops at the first failure and leaves the rest for the next push
+    def push(self):
+        spooled = self.__get_spooled()
+        sent = 0
+
+        if not spooled:
+            return 0, 0
+
+        try:
+            with socket.create_connection((self.address, self.port), timeout = self.timeout) as connection:
+                stream = connection.makefile("rb")
+
+                for name in spooled:
+                    path = os.path.join(self.spool_directory, name)
+                    with open(path, "rb") as batch:
+                        frame = batch.read()
+
+                    connection.sendall(frame)
+                    reply = read_frame(stream)
+                    batch_id = decode_payload(frame[HEADER.size:])["id"]
+
+                    if reply is None or reply.get("ack") != batch_id:
+                        raise ConnectionError("Aggregator rejected batch {}: {}".format(name, (reply or {}).get("error", "no acknowledgement")))
+
+                    os.remove(path)
+                    sent += 1
+        except (OSError, EOFError, ValueError) as exception:
+            LOGGER.warning("Collector -> Unable to push to aggregator at %s:%s: %s; %s batches stay spooled", self.address, self.port, exception, len(spooled) - sent)
+
+        return sent, len(spooled) - sent
@@ -0,0 +1,100 @@
+import logging
+import yaml
+import os
+
+LOGGER = logging.getLogger()
+
+# Keys added to disk entries at runtime; they are not part of the configured settings of a disk
+RUNTIME_KEYS = ("name", "group")
+
+# Sections, or single settings as "section.key", that are only read at startup; changes to them are reported but need a restart
+# The rest of the scheduler section and the discovery section are read again on every run
+RESTART_SECTIONS = ("logging", "smtp", "database", "metrics", "aggregator", "history", "self_tests", "scheduler.workers", "daemon.reload_interval",
+    "email.retry_delay", "email.max_retry_delay", "email.max_attempts")
+
+def get_service(filename):
+    return ConfigService(filename)
+
+# Configured disks as {uuid : (group, name, settings)}
+def get_disks(config):
+    disks = {}
+
+    for group, entries in (config.get("disks") or {}).items():
+        for disk in entries or []:
+            for name, settings in disk.items():
+                settings = {key : value for key, value in settings.items() if key not in RUNTIME_KEYS}
+                disks[str(settings["uuid"]).lower()] = (group, name, settings)
+
+    return disks
+
+def get_thresholds(config):
+    thresholds = {}
+
+    for attribute in config["smart"]["attributes"]:
+        for key in attribute.keys():
+            thresholds[key] = attribute[key]["threshold"]
+
+    return thresholds
+
+def __get_setting(config, name):
+    section, _, key = name.partition(".")
+    if not key:
+        return config.get(section)
+
+    return (config.get(section) or {}).get(key)
+
+# Compare two configurations and return what has to be applied to a running monitor
+# Disks are keyed by uuid; a disk whose name, group or settings changed is both removed and added so its state is reloaded
+# Returns {"added" : {uuid : (group, name, settings)}, "removed" : {...}, "thresholds" : {attribute : (old, new)},
+# "columns" : [new attribute names], "attributes" : bool, "smart" : bool, "restart" : [sections]}
+def get_diff(old, new):
+    old_disks = get_disks(old)
+    new_disks = get_disks(new)
+    old_thresholds = get_thresholds(old)
+    new_thresholds = get_thresholds(new)
+
+    changed = [uuid for uuid in old_disks.keys() & new_disks.keys() if old_disks[uuid] != new_disks[uuid]]
+
+    return {
+        "added" : {uuid : new_disks[uuid] for uuid in (new_disks.keys() - old_disks.keys()) | set(changed)},
+        "removed" : {uuid : old_disks[uuid] for uuid in (old_disks.keys() - new_disks.keys()) | set(changed)},
+        "thresholds" : {key : (old_thresholds.get(key), new_thresholds.get(key)) for key in old_thresholds.keys() | new_thresholds.keys() if old_thresholds.get(key) != new_thresholds.get(key)},
+        "columns" : sorted(new_thresholds.keys() - old_thresholds.keys()),
+        "attributes" : old["smart"]["attributes"] != new["smart"]["attributes"],
+        "smart" : old["smart"] != new["smart"],
+        "restart" : [name for name in RESTART_SECTIONS if __get_setting(old, name) != __get_setting(new, name)]}
+
+# Watches the configuration file for changes
+# Only the modification time and size are checked on every poll; the file is parsed once it changed
+class ConfigService():
+    def __init__(self, filename):
+        self.filename = filename
+        self.signature = self.__get_signature()
+
+    def __get_signature(self):
+        try:
+            status = os.stat(self.filename)
+        except OSError:
+            return None
+
+        return status.st_mtime_ns, status.st_size
+
+    # Return the new configuration when the file changed since the last poll and None otherwise
+    # A file that cannot be read or parsed is reported once and ignored until it changes again
+    def poll(self):
+        signature = self.__get_signature()
+        if signature is None or signature == self.signature:
+            return None
+
+        self.signature = signature
+
+        try:
+            with open(self.filename) as config_file:
+                config = yaml.safe_load(config_file)
+            get_disks(config)
+            get_thresholds(config)
+        except Exception as exception:
+            LOGGER.warning("Config -> Unable to load changed configuration %s: %s; keeping current configuration", self.filename, exception)
+            return None
+
+        return config
@@ -0,0 +1,87 @@
+import logging
+import re
+
+from services.RenderService import get_renderer, format_report, FORMAT_PLAIN
+
+LOGGER = logging.getLogger()
+
+MODE_NONE = "none"
+MODE_RUN = "run"
+MODE_GROUP = "group"
+
+# Order in which severities are summarised and listed in a digest
+SEVERITIES = ["FAILING", "WARNING", "PREDICTED", "MISSING", "INITIAL"]
+
+def get_service(mode = MODE_NONE, format = FORMAT_PLAIN):
+    return DigestService(mode, format)
+
+# Turns the alerts queued during a run into outgoing mail
+# Without a digest every alert is its own message; otherwise alerts are combined per run or per group
+# Bodies are rendered here, after suppression, so alerts that are never mailed are never rendered
+class DigestService():
+    def __init__(self, mode, format):
+        self.mode = str(mode or MODE_NONE).lower()
+        self.renderer = get_renderer(format)
+
+        if self.mode not in (MODE_NONE, MODE_RUN, MODE_GROUP):
+            raise ValueError("Invalid email digest mode: {}".format(mode))
+
+    def __get_order(self, alert):
+        severity = SEVERITIES.index(alert["severity"]) if alert["severity"] in SEVERITIES else len(SEVERITIES)
+        return (severity, alert["group"], alert["name"])
+
+    def __get_attachment_name(self, alert):
+        return "{}-{}-smartctl.txt".format(re.sub(r"[^\w.-]", "_", alert["group"].lower()), re.sub(r"[^\w.-]", "_", alert["name"]))
+
+    def __build_single(self, alert):
+        return {"subject" : alert["subject"], "body" : self.renderer.render_alert(alert), "subtype" : self.renderer.subtype}
+
+    def __build_digest(self, alerts, group = None):
+        alerts = sorted(alerts, key = self.__get_order)
+
+        counts = {}
+        for alert in alerts:
+            counts[alert["severity"]] = counts.get(alert["severity"], 0) + 1
+        severities = [severity for severity in SEVERITIES if severity in counts] + sorted(severity for severity in counts if severity not in SEVERITIES)
+
+        summary = ", ".join("{} {}".format(counts[severity], severity) for severity in severities)
+        subject = "SMART Monitor Digest: {}".format(summary)
+        if group is not None:
+            subject = "SMART Monitor Digest ({}): {}".format(group, summary)
+
+        sections = [
+            {"title" : "Summary:", "columns" : None, "rows" : [[severity, counts[severity]] for severity in severities]},
+            {"title" : "Alerts:", "columns" : None, "rows" : [[alert["severity"], "{} ({})".format(alert["name"], alert["group"])] for alert in alerts]}]
+
+        # Full smartctl dumps are attached once per drive instead of being pasted inline
+        # Every alert of a drive refers to the attachment of its first alert with a report
+        attachments = []
+        names = []
+        attached = {}
+        for alert in alerts:
+            if alert.get("report") and alert["uuid"] not in attached:
+                attached[alert["uuid"]] = self.__get_attachment_name(alert)
+                attachments.append({"filename" : attached[alert["uuid"]], "content" : format_report(alert["report"])})
+
+            names.append(attached.get(alert["uuid"]) if alert.get("report") else None)
+
+        return {"subject" : subject, "body" : self.renderer.render_digest(sections, alerts, names), "subtype" : self.renderer.subtype, "attachments" : attachments}
+
+    # Alerts have the format queued by the drive monitor: {"subject", "sections", "report", "severity", "name", "group", ...}
+    # Returns messages in the outbox format: {"subject" : "", "body" : "", "subtype" : "", "attachments" : [{"filename" : "", "content" : ""}]}
+    def build(self, alerts):
+        if not alerts:
+            return []
+
+        if self.mode == MODE_RUN:
+            return [self.__build_digest(alerts)]
+
+        if self.mode == MODE_GROUP:
+            groups = {}
+            for alert in alerts:
+                groups.setdefault(alert["group"], []).append(alert)
+
+            return [self.__build_digest(group_alerts, group) for group, group_alerts in groups.items()]
+
+        # Single messages keep the order they were handed in (the event bus hands out the most severe first)
+        return [self.__build_single(alert) for alert in alerts]
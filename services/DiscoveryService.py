@@ -0,0 +1,75 @@
+import logging
+import os
+
+LOGGER = logging.getLogger()
+
+BY_UUID_DIRECTORY = "/dev/disk/by-uuid/"
+SYSFS_BLOCK_DIRECTORY = "/sys/class/block/"
+
+def get_service(by_uuid_directory = None, sysfs_directory = None):
+    return DiscoveryService(by_uuid_directory or BY_UUID_DIRECTORY, sysfs_directory or SYSFS_BLOCK_DIRECTORY)
+
+# Maps configured filesystem UUIDs to the physical block devices that hold them
+# Partitions resolve to their disk and single-device mappers (e.g. LUKS) to the device beneath them
+class DiscoveryService():
+    def __init__(self, by_uuid_directory, sysfs_directory):
+        self.by_uuid_directory = by_uuid_directory
+        self.sysfs_directory = sysfs_directory
+
+    def get_link(self, uuid):
+        return os.path.join(self.by_uuid_directory, uuid.lower())
+
+    def __scan(self):
+        # Read the whole by-uuid directory once instead of checking every configured path
+        links = {}
+
+        try:
+            with os.scandir(self.by_uuid_directory) as entries:
+                for entry in entries:
+                    target = os.path.realpath(entry.path)
+                    if os.path.exists(target):
+                        links[entry.name.lower()] = target
+        except OSError as exception:
+            LOGGER.warning("Discovery -> Unable to read %s: %s", self.by_uuid_directory, exception)
+
+        return links
+
+    def __get_physical_device(self, device, depth = 0):
+        block = os.path.join(self.sysfs_directory, os.path.basename(device))
+
+        # Without sysfs information the device is probed as it is
+        if depth > 8 or not os.path.exists(block):
+            return device
+
+        # A partition's sysfs entry lives inside the entry of its disk
+        if os.path.exists(os.path.join(block, "partition")):
+            disk = os.path.basename(os.path.dirname(os.path.realpath(block)))
+            return self.__get_physical_device(os.path.join(os.path.dirname(device), disk), depth + 1)
+
+        # Device mappers backed by exactly one device are resolved to that device; RAID sets with several are kept
+        try:
+            slaves = os.listdir(os.path.join(block, "slaves"))
+        except OSError:
+            slaves = []
+
+        if len(slaves) == 1:
+            return self.__get_physical_device(os.path.join(os.path.dirname(device), slaves[0]), depth + 1)
+
+        return device
+
+    # Return {uuid : physical device path}; UUIDs that cannot be found map to None
+    def discover(self, uuids):
+        links = self.__scan()
+        devices = {}
+        locations = {}
+
+        for uuid in uuids:
+            uuid = uuid.lower()
+            target = links.get(uuid)
+
+            if target is not None and target not in devices:
+                devices[target] = self.__get_physical_device(target)
+
+            locations[uuid] = devices[target] if target is not None else None
+
+        return locations
@@ -1,7 +1,18 @@
 import logging
 
+from sqlalchemy import text, bindparam
+
 LOGGER = logging.getLogger()
 
+UUID_INDEX = "drives_uuid"
+
+# Columns describing the last time a drive was looked at, next to its attribute columns
+STATE_COLUMNS = {"status" : "TEXT", "last_seen" : "REAL", "report_digest" : "TEXT", "model" : "TEXT", "health" : "TEXT"}
+SELECT_CHUNK_SIZE = 500
+
+# Statements are built once per set of attribute columns and reused by every connection
+statements = {}
+
 def get_service(connection):
     return DriveService(connection)
 
@@ -9,63 +20,105 @@ class DriveService():
     def __init__(self, connection):
         self.connection = connection
 
-    def get_drive(self, uuid, variables):
-        result = self.connection.execute(self.__build_select(uuid, variables))
-        return result.first()
-
-    def add_drive(self, uuid, name, group, variables):
-        self.connection.execute(self.__build_insert(uuid, name, group, variables))
-
-    def update_drive(self, uuid, variables):
-        self.connection.execute(self.__build_update(uuid, variables))
+    # Read the given attribute columns of many drives with one query; returns {uuid : {column : value}}
+    def get_drives(self, uuids, variables):
+        columns = tuple(variables)
+        uuids = list(uuids)
+        drives = {}
+
+        # Stay below SQLite's limit on bound parameters per statement
+        for i in range(0, len(uuids), SELECT_CHUNK_SIZE):
+            result = self.connection.execute(self.__build_select_many(columns), {"uuids" : uuids[i:i + SELECT_CHUNK_SIZE]})
+            for row in result:
+                drives[row[0]] = dict(zip(columns, row[1:]))
+
+        return drives
+
+    # Insert or update many drives with one executemany per attribute column set
+    # Rows have the following format: {"uuid" : "", "name" : "", "group" : "", "attributes" : {}, "status" : "", "last_seen" : 0, "report_digest" : "", "model" : "", "health" : ""}
+    # Callers are expected to wrap this in a transaction (e.g. engine.begin()) so a run is written at once
+    def bulk_upsert(self, rows):
+        batches = {}
+
+        for row in rows:
+            columns = tuple(row["attributes"])
+            batches.setdefault(columns, []).append(dict(
+                row["attributes"], uuid = row["uuid"], name = row["name"], code_group = row["group"],
+                status = row.get("status"), last_seen = row.get("last_seen"), report_digest = row.get("report_digest"), model = row.get("model"),
+                health = row.get("health")))
+
+        for columns, parameters in batches.items():
+            self.connection.execute(self.__build_upsert(columns), parameters)
+
+    # Update only the status of many drives, keeping their stored attributes; last_seen, report_digest, model and health are kept when None
+    # Rows have the following format: {"uuid" : "", "status" : "", "last_seen" : 0, "report_digest" : "", "model" : "", "health" : ""}
+    def touch_drives(self, rows):
+        if rows:
+            self.connection.execute(text(
+                "UPDATE drives SET status = :status, last_seen = COALESCE(:last_seen, last_seen), report_digest = COALESCE(:report_digest, report_digest), "
+                "model = COALESCE(:model, model), health = COALESCE(:health, health) WHERE uuid = :uuid"),
+                [{"uuid" : row["uuid"], "status" : row.get("status"), "last_seen" : row.get("last_seen"), "report_digest" : row.get("report_digest"), "model" : row.get("model"),
+                  "health" : row.get("health")} for row in rows])
 
     def create_table(self):
         self.connection.execute(self.__build_create())
+        self.connection.execute(self.__build_uuid_index())
+
+    def add_state_column(self, column):
+        self.connection.execute(text("ALTER TABLE drives ADD COLUMN " + column + " " + STATE_COLUMNS[column]))
 
     def add_table_column(self, column):
         self.connection.execute(self.__add_column(column))
         self.connection.execute(self.__initialize_column(column))
 
+    def has_uuid_index(self):
+        result = self.connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'index' AND name = :name"), {"name" : UUID_INDEX})
+        return result.first() is not None
 
-    def __build_create(self):
-        return "CREATE TABLE drives (id INTEGER PRIMARY KEY AUTOINCREMENT, uuid TEXT, name TEXT, code_group TEXT, last_updated TEXT)"
-
-    def __add_column(self, column):
-        return "ALTER TABLE drives ADD COLUMN " + column + " INTEGER"
-
-    def __initialize_column(self, column):
-        return "UPDATE drives SET " + column + " = 0"
-
-    def __build_select(self, uuid, variables):
-        statement = "SELECT "
-
-        for i, key in enumerate(variables):
-            statement += key + (", " if i < len(variables) - 1 else "")
+    # Migrate databases created before uuid was unique; keeps the most recent row of any duplicated drive
+    def create_uuid_index(self):
+        self.connection.execute(text("DELETE FROM drives WHERE id NOT IN (SELECT MAX(id) FROM drives GROUP BY uuid)"))
+        self.connection.execute(self.__build_uuid_index())
 
-        statement += " FROM drives WHERE uuid = '{}'".format(uuid)
 
-        return statement
+    def __check_columns(self, columns):
+        # Column names cannot be bound as parameters; only allow plain identifiers from the configuration
+        for column in columns:
+            if not column.isidentifier():
+                raise ValueError("Invalid attribute column name: {}".format(column))
 
-    def __build_update(self, uuid, variables):
-        statement = "UPDATE drives SET last_updated = date('now'), "
+    def __cached(self, key, build):
+        if key not in statements:
+            self.__check_columns(key[1])
+            statements[key] = build()
 
-        column = "{} = {}"
+        return statements[key]
 
-        for i, key in enumerate(variables):
-            statement += column.format(key, str(variables[key])) + (", " if i < len(variables) - 1 else "")
-
-        statement += " WHERE uuid = '{}'".format(uuid)
+    def __build_create(self):
+        return text("CREATE TABLE drives (id INTEGER PRIMARY KEY AUTOINCREMENT, uuid TEXT, name TEXT, code_group TEXT, last_updated TEXT, status TEXT, last_seen REAL, report_digest TEXT, model TEXT, health TEXT)")
 
-        return statement
+    def __build_uuid_index(self):
+        return text("CREATE UNIQUE INDEX IF NOT EXISTS " + UUID_INDEX + " ON drives (uuid)")
 
-    def __build_insert(self, uuid, name, group, variables):
-        statement = "INSERT INTO drives (uuid, name, code_group, last_updated, "
-        values = "VALUES ('{}', '{}', '{}', date('now'), ".format(uuid, name, group)
-            
-        for i, key in enumerate(variables):
-            statement += key + (", " if i < len(variables) - 1 else ") ")
-            values += str(variables[key]) + (", " if i < len(variables) - 1 else ")")
-    
-        statement += values
+    def __add_column(self, column):
+        self.__check_columns([column])
+        return text("ALTER TABLE drives ADD COLUMN " + column + " INTEGER")
 
-        return statement
\ No newline at end of file
+    def __initialize_column(self, column):
+        self.__check_columns([column])
+        return text("UPDATE drives SET " + column + " = 0")
+
+    def __build_select_many(self, columns):
+        return self.__cached(("select_many", columns), lambda: text(
+            "SELECT " + ", ".join(("uuid",) + columns) + " FROM drives WHERE uuid IN :uuids").bindparams(bindparam("uuids", expanding = True)))
+
+    def __build_upsert(self, columns):
+        # Existing drives keep their name and group; only the attributes, status and last update date change
+        return self.__cached(("upsert", columns), lambda: text(
+            "INSERT INTO drives (" + ", ".join(("uuid", "name", "code_group", "last_updated", "status", "last_seen", "report_digest", "model", "health") + columns) + ") "
+            "VALUES (" + ", ".join([":uuid", ":name", ":code_group", "date('now')", ":status", ":last_seen", ":report_digest", ":model", ":health"] + [":" + column for column in columns]) + ") "
+            "ON CONFLICT (uuid) DO UPDATE SET " + ", ".join(
+                ["last_updated = excluded.last_updated", "status = excluded.status", "last_seen = COALESCE(excluded.last_seen, last_seen)",
+                 "report_digest = COALESCE(excluded.report_digest, report_digest)", "model = COALESCE(excluded.model, model)",
+                 "health = COALESCE(excluded.health, health)"] +
+                ["{0} = excluded.{0}".format(column) for column in columns])))
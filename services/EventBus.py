@@ -0,0 +1,91 @@
+import threading
+import logging
+
+from queue import SimpleQueue, Empty
+
+LOGGER = logging.getLogger()
+
+# Order in which alerts are handed out; trend predictions rank with warnings and unknown severities come last
+# Digests list severities in their own order (DigestService.SEVERITIES)
+SEVERITIES = ["FAILING", "WARNING", "PREDICTED", "INITIAL", "MISSING"]
+
+DEFAULT_CAPACITY = 10000
+
+def get_bus(capacity = DEFAULT_CAPACITY):
+    return EventBus(capacity)
+
+def get_priority(severity):
+    return SEVERITIES.index(severity) if severity in SEVERITIES else len(SEVERITIES)
+
+# Carries alerts from drive monitors to the code that mails them
+# Alerts have the format published by DriveMonitor ({"subject", "sections", "report", "severity", "fingerprint", "uuid", "name", "group"})
+# Every severity has its own SimpleQueue, so producers never share a lock and drain() returns the most severe alerts first
+# At most about capacity alerts are pending; an alert published while the bus is full is dropped and counted
+# The check reads the queue sizes without a lock, so concurrent publishers may overshoot capacity by one alert each;
+# only dropped alerts take the lock that guards the drop counts
+class EventBus():
+    def __init__(self, capacity):
+        self.capacity = max(int(capacity), 1)
+        self.queues = [SimpleQueue() for _ in range(len(SEVERITIES) + 1)]
+        self.subscribers = []
+        self.dispatched = SimpleQueue()
+        self.drops_lock = threading.Lock()
+        self.dropped = {}
+        self.drained = 0
+
+    # Call handler(alerts) with every alert of the given severities as soon as it is published instead of queueing it
+    # Handlers run on the publishing thread; an alert whose handler raised is queued as usual so it is not lost
+    # Subscribing while alerts are published is safe; alerts already queued stay queued
+    def subscribe(self, handler, severities):
+        # Replaced as a whole so publishers iterating the previous list are not affected
+        self.subscribers = self.subscribers + [(handler, frozenset(severities))]
+
+    # Returns False when the alert was dropped because the bus was full
+    def publish(self, alert):
+        for handler, severities in self.subscribers:
+            if alert["severity"] in severities:
+                try:
+                    handler([alert])
+                except Exception:
+                    LOGGER.exception("Events -> Subscriber failed to handle alert '%s'; queueing it for the end of the run", alert["subject"])
+                else:
+                    self.dispatched.put(alert)
+                    return True
+
+        if sum(queue.qsize() for queue in self.queues) >= self.capacity:
+            with self.drops_lock:
+                self.dropped[alert["severity"]] = self.dropped.get(alert["severity"], 0) + 1
+            LOGGER.error("Events -> Alert bus full (%s pending); dropped alert '%s'", self.capacity, alert["subject"])
+            return False
+
+        self.queues[get_priority(alert["severity"])].put(alert)
+        return True
+
+    def __drain_queue(self, queue):
+        items = []
+
+        while True:
+            try:
+                items.append(queue.get_nowait())
+            except Empty:
+                return items
+
+    # Remove and return every queued alert, most severe first and in publishing order within a severity
+    def drain(self):
+        alerts = []
+
+        for queue in self.queues:
+            alerts.extend(self.__drain_queue(queue))
+
+        self.drained += len(alerts)
+        return alerts
+
+    # Remove and return the alerts that subscribers handled since the last call
+    def get_dispatched(self):
+        return self.__drain_queue(self.dispatched)
+
+    def get_stats(self):
+        with self.drops_lock:
+            dropped = dict(self.dropped)
+
+        return {"drained" : self.drained, "dropped" : dropped, "capacity" : self.capacity}
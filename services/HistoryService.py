@@ -0,0 +1,164 @@
+import logging
+
+from sqlalchemy import text, bindparam
+
+LOGGER = logging.getLogger()
+
+HOUR = 3600
+DAY = 86400
+SELECT_CHUNK_SIZE = 500
+
+# Attribute name to id mapping; attribute ids never change once assigned and are only cached once committed
+attribute_ids = {}
+
+def get_service(connection):
+    return HistoryService(connection)
+
+# Stores attribute values over time
+# Raw samples are only written when a value changes and are later rolled up into hourly and daily buckets
+class HistoryService():
+    def __init__(self, connection):
+        self.connection = connection
+        self.assigned_ids = {}
+
+    def create_tables(self):
+        self.connection.execute(text("CREATE TABLE IF NOT EXISTS attributes (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)"))
+
+        # Primary keys lead with drive and attribute so reading one series is a single range scan
+        self.connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS attribute_history ("
+            "drive_id INTEGER NOT NULL, attribute_id INTEGER NOT NULL, timestamp INTEGER NOT NULL, raw_value INTEGER NOT NULL, "
+            "PRIMARY KEY (drive_id, attribute_id, timestamp)) WITHOUT ROWID"))
+        self.connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS attribute_latest ("
+            "drive_id INTEGER NOT NULL, attribute_id INTEGER NOT NULL, timestamp INTEGER NOT NULL, raw_value INTEGER NOT NULL, "
+            "PRIMARY KEY (drive_id, attribute_id)) WITHOUT ROWID"))
+
+        for table in ("attribute_history_hourly", "attribute_history_daily"):
+            self.connection.execute(text(
+                "CREATE TABLE IF NOT EXISTS " + table + " ("
+                "drive_id INTEGER NOT NULL, attribute_id INTEGER NOT NULL, timestamp INTEGER NOT NULL, "
+                "min_value INTEGER NOT NULL, max_value INTEGER NOT NULL, last_value INTEGER NOT NULL, samples INTEGER NOT NULL, "
+                "PRIMARY KEY (drive_id, attribute_id, timestamp)) WITHOUT ROWID"))
+
+        # Retention works across all drives by age, which needs its own index
+        for table in ("attribute_history", "attribute_history_hourly", "attribute_history_daily"):
+            self.connection.execute(text("CREATE INDEX IF NOT EXISTS " + table + "_timestamp ON " + table + " (timestamp)"))
+
+    def __get_attribute_ids(self, names):
+        missing = [name for name in names if name not in attribute_ids]
+
+        if missing:
+            # Ids inserted here are rolled back with the transaction; they stay out of the shared cache until cache_attribute_ids()
+            self.connection.execute(text("INSERT OR IGNORE INTO attributes (name) VALUES (:name)"), [{"name" : name} for name in missing])
+            for row in self.connection.execute(text("SELECT id, name FROM attributes")):
+                self.assigned_ids[row[1]] = row[0]
+
+            return dict(attribute_ids, **self.assigned_ids)
+
+        return attribute_ids
+
+    # Call after the transaction of write_samples() is committed
+    def cache_attribute_ids(self):
+        attribute_ids.update(self.assigned_ids)
+        self.assigned_ids = {}
+
+    def __select_by_uuid(self, statement, uuids):
+        rows = []
+        statement = text(statement).bindparams(bindparam("uuids", expanding = True))
+
+        # Stay below SQLite's limit on bound parameters per statement
+        for i in range(0, len(uuids), SELECT_CHUNK_SIZE):
+            rows.extend(self.connection.execute(statement, {"uuids" : uuids[i:i + SELECT_CHUNK_SIZE]}).fetchall())
+
+        return rows
+
+    # Record the attribute values of many drives; samples have the format {"uuid" : "", "timestamp" : 0, "attributes" : {}}
+    # Drives must already exist in the drives table; returns the number of values written
+    def write_samples(self, samples):
+        if not samples:
+            return 0
+
+        uuids = list(set(sample["uuid"] for sample in samples))
+        ids = self.__get_attribute_ids(set().union(*(sample["attributes"].keys() for sample in samples)))
+
+        drive_ids = {}
+        for row in self.__select_by_uuid("SELECT uuid, id FROM drives WHERE uuid IN :uuids", uuids):
+            drive_ids[row[0]] = row[1]
+
+        latest = {}
+        for row in self.__select_by_uuid(
+                "SELECT l.drive_id, l.attribute_id, l.raw_value FROM attribute_latest l "
+                "JOIN drives d ON d.id = l.drive_id WHERE d.uuid IN :uuids", uuids):
+            latest[(row[0], row[1])] = row[2]
+
+        # Only values that differ from the latest stored value are written
+        changed = []
+        for sample in samples:
+            if sample["uuid"] not in drive_ids:
+                continue
+
+            for name, value in sample["attributes"].items():
+                key = (drive_ids[sample["uuid"]], ids[name])
+                if latest.get(key) != int(value):
+                    latest[key] = int(value)
+                    changed.append({"drive_id" : key[0], "attribute_id" : key[1], "timestamp" : int(sample["timestamp"]), "raw_value" : int(value)})
+
+        if changed:
+            self.connection.execute(text(
+                "INSERT OR REPLACE INTO attribute_history (drive_id, attribute_id, timestamp, raw_value) "
+                "VALUES (:drive_id, :attribute_id, :timestamp, :raw_value)"), changed)
+            self.connection.execute(text(
+                "INSERT OR REPLACE INTO attribute_latest (drive_id, attribute_id, timestamp, raw_value) "
+                "VALUES (:drive_id, :attribute_id, :timestamp, :raw_value)"), changed)
+
+        return len(changed)
+
+    def __rollup(self, source, target, bucket, cutoff, raw):
+        # Raw samples carry a single value while rollups already carry min, max and last values
+        minimum = "raw_value" if raw else "min_value"
+        maximum = "raw_value" if raw else "max_value"
+        last = "raw_value" if raw else "last_value"
+        count = "1" if raw else "samples"
+
+        self.connection.execute(text(
+            "INSERT INTO " + target + " (drive_id, attribute_id, timestamp, min_value, max_value, last_value, samples) "
+            "SELECT s.drive_id, s.attribute_id, (s.timestamp / :bucket) * :bucket AS bucket, MIN(s." + minimum + "), MAX(s." + maximum + "), "
+            "(SELECT l." + last + " FROM " + source + " l WHERE l.drive_id = s.drive_id AND l.attribute_id = s.attribute_id "
+            "AND l.timestamp >= (s.timestamp / :bucket) * :bucket AND l.timestamp < (s.timestamp / :bucket) * :bucket + :bucket "
+            "ORDER BY l.timestamp DESC LIMIT 1), "
+            "SUM(" + count + ") FROM " + source + " s WHERE s.timestamp < :cutoff "
+            "GROUP BY s.drive_id, s.attribute_id, bucket "
+            "ON CONFLICT (drive_id, attribute_id, timestamp) DO UPDATE SET "
+            "min_value = MIN(min_value, excluded.min_value), max_value = MAX(max_value, excluded.max_value), "
+            "last_value = excluded.last_value, samples = samples + excluded.samples"), {"bucket" : bucket, "cutoff" : cutoff})
+        self.connection.execute(text("DELETE FROM " + source + " WHERE timestamp < :cutoff"), {"cutoff" : cutoff})
+
+    # Roll raw samples into hourly buckets and hourly buckets into daily buckets once they exceed their age
+    # A retention of 0 days keeps the data forever
+    def apply_retention(self, now, raw_days, hourly_days, daily_days):
+        if raw_days:
+            # Cutoff is aligned to a bucket boundary so a bucket is never rolled up twice
+            self.__rollup("attribute_history", "attribute_history_hourly", HOUR, (int(now - raw_days * DAY) // HOUR) * HOUR, True)
+        if hourly_days:
+            self.__rollup("attribute_history_hourly", "attribute_history_daily", DAY, (int(now - hourly_days * DAY) // DAY) * DAY, False)
+        if daily_days:
+            self.connection.execute(text("DELETE FROM attribute_history_daily WHERE timestamp < :cutoff"), {"cutoff" : int(now - daily_days * DAY)})
+
+    # Return [(timestamp, value)] of an attribute of a drive between start and end (inclusive) in ascending order
+    # Older parts of the range come from the rollups, using the last value of every bucket
+    def get_series(self, uuid, attribute, start, end):
+        key = self.connection.execute(text(
+            "SELECT d.id, a.id FROM drives d, attributes a WHERE d.uuid = :uuid AND a.name = :attribute"), {"uuid" : uuid, "attribute" : attribute}).first()
+        if key is None:
+            return []
+
+        result = self.connection.execute(text(
+            "SELECT timestamp, last_value FROM attribute_history_daily WHERE drive_id = :drive_id AND attribute_id = :attribute_id AND timestamp BETWEEN :start AND :end "
+            "UNION ALL "
+            "SELECT timestamp, last_value FROM attribute_history_hourly WHERE drive_id = :drive_id AND attribute_id = :attribute_id AND timestamp BETWEEN :start AND :end "
+            "UNION ALL "
+            "SELECT timestamp, raw_value FROM attribute_history WHERE drive_id = :drive_id AND attribute_id = :attribute_id AND timestamp BETWEEN :start AND :end "
+            "ORDER BY 1"), {"drive_id" : key[0], "attribute_id" : key[1], "start" : int(start), "end" : int(end)})
+
+        return [(row[0], row[1]) for row in result]
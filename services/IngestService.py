@@ -0,0 +1,98 @@
+import concurrent.futures
+import collections
+import logging
+import tarfile
+import os
+
+from services.SmartService import get_service as get_smart_service
+from services.AttributeParser import get_parser as get_attribute_parser
+
+LOGGER = logging.getLogger()
+
+UUID_TAG = "uuid:"
+
+# Parser of the current worker process; built once by the pool initializer
+worker_parser = None
+
+def get_service(smart, workers = None, window = None):
+    return IngestService(smart, workers, window)
+
+def init_worker(smart):
+    global worker_parser
+    worker_parser = get_attribute_parser(smart)
+
+# Runs in a worker process: returns (uuid, smart report) with the attribute table already parsed
+# The uuid is taken from a leading "uuid: <uuid>" line when present and from the file name otherwise
+def parse_capture(name, content):
+    output = content.decode("utf-8", "replace")
+
+    first, separator, rest = output.lstrip().partition("\n")
+    if first.lower().startswith(UUID_TAG):
+        uuid = first[len(UUID_TAG):].strip()
+        output = rest
+    else:
+        uuid = os.path.basename(name).split(".")[0]
+
+    smart_report = get_smart_service().parse_capture(output)
+    if smart_report["attributes"] is None:
+        smart_report["attributes"] = worker_parser.parse(smart_report["report"])["rows"]
+    if not smart_report["attributes"]:
+        raise ValueError("no SMART attribute table found")
+
+    return uuid.lower(), smart_report
+
+# Streams captured smartctl outputs from a directory or tarball and parses them in a process pool
+# At most window files are read ahead of the caller, so memory stays flat regardless of the number of files
+class IngestService():
+    def __init__(self, smart, workers, window):
+        self.smart = smart
+        self.workers = workers or os.cpu_count() or 1
+        self.window = window or self.workers * 4
+
+    def __read_directory(self, path):
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    yield from self.__read_directory(entry.path)
+                elif entry.is_file() and not entry.name.startswith("."):
+                    with open(entry.path, "rb") as capture:
+                        yield entry.path, capture.read()
+
+    def __read_archive(self, path):
+        # Stream mode reads members one after another without loading the archive index
+        with tarfile.open(path, "r|*") as archive:
+            for member in archive:
+                if member.isfile() and not os.path.basename(member.name).startswith("."):
+                    yield member.name, archive.extractfile(member).read()
+
+    def read(self, path):
+        if os.path.isdir(path):
+            return self.__read_directory(path)
+
+        return self.__read_archive(path)
+
+    # Yield (name, uuid, smart report) for every capture under path, in the order they were read
+    # Keeping that order lets several captures of the same drive be compared one after another
+    def parse(self, path):
+        with concurrent.futures.ProcessPoolExecutor(self.workers, initializer = init_worker, initargs = (self.smart,)) as executor:
+            pending = collections.deque()
+
+            for name, content in self.read(path):
+                pending.append((name, executor.submit(parse_capture, name, content)))
+
+                if len(pending) >= self.window:
+                    yield self.__next(pending)
+
+            while pending:
+                yield self.__next(pending)
+
+    def __next(self, pending):
+        name, future = pending.popleft()
+
+        try:
+            uuid, smart_report = future.result()
+        except Exception as exception:
+            LOGGER.warning("Ingest -> Unable to parse %s: %s; skipping...", name, exception)
+            return name, None, None
+
+        return name, uuid, smart_report
@@ -0,0 +1,64 @@
+import logging
+import logging.handlers
+import queue
+import json
+import time
+
+# Value of logging.format that selects JSON lines instead of a format string
+JSON_FORMAT = "json"
+DEFAULT_FORMAT = "%(asctime)s [%(levelname)-6.6s] %(message)s"
+
+# Messages are written as "<component> -> <text>"; the component becomes its own field
+COMPONENT_SEPARATOR = " -> "
+
+def get_formatter(log_format = None):
+    if log_format and log_format.strip().lower() == JSON_FORMAT:
+        return JsonLinesFormatter()
+
+    return logging.Formatter(log_format or DEFAULT_FORMAT)
+
+# Start a listener that hands records queued by get_handler to handlers on a background thread
+# Handlers keep their own levels, so a file handler may log less than the console or the other way around
+def get_listener(records, handlers):
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level = True)
+    listener.start()
+    return listener
+
+def get_handler(records = None):
+    return DeferredQueueHandler(records if records is not None else queue.SimpleQueue())
+
+# Puts records on a queue without formatting them first
+# The standard QueueHandler merges the message and its arguments in the calling thread; here that is left to the listener,
+# so worker threads only pay for the level check and the queue put. Callers must not mutate arguments after logging them
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+# Writes one JSON object per record so events can be filtered by drive and phase without parsing free text
+# Drive and phase come from the extra argument of the logging call and are null for records that carry neither
+class JsonLinesFormatter(logging.Formatter):
+    def formatTime(self, record, datefmt = None):
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + ".{:03d}".format(int(record.msecs)) + time.strftime("%z", time.localtime(record.created))
+
+    def format(self, record):
+        message = record.getMessage()
+        component = None
+
+        prefix, separator, text = message.partition(COMPONENT_SEPARATOR)
+        if separator and prefix and "\n" not in prefix:
+            component = prefix
+            message = text
+
+        event = {
+            "time" : self.formatTime(record),
+            "level" : record.levelname,
+            "thread" : record.threadName,
+            "component" : component,
+            "drive" : getattr(record, "drive", None),
+            "phase" : getattr(record, "phase", None),
+            "message" : message}
+
+        if record.exc_info:
+            event["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(event, default = str)
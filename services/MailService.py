@@ -1,33 +1,13 @@
 import logging
 import smtplib
-import time
 
 from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
 from email import charset
 
 LOGGER = logging.getLogger()
 
 def get_service(hostname, port, tls, username, password):
-    server = None
-
-    try:
-        if tls:
-            server = smtplib.SMTP_SSL(hostname, port, timeout = 3)
-        else:
-            server = smtplib.SMTP(hostname, port, timeout = 3)
-
-        if username and password:
-            server.login(username, password)
-    except smtplib.SMTPAuthenticationError:
-        LOGGER.error("Issue with login to SMTP server -> Authentication to SMTP server failed. Please check your username and password.")
-        return None
-    except smtplib.SMTPException:
-        LOGGER.error("Issue with connecting with SMTP server -> Unable to connect to SMTP server. Please check your configuration.")
-        return None
-    finally:
-        if server:
-            server.quit()
-
     return MailService(hostname, port, tls, username, password)
 
 class MailService():
@@ -37,7 +17,7 @@ class MailService():
         self.tls = tls
         self.username = username
         self.password = password
-        self.attempts = 2
+        self.server = None
 
     def __connect(self):
         charset.add_charset("utf-8", charset.SHORTEST, charset.QP)
@@ -52,56 +32,45 @@ class MailService():
 
         return server
 
-    # Recommended for only sending messages sparingly otherwise SMTP providers like GMail will 
-    # disconnect if too many connection attempts are made within a certain amount of time
-    def send_message(self, sender, destination, subject, body):
-        # Build envelope
-        envelope  = MIMEText(body, "plain", "utf-8")
+    # The subtype is the MIME text subtype of the body, such as "plain" or "html"
+    def __build_envelope(self, sender, destination, subject, body, attachments = None, subtype = "plain"):
+        envelope  = MIMEText(body, subtype, "utf-8")
+
+        # Attachments are plain text files with the following format: {"filename" : "", "content" : ""}
+        if attachments:
+            envelope = MIMEMultipart()
+            envelope.attach(MIMEText(body, subtype, "utf-8"))
+
+            for attachment in attachments:
+                part = MIMEText(attachment["content"], "plain", "utf-8")
+                part.add_header("Content-Disposition", "attachment", filename = attachment["filename"])
+                envelope.attach(part)
+
         envelope["Subject"] = subject
         envelope["From"] = sender
         envelope["To"] = destination
 
-        # Send envelope
-        server = self.__connect()
-        for i in range(self.attempts):
+        return envelope
+
+    # Send a single message over a connection that is kept open for the following messages
+    # Raises smtplib.SMTPException or OSError on failure; the connection is dropped so the next call reconnects
+    def deliver(self, sender, destination, subject, body, attachments = None, subtype = "plain"):
+        envelope = self.__build_envelope(sender, destination, subject, body, attachments, subtype)
+
+        try:
+            if self.server is None:
+                self.server = self.__connect()
+
+            self.server.sendmail(sender, destination, envelope.as_string())
+        except (smtplib.SMTPException, OSError):
+            self.close()
+            raise
+
+    def close(self):
+        if self.server is not None:
             try:
-                server.sendmail(sender, destination, envelope.as_string())
-                break
-            except smtplib.SMTPException:
-                if i < self.attempts - 1:
-                    LOGGER.warning("Issue with sending mail through SMTP server -> Retrying connection...")
-                    server.quit()
-                    time.sleep(30)
-                    server = self.connect()
-                else:
-                    LOGGER.error("Issue with sending mail through SMTP server -> Could not connect to SMTP server!")
-
-        server.quit()
-
-    # Send multiple messages with the following format: {"subject" : "", "body" : ""}
-    def bulk_message(self, sender, destination, messages):
-        # Connection made earlier in preperation for bulk messaging
-        server = self.__connect()
-
-        for message in messages:
-            # Build envelope
-            envelope  = MIMEText(message["body"], "plain", "utf-8")
-            envelope["Subject"] = message["subject"]
-            envelope["From"] = sender
-            envelope["To"] = destination
-
-            # Send envelope
-            for i in range(self.attempts):
-                try:
-                    server.sendmail(sender, destination, envelope.as_string())
-                    break
-                except smtplib.SMTPException:
-                    if i < self.attempts - 1:
-                        LOGGER.warning("Issue with sending mail through SMTP server -> Retrying connection...")
-                        server.quit()
-                        time.sleep(30)
-                        server = self.connect()
-                    else:
-                        LOGGER.error("Issue with sending mail through SMTP server -> Could not connect to SMTP server!")
-
-        server.quit()
\ No newline at end of file
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+
+            self.server = None
@@ -0,0 +1,93 @@
+import threading
+import bisect
+import logging
+
+LOGGER = logging.getLogger()
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Internal histograms by name; filled by the services and threads that own the measured code
+histograms = {}
+histograms_lock = threading.Lock()
+
+def get_histogram(name, description, buckets = DEFAULT_BUCKETS):
+    with histograms_lock:
+        if name not in histograms:
+            histograms[name] = Histogram(name, description, buckets)
+
+        return histograms[name]
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(labels):
+    return "{" + ",".join("{}=\"{}\"".format(key, escape(value)) for key, value in labels) + "}"
+
+# Cumulative histogram of durations in seconds; observing is cheap enough to stay on when nothing is exported
+class Histogram():
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    def render(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+
+        lines = ["# TYPE {} histogram".format(self.name), "# HELP {} {}".format(self.name, self.description), "# UNIT {} seconds".format(self.name)]
+
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(self.name, format_labels([("le", "+Inf" if bound == float("inf") else repr(float(bound)))]), cumulative))
+
+        lines.append("{}_sum {}".format(self.name, repr(total)))
+        lines.append("{}_count {}".format(self.name, cumulative))
+
+        return lines
+
+# Render the latest values of the watched attributes, additional gauges and all internal histograms
+# Drives have the following format: {"name" : "", "group" : "", "uuid" : "", "attributes" : {}, "last_seen" : 0}
+# Gauges have the following format: {name : (description, value)}
+def render(drives, gauges):
+    lines = [
+        "# TYPE smart_monitor_attribute_raw_value gauge",
+        "# HELP smart_monitor_attribute_raw_value Raw value of a watched SMART attribute from the latest run"]
+
+    for drive in drives:
+        for attribute, value in sorted(drive["attributes"].items()):
+            if value is not None:
+                lines.append("smart_monitor_attribute_raw_value{} {}".format(
+                    format_labels([("name", drive["name"]), ("group", drive["group"]), ("uuid", drive["uuid"]), ("attribute", attribute)]), int(value)))
+
+    lines.append("# TYPE smart_monitor_drive_last_seen_seconds gauge")
+    lines.append("# HELP smart_monitor_drive_last_seen_seconds Time of the last full read of a drive")
+    lines.append("# UNIT smart_monitor_drive_last_seen_seconds seconds")
+    for drive in drives:
+        if drive.get("last_seen") is not None:
+            lines.append("smart_monitor_drive_last_seen_seconds{} {}".format(
+                format_labels([("name", drive["name"]), ("group", drive["group"]), ("uuid", drive["uuid"])]), repr(float(drive["last_seen"]))))
+
+    for name, (description, value) in sorted(gauges.items()):
+        lines.append("# TYPE {} gauge".format(name))
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("{} {}".format(name, value))
+
+    with histograms_lock:
+        registered = sorted(histograms.values(), key = lambda histogram: histogram.name)
+    for histogram in registered:
+        lines.extend(histogram.render())
+
+    lines.append("# EOF")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,82 @@
+import logging
+import json
+
+from sqlalchemy import text
+
+LOGGER = logging.getLogger()
+
+PENDING = "pending"
+SENT = "sent"
+FAILED = "failed"
+
+def get_service(connection):
+    return OutboxService(connection)
+
+# Mail waiting to be delivered; kept in the local database so it survives restarts
+class OutboxService():
+    def __init__(self, connection):
+        self.connection = connection
+
+    def create_table(self):
+        self.connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, sender TEXT NOT NULL, destination TEXT NOT NULL, subject TEXT NOT NULL, body TEXT NOT NULL, "
+            "status TEXT NOT NULL, created REAL NOT NULL, next_attempt REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "last_error TEXT, delivered REAL, attachments TEXT, subtype TEXT)"))
+        self.connection.execute(text("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt)"))
+
+        # Outboxes created before attachments or rendered formats were supported lack the columns
+        columns = [row[1] for row in self.connection.execute(text("PRAGMA table_info(outbox)"))]
+        if "attachments" not in columns:
+            self.connection.execute(text("ALTER TABLE outbox ADD COLUMN attachments TEXT"))
+        if "subtype" not in columns:
+            self.connection.execute(text("ALTER TABLE outbox ADD COLUMN subtype TEXT"))
+
+    # Messages have the following format: {"subject" : "", "body" : "", "subtype" : "", "attachments" : [{"filename" : "", "content" : ""}]}
+    # The subtype is the MIME text subtype of the body ("plain" when missing); attachments are optional
+    def enqueue(self, sender, destination, messages, now):
+        if messages:
+            self.connection.execute(text(
+                "INSERT INTO outbox (sender, destination, subject, body, subtype, attachments, status, created, next_attempt) "
+                "VALUES (:sender, :destination, :subject, :body, :subtype, :attachments, :status, :created, :created)"),
+                [{
+                    "sender" : sender,
+                    "destination" : destination,
+                    "subject" : message["subject"],
+                    "body" : message["body"],
+                    "subtype" : message.get("subtype"),
+                    "attachments" : json.dumps(message["attachments"]) if message.get("attachments") else None,
+                    "status" : PENDING,
+                    "created" : now} for message in messages])
+
+    def get_due(self, now, limit):
+        result = self.connection.execute(text(
+            "SELECT id, sender, destination, subject, body, subtype, attachments, created, attempts FROM outbox "
+            "WHERE status = :status AND next_attempt <= :now ORDER BY next_attempt, id LIMIT :limit"), {"status" : PENDING, "now" : now, "limit" : limit})
+
+        messages = [dict(zip(("id", "sender", "destination", "subject", "body", "subtype", "attachments", "created", "attempts"), row)) for row in result]
+        for message in messages:
+            message["attachments"] = json.loads(message["attachments"]) if message["attachments"] else []
+            message["subtype"] = message["subtype"] or "plain"
+
+        return messages
+
+    def get_next_attempt(self):
+        return self.connection.execute(text("SELECT MIN(next_attempt) FROM outbox WHERE status = :status"), {"status" : PENDING}).scalar()
+
+    def count_pending(self):
+        return self.connection.execute(text("SELECT COUNT(*) FROM outbox WHERE status = :status"), {"status" : PENDING}).scalar()
+
+    def mark_sent(self, message_id, attempts, now):
+        self.connection.execute(text(
+            "UPDATE outbox SET status = :status, attempts = :attempts, delivered = :now, last_error = NULL WHERE id = :id"),
+            {"status" : SENT, "attempts" : attempts, "now" : now, "id" : message_id})
+
+    def mark_failed(self, message_id, attempts, next_attempt, error, give_up):
+        self.connection.execute(text(
+            "UPDATE outbox SET status = :status, attempts = :attempts, next_attempt = :next_attempt, last_error = :error WHERE id = :id"),
+            {"status" : FAILED if give_up else PENDING, "attempts" : attempts, "next_attempt" : next_attempt, "error" : error, "id" : message_id})
+
+    # Delivered mail is only kept for reporting delivery latency and retries
+    def purge_sent(self, before):
+        self.connection.execute(text("DELETE FROM outbox WHERE status = :status AND delivered < :before"), {"status" : SENT, "before" : before})
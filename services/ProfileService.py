@@ -0,0 +1,92 @@
+import threading
+import time
+
+# Phase timers for the --profile run report
+# Timing is off by default; timer() then hands out a shared do-nothing context manager so instrumented code pays one function call
+enabled = False
+samples = []
+labels = {}
+lock = threading.Lock()
+
+class Timer():
+    __slots__ = ("phase", "drive", "started")
+
+    def __init__(self, phase, drive):
+        self.phase = phase
+        self.drive = drive
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        record(self.phase, time.perf_counter() - self.started, self.drive)
+        return False
+
+class NullTimer():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        return False
+
+NULL_TIMER = NullTimer()
+
+def enable():
+    global enabled
+    enabled = True
+
+# Time the enclosed block as a phase, optionally attributed to a drive (or a device location, see set_label)
+def timer(phase, drive = None):
+    if not enabled:
+        return NULL_TIMER
+
+    return Timer(phase, drive)
+
+# Record a duration that was already measured
+def record(phase, seconds, drive = None):
+    if enabled:
+        with lock:
+            samples.append((phase, drive, seconds))
+
+# Samples recorded against a device location are reported under the names of the disks on it
+def set_label(key, label):
+    if enabled:
+        with lock:
+            labels[key] = label
+
+def __percentile(values, percent):
+    # Nearest rank on sorted values
+    return values[min(len(values) - 1, max(0, int(round(percent / 100.0 * len(values) + 0.5)) - 1))]
+
+def __format_table(title, first_column, rows):
+    table = "{}\n".format(title)
+    table += "    {:<32}{:<24}{:>8}{:>12}{:>12}{:>12}{:>12}\n".format(first_column, "PHASE", "COUNT", "TOTAL_S", "P50_MS", "P95_MS", "MAX_MS")
+
+    for key, phase, values in rows:
+        values = sorted(values)
+        table += "    {:<32}{:<24}{:>8}{:>12.3f}{:>12.2f}{:>12.2f}{:>12.2f}\n".format(
+            str(key)[:31], phase[:23], len(values), sum(values), __percentile(values, 50) * 1000, __percentile(values, 95) * 1000, values[-1] * 1000)
+
+    return table
+
+# Per-drive and aggregate tables of everything recorded so far
+def get_report():
+    with lock:
+        recorded = list(samples)
+        names = dict(labels)
+
+    phases = {}
+    drives = {}
+    for phase, drive, seconds in recorded:
+        phases.setdefault(phase, []).append(seconds)
+        if drive is not None:
+            drives.setdefault((names.get(drive, drive), phase), []).append(seconds)
+
+    report = __format_table("Per drive:", "DRIVE", [(drive, phase, values) for (drive, phase), values in sorted(drives.items())])
+    report += "\n"
+    report += __format_table("Aggregate:", "DRIVE", [("all", phase, values) for phase, values in sorted(phases.items(), key = lambda item: -sum(item[1]))])
+
+    return report
@@ -0,0 +1,202 @@
+import logging
+import html
+import json
+
+LOGGER = logging.getLogger()
+
+FORMAT_PLAIN = "plain"
+FORMAT_HTML = "html"
+FORMAT_JSON = "json"
+
+# Spaces between the columns of a plain text table
+COLUMN_GAP = 4
+
+# Alerts are rendered from the format queued by the drive monitor:
+# {"subject", "sections", "report", "severity", "name", "group", ...}
+# Sections are kept as data until a message is built; every section has a "title" and at most one of:
+# "columns" and "rows" (a table; columns may be None for a table without header), "items" (a list) or "fields" (a list of [label, value])
+# Reports are the smartctl output of a drive as {"information", "device_location", "mount_point", "output"}; every key is optional
+
+def get_renderer(name = FORMAT_PLAIN):
+    name = str(name or FORMAT_PLAIN).lower()
+
+    if name not in RENDERERS:
+        raise ValueError("Invalid email format: {}".format(name))
+
+    return RENDERERS[name]()
+
+# Add a renderer class to the registry; it is used for messages once email.format names it
+def register_renderer(name, renderer):
+    RENDERERS[str(name).lower()] = renderer
+
+# Text of a report as it is mailed; the serial number is replaced by the device location for safety
+def format_report(report):
+    if not report:
+        return None
+
+    formatted = ""
+    if report.get("information"):
+        for line in report["information"].split("\n"):
+            if "SERIAL NUMBER" in line.upper():
+                formatted += "Device Location:  {}\n".format(report.get("device_location"))
+                formatted += "Mount Location:   {}\n".format(report.get("mount_point"))
+            else:
+                formatted += line + "\n"
+
+    return formatted + (report.get("output") or "")
+
+# Renders sections as indented plain text; the widths of a table are computed once from all of its cells
+class PlainRenderer():
+    subtype = "plain"
+
+    def __render_table(self, section):
+        rows = [[str(cell) for cell in row] for row in section["rows"]]
+        if section["columns"]:
+            rows.insert(0, [str(column) for column in section["columns"]])
+        if not rows:
+            return ""
+
+        widths = [max(len(row[i]) for row in rows) + COLUMN_GAP for i in range(len(rows[0]))]
+
+        lines = []
+        for row in rows:
+            lines.append((" " * 4) + "".join(cell.ljust(width) for cell, width in zip(row[:-1], widths)) + row[-1])
+
+        return "\n".join(lines) + "\n"
+
+    def __render_fields(self, section):
+        width = max(len(str(label)) for label, _ in section["fields"]) + COLUMN_GAP
+
+        return "".join((" " * 4) + "{}:".format(label).ljust(width) + str(value) + "\n" for label, value in section["fields"])
+
+    def __render_section(self, section):
+        text = section["title"] + "\n"
+
+        if "rows" in section:
+            text += self.__render_table(section)
+        elif "items" in section:
+            text += "".join((" " * 4) + "~  {}\n".format(item) for item in section["items"])
+        elif "fields" in section:
+            text += self.__render_fields(section)
+        else:
+            return text + "\n"
+
+        return text + "\n\n"
+
+    def render_sections(self, sections):
+        return "".join(self.__render_section(section) for section in sections)
+
+    # An attachment is the filename the report is attached as; without one the report is appended inline
+    def render_alert(self, alert, attachment = None):
+        body = self.render_sections(alert["sections"])
+
+        if attachment:
+            body += "\nFull SMART report attached as {}\n".format(attachment)
+        elif alert.get("report"):
+            body += "\n{}\n".format("*" * 80)
+            body += format_report(alert["report"])
+
+        return body
+
+    # Attachments has one filename (or None) per alert
+    def render_digest(self, summary, alerts, attachments):
+        body = self.render_sections(summary)
+
+        for alert, attachment in zip(alerts, attachments):
+            body += "\n\n{}\n".format("*" * 80)
+            body += alert["subject"] + "\n\n"
+            body += self.render_alert(alert, attachment)
+
+        return body
+
+# Renders sections as HTML tables; reports are kept preformatted
+class HtmlRenderer():
+    subtype = "html"
+
+    def __render_section(self, section):
+        text = "<p>{}</p>\n".format(html.escape(section["title"]))
+
+        if "rows" in section:
+            text += "<table border=\"1\" cellpadding=\"4\" cellspacing=\"0\">\n"
+            if section["columns"]:
+                text += "<tr>" + "".join("<th>{}</th>".format(html.escape(str(column))) for column in section["columns"]) + "</tr>\n"
+            for row in section["rows"]:
+                text += "<tr>" + "".join("<td>{}</td>".format(html.escape(str(cell))) for cell in row) + "</tr>\n"
+            text += "</table>\n"
+        elif "items" in section:
+            text += "<ul>\n" + "".join("<li>{}</li>\n".format(html.escape(str(item))) for item in section["items"]) + "</ul>\n"
+        elif "fields" in section:
+            text += "<table cellpadding=\"4\" cellspacing=\"0\">\n"
+            text += "".join("<tr><th align=\"left\">{}</th><td>{}</td></tr>\n".format(html.escape(str(label)), html.escape(str(value))) for label, value in section["fields"])
+            text += "</table>\n"
+
+        return text
+
+    def __render_alert(self, alert, attachment):
+        body = "".join(self.__render_section(section) for section in alert["sections"])
+
+        if attachment:
+            body += "<p>Full SMART report attached as {}</p>\n".format(html.escape(attachment))
+        elif alert.get("report"):
+            body += "<hr>\n<pre>{}</pre>\n".format(html.escape(format_report(alert["report"])))
+
+        return body
+
+    def __wrap(self, content):
+        return "<html>\n<body>\n{}</body>\n</html>\n".format(content)
+
+    def render_alert(self, alert, attachment = None):
+        return self.__wrap(self.__render_alert(alert, attachment))
+
+    def render_digest(self, summary, alerts, attachments):
+        body = "".join(self.__render_section(section) for section in summary)
+
+        for alert, attachment in zip(alerts, attachments):
+            body += "<hr>\n<h3>{}</h3>\n".format(html.escape(alert["subject"]))
+            body += self.__render_alert(alert, attachment)
+
+        return self.__wrap(body)
+
+# Renders alerts as JSON documents so other tools can consume them without parsing text
+# Table rows become objects keyed by column name; reports are included inline even when a digest also attaches them
+class JsonRenderer():
+    subtype = "plain"
+
+    def __get_section(self, section):
+        document = {"title" : section["title"]}
+
+        if "rows" in section:
+            if section["columns"]:
+                document["rows"] = [dict(zip(section["columns"], row)) for row in section["rows"]]
+            else:
+                document["rows"] = [list(row) for row in section["rows"]]
+        elif "items" in section:
+            document["items"] = list(section["items"])
+        elif "fields" in section:
+            document["fields"] = {str(label) : value for label, value in section["fields"]}
+
+        return document
+
+    def __get_alert(self, alert, attachment):
+        return {
+            "subject" : alert["subject"],
+            "severity" : alert["severity"],
+            "uuid" : alert.get("uuid"),
+            "name" : alert["name"],
+            "group" : alert["group"],
+            "sections" : [self.__get_section(section) for section in alert["sections"]],
+            "attachment" : attachment,
+            "report" : format_report(alert.get("report"))}
+
+    def render_alert(self, alert, attachment = None):
+        return json.dumps(self.__get_alert(alert, attachment), indent = 2, default = str)
+
+    def render_digest(self, summary, alerts, attachments):
+        return json.dumps({
+            "summary" : [self.__get_section(section) for section in summary],
+            "alerts" : [self.__get_alert(alert, attachment) for alert, attachment in zip(alerts, attachments)]}, indent = 2, default = str)
+
+RENDERERS = {
+    FORMAT_PLAIN : PlainRenderer,
+    FORMAT_HTML : HtmlRenderer,
+    FORMAT_JSON : JsonRenderer}
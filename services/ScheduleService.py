@@ -0,0 +1,112 @@
+import logging
+import heapq
+import itertools
+
+LOGGER = logging.getLogger()
+
+# Health of a drive as judged by its last read; None means the drive could not be judged (new, standby, missing or timed out)
+HEALTH_FAILING = "failing"
+HEALTH_DEGRADING = "degrading"
+HEALTH_CHANGED = "changed"
+HEALTH_STATIC = "static"
+
+DEFAULT_BACKOFF = 2
+DEFAULT_WINDOW = 30
+
+def get_service(groups, adaptive = False, backoff = DEFAULT_BACKOFF, window = DEFAULT_WINDOW):
+    return ScheduleService(groups, adaptive, backoff, window)
+
+# Keeps the time at which every drive is next polled in a heap, so the next due drive is found in O(log n)
+# Groups have the format {GROUP : {"interval" : seconds, "floor" : seconds, "ceiling" : seconds}}
+# With adaptive polling a drive's interval follows its health within the floor and ceiling of its group:
+# failing drives are polled at the floor, degrading and changed drives move toward it and static drives back off toward the ceiling
+# Without it every drive is polled at the interval of its group
+class ScheduleService():
+    def __init__(self, groups, adaptive, backoff, window):
+        self.heap = []
+        self.entries = {}
+        self.drives = {}
+        self.sequence = itertools.count()
+        self.configure(groups, adaptive, backoff, window)
+
+    def configure(self, groups, adaptive = False, backoff = DEFAULT_BACKOFF, window = DEFAULT_WINDOW):
+        self.groups = groups
+        self.adaptive = adaptive
+        self.backoff = max(float(backoff), 1.0)
+        self.window = max(float(window), 0.0)
+
+    def __push(self, uuid, due):
+        # Replaced entries stay in the heap and are skipped once they reach the top
+        if uuid in self.entries:
+            self.entries[uuid][2] = None
+
+        entry = [due, next(self.sequence), uuid]
+        self.entries[uuid] = entry
+        heapq.heappush(self.heap, entry)
+
+    def __discard_removed(self):
+        while self.heap and self.heap[0][2] is None:
+            heapq.heappop(self.heap)
+
+    # Schedule the configured devices: new drives and those in added are due at now, drives no longer configured are dropped
+    def sync(self, devices, now, added = ()):
+        configured = {}
+        for device in devices:
+            configured[device["uuid"].lower()] = device["group"]
+
+        for uuid in list(self.drives):
+            if uuid not in configured:
+                del self.drives[uuid]
+                self.entries.pop(uuid)[2] = None
+
+        for uuid, group in configured.items():
+            if uuid not in self.drives or uuid in added:
+                self.drives[uuid] = {"group" : group, "interval" : self.groups[group]["interval"]}
+                self.__push(uuid, now)
+            else:
+                self.drives[uuid]["group"] = group
+
+        self.__discard_removed()
+
+    # Time at which the next drive is due; None when no drive is scheduled
+    def get_next(self):
+        self.__discard_removed()
+        return self.heap[0][0] if self.heap else None
+
+    # Remove and return every drive due by now
+    # Drives due within the batch window are included so drives with similar intervals keep being read in one run
+    # The window is at most a tenth of a drive's interval, so no drive is read much earlier than its schedule says
+    def pop_due(self, now):
+        due = []
+
+        self.__discard_removed()
+        while self.heap and self.heap[0][0] <= now + min(self.window, self.drives[self.heap[0][2]]["interval"] / 10):
+            uuid = heapq.heappop(self.heap)[2]
+            del self.entries[uuid]
+            due.append(uuid)
+            self.__discard_removed()
+
+        return due
+
+    def __get_interval(self, drive, health):
+        limits = self.groups[drive["group"]]
+
+        if not self.adaptive or health is None:
+            return limits["interval"]
+        if health == HEALTH_FAILING:
+            return limits["floor"]
+        if health in (HEALTH_DEGRADING, HEALTH_CHANGED):
+            return max(min(drive["interval"], limits["interval"]) / self.backoff, limits["floor"])
+
+        return min(max(drive["interval"], limits["interval"]) * self.backoff, limits["ceiling"])
+
+    # Schedule the next poll of a drive that was just read; returns the interval until then
+    def reschedule(self, uuid, health, now):
+        if uuid not in self.drives:
+            return None
+
+        drive = self.drives[uuid]
+        drive["interval"] = self.__get_interval(drive, health)
+        self.__push(uuid, now + drive["interval"])
+
+        return drive["interval"]
@@ -0,0 +1,52 @@
+import logging
+
+from sqlalchemy import text, bindparam
+
+LOGGER = logging.getLogger()
+
+SELECT_CHUNK_SIZE = 500
+
+RUNNING = "running"
+COMPLETED = "completed"
+REJECTED = "rejected"
+
+COLUMNS = ["uuid", "name", "test_type", "status", "result", "passed", "remaining_percent", "lifetime_hours", "started", "completed", "last_short", "last_long"]
+
+def get_service(connection):
+    return SelfTestService(connection)
+
+# Latest self-test of every drive, keyed by drive uuid like the drives table
+# last_short and last_long hold when each type of test was last started and decide when the next one is due
+class SelfTestService():
+    def __init__(self, connection):
+        self.connection = connection
+
+    def create_table(self):
+        self.connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS self_tests ("
+            "uuid TEXT PRIMARY KEY, name TEXT NOT NULL, test_type TEXT, status TEXT, result TEXT, passed INTEGER, remaining_percent INTEGER, "
+            "lifetime_hours INTEGER, started REAL, completed REAL, last_short REAL, last_long REAL)"))
+
+    # Return {uuid : {column : value}} for the given drives; drives that never ran a test are left out
+    def get_tests(self, uuids):
+        uuids = list(uuids)
+        statement = text("SELECT {} FROM self_tests WHERE uuid IN :uuids".format(", ".join(COLUMNS))).bindparams(bindparam("uuids", expanding = True))
+
+        tests = {}
+        for i in range(0, len(uuids), SELECT_CHUNK_SIZE):
+            for row in self.connection.execute(statement, {"uuids" : uuids[i:i + SELECT_CHUNK_SIZE]}):
+                tests[row[0]] = dict(zip(COLUMNS, row))
+
+        return tests
+
+    # Tests have the format returned by get_tests; every column is written
+    def save(self, tests):
+        if not tests:
+            return
+
+        self.connection.execute(text(
+            "INSERT INTO self_tests ({}) VALUES ({}) ON CONFLICT (uuid) DO UPDATE SET {}".format(
+                ", ".join(COLUMNS),
+                ", ".join(":" + column for column in COLUMNS),
+                ", ".join("{0} = excluded.{0}".format(column) for column in COLUMNS[1:]))),
+            [{column : test.get(column) for column in COLUMNS} for test in tests])
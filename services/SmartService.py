@@ -0,0 +1,308 @@
+import subprocess
+import asyncio
+import logging
+import json
+import time
+import re
+
+from services.MetricsService import get_histogram
+from services.ProfileService import record as record_phase
+
+LOGGER = logging.getLogger()
+
+WHEN_FAILED = {"now" : "FAILING_NOW", "past" : "In_the_past"}
+IDENTITY_LABELS = {"DEVICE MODEL" : "model", "SERIAL NUMBER" : "serial", "FIRMWARE VERSION" : "firmware"}
+LOW_POWER_MODES = ("IS IN STANDBY MODE", "IS IN SLEEP MODE")
+DATA_SECTION = "=== START OF READ SMART DATA SECTION ==="
+
+SELF_TEST_TYPES = ("short", "long")
+SELF_TEST_STARTED = ("TESTING HAS BEGUN", "TEST WILL COMPLETE")
+SELF_TEST_BUSY = "WITHOUT ABORTING CURRENT TEST"
+SELF_TEST_FAILURES = ("FAILURE", "FATAL")
+SELF_TEST_REMAINING = re.compile(r"(\d+)% of test remaining")
+SELF_TEST_ROW = re.compile(r"^#\s*\d+\s+(.+?)\s{2,}(.+?)\s{2,}(\d+)%\s+(\d+|-)")
+
+SMARTCTL_SECONDS = get_histogram("smart_monitor_smartctl_seconds", "Time taken by a single smartctl call")
+
+# Cleared once smartctl rejects the --json option so older builds are not asked again
+json_supported = True
+
+def get_service(timeout = None):
+    return SmartService(timeout)
+
+# Raised when a device was left alone because it is spun down
+class DeviceStandby(Exception):
+    pass
+
+class SmartService():
+    def __init__(self, timeout = None):
+        # Seconds a single smartctl call may take before it is killed; None waits forever
+        self.timeout = timeout
+
+    def __execute(self, arguments):
+        started = time.monotonic()
+        process = subprocess.Popen(
+            ["smartctl"] + arguments,
+            stdout=subprocess.PIPE,
+            stderr = subprocess.PIPE)
+
+        try:
+            output, error = process.communicate(timeout = self.timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise
+        finally:
+            SMARTCTL_SECONDS.observe(time.monotonic() - started)
+            record_phase("smartctl", time.monotonic() - started, arguments[-1])
+
+        return output.decode()
+
+    async def __execute_async(self, arguments):
+        started = time.monotonic()
+        process = await asyncio.create_subprocess_exec(
+            "smartctl", *arguments,
+            stdout = asyncio.subprocess.PIPE,
+            stderr = asyncio.subprocess.PIPE)
+
+        try:
+            output, error = await asyncio.wait_for(process.communicate(), self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            process.kill()
+            await process.wait()
+            raise
+        finally:
+            SMARTCTL_SECONDS.observe(time.monotonic() - started)
+            record_phase("smartctl", time.monotonic() - started, arguments[-1])
+
+        return output.decode()
+
+    def __get_arguments(self, arguments, standby):
+        # With -n standby smartctl checks the power mode first and exits without waking a spun down device
+        return (["-n", "standby"] if standby else []) + arguments
+
+    def __check_standby(self, output, device_location):
+        if any(mode in output.upper() for mode in LOW_POWER_MODES):
+            raise DeviceStandby(device_location)
+
+    def __strip_banner(self, output):
+        # Remove the version and copyright lines printed at the top of every smartctl output
+        lines = output.split("\n", 2)
+        return lines[2] if len(lines) > 2 else ""
+
+    def __format_information(self, data):
+        information = "=== START OF INFORMATION SECTION ===\n"
+
+        fields = [
+            ("Model Family", data.get("model_family")),
+            ("Device Model", data.get("model_name")),
+            ("Serial Number", data.get("serial_number")),
+            ("Firmware Version", data.get("firmware_version")),
+            ("User Capacity", "{:,} bytes".format(data["user_capacity"]["bytes"]) if "user_capacity" in data else None),
+            ("Rotation Rate", "{} rpm".format(data["rotation_rate"]) if data.get("rotation_rate") else None)]
+
+        for label, value in fields:
+            if value is not None:
+                information += "{}{}\n".format((label + ":").ljust(18), value)
+
+        if "smart_status" in data:
+            information += "SMART overall-health self-assessment test result: {}\n".format("PASSED" if data["smart_status"].get("passed") else "FAILED!")
+
+        return information + "\n"
+
+    def __format_report(self, data):
+        report = DATA_SECTION + "\n"
+        report += "Vendor Specific SMART Attributes with Thresholds:\n"
+        report += "ID# ATTRIBUTE_NAME          FLAG     VALUE WORST THRESH TYPE      UPDATED  WHEN_FAILED RAW_VALUE\n"
+
+        for row in data.get("ata_smart_attributes", {}).get("table", []):
+            flags = row.get("flags", {})
+            report += "{:>3} {:<23} 0x{:04x}   {:03d}   {:03d}   {:03d}    {:<9} {:<8} {:>12}    {}\n".format(
+                row["id"],
+                row["name"],
+                flags.get("value", 0),
+                row.get("value", 0),
+                row.get("worst", 0),
+                row.get("thresh", 0),
+                "Pre-fail" if flags.get("prefailure") else "Old_age",
+                "Always" if flags.get("updated_online") else "Offline",
+                WHEN_FAILED.get(row.get("when_failed"), "-"),
+                row.get("raw", {}).get("string", row.get("raw", {}).get("value", "")))
+
+        return report
+
+    def __parse_json(self, output):
+        data = json.loads(output)
+
+        attributes = []
+        for row in data.get("ata_smart_attributes", {}).get("table", []):
+            attributes.append({
+                "id" : row["id"],
+                "name" : row["name"].lower(),
+                "when_failed" : WHEN_FAILED.get(row.get("when_failed"), "-"),
+                "raw_value" : int(row.get("raw", {}).get("value", 0))})
+
+        health = None
+        if "smart_status" in data:
+            health = "PASSED" if data["smart_status"].get("passed") else "FAILED"
+
+        return {
+            "identity" : {
+                "model" : data.get("model_name"),
+                "serial" : data.get("serial_number"),
+                "firmware" : data.get("firmware_version")},
+            "health" : health,
+            "attributes" : attributes,
+            "information" : self.__format_information(data),
+            "report" : self.__format_report(data)}
+
+    def __build_text_report(self, information, report):
+        identity = {}
+        for line in information.split("\n"):
+            label, separator, value = line.partition(":")
+            if separator and label.strip().upper() in IDENTITY_LABELS:
+                identity[IDENTITY_LABELS[label.strip().upper()]] = value.strip()
+
+        # Attributes are left for the caller's column based parser
+        return {
+            "identity" : identity,
+            "health" : None,
+            "attributes" : None,
+            "information" : self.__strip_banner(information),
+            "report" : self.__strip_banner(report)}
+
+    def __handle_json_failure(self, output, device_location):
+        global json_supported
+
+        if "UNRECOGNIZED OPTION" in output.upper():
+            LOGGER.warning("Smart -> Installed smartctl does not support --json; falling back to text reports")
+            json_supported = False
+        else:
+            LOGGER.warning("Smart -> Unable to parse JSON report for %s; falling back to text reports", device_location)
+
+    # Build a report from output captured elsewhere: a "smartctl -i -A" text dump or "smartctl --json" output
+    # Text attributes are left for the caller's column based parser, as with get_report
+    def parse_capture(self, output):
+        if output.lstrip().startswith("{"):
+            return self.__parse_json(output)
+
+        information, separator, report = output.partition(DATA_SECTION)
+        smart_report = self.__build_text_report(information, "")
+        smart_report["report"] = separator + report
+
+        return smart_report
+
+    def __parse_self_test_json(self, output):
+        data = json.loads(output)
+        status = data.get("ata_smart_data", {}).get("self_test", {}).get("status", {})
+
+        log = []
+        for row in data.get("ata_smart_self_test_log", {}).get("standard", {}).get("table", []):
+            result = row.get("status", {})
+            log.append({
+                "type" : row.get("type", {}).get("string"),
+                "status" : result.get("string"),
+                "passed" : result.get("passed", not any(failure in str(result.get("string")).upper() for failure in SELF_TEST_FAILURES)),
+                "remaining_percent" : int(result.get("remaining_percent", 0)),
+                "lifetime_hours" : row.get("lifetime_hours")})
+
+        # The upper four bits of the execution status are 15 while a self-test is running
+        return {
+            "running" : (int(status.get("value", 0)) >> 4) == 15,
+            "remaining_percent" : status.get("remaining_percent"),
+            "log" : log}
+
+    def __parse_self_test_text(self, output):
+        remaining = SELF_TEST_REMAINING.search(output)
+
+        log = []
+        for line in output.split("\n"):
+            row = SELF_TEST_ROW.match(line.strip())
+            if row:
+                log.append({
+                    "type" : row.group(1),
+                    "status" : row.group(2),
+                    "passed" : not any(failure in row.group(2).upper() for failure in SELF_TEST_FAILURES),
+                    "remaining_percent" : int(row.group(3)),
+                    "lifetime_hours" : int(row.group(4)) if row.group(4).isdigit() else None})
+
+        return {
+            "running" : "SELF-TEST ROUTINE IN PROGRESS" in output.upper(),
+            "remaining_percent" : int(remaining.group(1)) if remaining else None,
+            "log" : log}
+
+    def __format_self_test_log(self, log):
+        output = "SMART Self-test log\n"
+        output += "{:<4} {:<19} {:<29} {:>4}  {}\n".format("Num", "Test_Description", "Status", "Remaining", "LifeTime(hours)")
+
+        for number, row in enumerate(log, 1):
+            output += "# {:<2} {:<19} {:<29} {:>8}%  {}\n".format(number, row["type"], row["status"], row["remaining_percent"], row["lifetime_hours"] if row["lifetime_hours"] is not None else "-")
+
+        return output
+
+    # Start a short or long self-test; the test runs in the drive's firmware and smartctl returns right away
+    # Returns True when the test was started and False when another self-test is already running
+    def start_self_test(self, device_location, test_type):
+        if test_type not in SELF_TEST_TYPES:
+            raise ValueError("Invalid self-test type: {}".format(test_type))
+
+        output = self.__execute(["-t", test_type, device_location])
+        if any(started in output.upper() for started in SELF_TEST_STARTED):
+            return True
+        if SELF_TEST_BUSY in output.upper():
+            return False
+
+        raise RuntimeError("smartctl did not start a {} self-test: {}".format(test_type, self.__strip_banner(output).strip() or "no output"))
+
+    # Progress of the running self-test and the self-test log, newest entry first
+    # Returns {"running" : bool, "remaining_percent" : int or None, "log" : [{"type", "status", "passed", "remaining_percent", "lifetime_hours"}], "output" : text}
+    def get_self_test_status(self, device_location):
+        if json_supported:
+            output = self.__execute(["-c", "-l", "selftest", "--json", device_location])
+
+            try:
+                status = self.__parse_self_test_json(output)
+                status["output"] = self.__format_self_test_log(status["log"])
+                return status
+            except (ValueError, KeyError, TypeError):
+                self.__handle_json_failure(output, device_location)
+
+        output = self.__execute(["-c", "-l", "selftest", device_location])
+        status = self.__parse_self_test_text(output)
+        status["output"] = self.__strip_banner(output)
+
+        return status
+
+    # Collect identity, health and attributes of a device with a single smartctl call when possible
+    # With standby set, a spun down device is not woken up and DeviceStandby is raised instead
+    def get_report(self, device_location, standby = False):
+        if json_supported:
+            output = self.__execute(self.__get_arguments(["-i", "-A", "-H", "--json", device_location], standby))
+            self.__check_standby(output, device_location)
+
+            try:
+                return self.__parse_json(output)
+            except (ValueError, KeyError, TypeError):
+                self.__handle_json_failure(output, device_location)
+
+        information = self.__execute(self.__get_arguments(["-i", device_location], standby))
+        self.__check_standby(information, device_location)
+
+        return self.__build_text_report(information, self.__execute(["-A", device_location]))
+
+    # Same as get_report, but runs smartctl as an asyncio subprocess
+    async def get_report_async(self, device_location, standby = False):
+        if json_supported:
+            output = await self.__execute_async(self.__get_arguments(["-i", "-A", "-H", "--json", device_location], standby))
+            self.__check_standby(output, device_location)
+
+            try:
+                return self.__parse_json(output)
+            except (ValueError, KeyError, TypeError):
+                self.__handle_json_failure(output, device_location)
+
+        information = await self.__execute_async(self.__get_arguments(["-i", device_location], standby))
+        self.__check_standby(information, device_location)
+        report = await self.__execute_async(["-A", device_location])
+
+        return self.__build_text_report(information, report)
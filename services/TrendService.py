@@ -0,0 +1,223 @@
+import logging
+import hashlib
+import itertools
+
+from sqlalchemy import text, bindparam
+
+# NumPy is optional; without it the trend analysis is disabled
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+LOGGER = logging.getLogger()
+
+DAY = 86400
+SEVERITY_PREDICTED = "PREDICTED"
+
+PROJECTION = "projection"
+OUTLIER = "outlier"
+
+def is_available():
+    return numpy is not None
+
+def get_service(connection):
+    return TrendService(connection)
+
+# Fleet wide analysis of the attribute history
+# Loads the history of every drive into arrays once and computes growth rates, time to threshold and
+# outliers among drives of the same model in vectorized passes instead of looping over drives
+class TrendService():
+    def __init__(self, connection):
+        if numpy is None:
+            raise RuntimeError("Trend analysis requires NumPy")
+
+        self.connection = connection
+
+    def __load(self, names, start):
+        names = list(names)
+
+        drives = self.connection.execute(text("SELECT id, uuid, model FROM drives")).fetchall()
+        attributes = self.connection.execute(text("SELECT id, name FROM attributes WHERE name IN :names").bindparams(bindparam("names", expanding = True)), {"names" : names}).fetchall()
+
+        # Current value of every series
+        latest = self.connection.execute(text(
+            "SELECT drive_id, attribute_id, timestamp, raw_value FROM attribute_latest WHERE attribute_id IN :ids").bindparams(bindparam("ids", expanding = True)),
+            {"ids" : [row[0] for row in attributes]}).fetchall() if attributes else []
+
+        # Earliest value of every series inside the window from each resolution; rolled up buckets contribute their lowest value
+        # SQLite returns the other columns of the row holding MIN(timestamp), so only one row per series and table is read
+        window = self.connection.execute(text(
+            "SELECT drive_id, attribute_id, MIN(timestamp), min_value FROM attribute_history_daily WHERE timestamp >= :start AND attribute_id IN :ids GROUP BY drive_id, attribute_id "
+            "UNION ALL "
+            "SELECT drive_id, attribute_id, MIN(timestamp), min_value FROM attribute_history_hourly WHERE timestamp >= :start AND attribute_id IN :ids GROUP BY drive_id, attribute_id "
+            "UNION ALL "
+            "SELECT drive_id, attribute_id, MIN(timestamp), raw_value FROM attribute_history WHERE timestamp >= :start AND attribute_id IN :ids GROUP BY drive_id, attribute_id").bindparams(
+                bindparam("ids", expanding = True)),
+            {"start" : int(start), "ids" : [row[0] for row in attributes]}).fetchall() if attributes else []
+
+        return drives, attributes, latest, window
+
+    def __to_arrays(self, rows):
+        if not rows:
+            return [numpy.zeros(0, dtype = numpy.int64) for i in range(4)]
+
+        # Rows are flattened first; handing result rows to numpy.array directly makes it probe every row for keys
+        table = numpy.fromiter(itertools.chain.from_iterable(rows), dtype = numpy.int64, count = len(rows) * 4).reshape(-1, 4)
+        return [table[:, i] for i in range(4)]
+
+    def __build_lookup(self, ids):
+        lookup = numpy.full(max(ids, default = 0) + 1, -1, dtype = numpy.int64)
+        lookup[ids] = numpy.arange(len(ids))
+
+        return lookup
+
+    def __get_keys(self, drive_lookup, attribute_lookup, drive_ids, attribute_ids, attribute_count):
+        # One key per (drive, attribute) series; ids outside the lookup tables give a negative key
+        drives = numpy.where(drive_ids < len(drive_lookup), drive_lookup[numpy.minimum(drive_ids, len(drive_lookup) - 1)], -1)
+        attributes = attribute_lookup[attribute_ids]
+
+        return numpy.where((drives >= 0) & (attributes >= 0), drives * attribute_count + attributes, -1)
+
+    def __group_medians(self, groups, values, count):
+        # Median of values per group id: sort by group then value and pick the middle of every run
+        order = numpy.lexsort((values, groups))
+        sorted_values = values[order]
+        sizes = numpy.bincount(groups, minlength = count)
+        starts = numpy.concatenate(([0], numpy.cumsum(sizes)[:-1]))
+        present = sizes > 0
+
+        medians = numpy.zeros(count)
+        medians[present] = (sorted_values[(starts + (sizes - 1) // 2)[present]] + sorted_values[(starts + sizes // 2)[present]]) / 2.0
+
+        return medians, sizes
+
+    # Analyze the history of the given attributes for the whole fleet
+    # Thresholds are {attribute : threshold}; settings are {"window_days", "horizon_days", "outlier_z", "min_peers"}
+    # Returns findings with the format {"uuid", "model", "attribute", "kind", "value", "rate", "days", "median"}
+    def analyze(self, thresholds, settings, now):
+        drives, attributes, latest, window = self.__load(thresholds.keys(), now - settings["window_days"] * DAY)
+        if not latest:
+            return []
+
+        uuids = [row[1] for row in drives]
+        names = [row[1] for row in attributes]
+        attribute_count = len(attributes)
+
+        # Models are numbered so drives of the same model share a group id; drives without a known model have no peers
+        model_index = {}
+        drive_models = numpy.array([model_index.setdefault(row[2] or "", len(model_index)) for row in drives], dtype = numpy.int64)
+        models = list(model_index)
+        known_models = numpy.array([model != "" for model in models], dtype = bool)
+
+        # Database ids are mapped to array positions through lookup tables; unknown ids map to -1
+        drive_lookup = self.__build_lookup([row[0] for row in drives])
+        attribute_lookup = self.__build_lookup([row[0] for row in attributes])
+
+        drive_ids, attribute_ids, latest_times, latest_values = self.__to_arrays(latest)
+        keys = self.__get_keys(drive_lookup, attribute_lookup, drive_ids, attribute_ids, attribute_count)
+        valid = keys >= 0
+        keys, latest_times, latest_values = keys[valid], latest_times[valid], latest_values[valid].astype(numpy.float64)
+
+        order = numpy.argsort(keys)
+        keys, latest_times, latest_values = keys[order], latest_times[order], latest_values[order]
+
+        # First value of every series inside the window; series without one did not change
+        first_times = latest_times.copy()
+        first_values = latest_values.copy()
+
+        window_drives, window_attributes, window_times, window_values = self.__to_arrays(window)
+        if len(window_times) and len(keys):
+            window_keys = self.__get_keys(drive_lookup, attribute_lookup, window_drives, window_attributes, attribute_count)
+            order = numpy.lexsort((window_times, window_keys))
+            window_keys, window_times, window_values = window_keys[order], window_times[order], window_values[order]
+
+            first = numpy.concatenate(([True], window_keys[1:] != window_keys[:-1]))
+            first_keys = window_keys[first]
+            positions = numpy.minimum(numpy.searchsorted(keys, first_keys), len(keys) - 1)
+            matched = keys[positions] == first_keys
+
+            first_times[positions[matched]] = window_times[first][matched]
+            first_values[positions[matched]] = window_values[first][matched]
+
+        series_drives = keys // attribute_count
+        series_attributes = keys % attribute_count
+
+        # Growth per day over the window
+        elapsed = numpy.maximum((now - first_times) / DAY, 1.0)
+        rates = (latest_values - first_values) / elapsed
+
+        # Days until the threshold is crossed at the current rate; values already above it are handled by the regular checks
+        limits = numpy.array([float(thresholds[name]) for name in names])[series_attributes]
+        growing = (rates > 0) & (latest_values <= limits)
+        days = numpy.full(len(keys), numpy.inf)
+        days[growing] = (limits[growing] - latest_values[growing]) / rates[growing]
+        projected = days <= settings["horizon_days"]
+
+        # Robust z-score of every value among drives of the same model and attribute
+        groups = drive_models[series_drives] * attribute_count + series_attributes
+        group_count = len(models) * attribute_count
+        medians, sizes = self.__group_medians(groups, latest_values, group_count)
+        deviations, sizes = self.__group_medians(groups, numpy.abs(latest_values - medians[groups]), group_count)
+        scores = 0.6745 * (latest_values - medians[groups]) / numpy.maximum(deviations[groups], 1.0)
+        outliers = (scores > settings["outlier_z"]) & (sizes[groups] >= settings["min_peers"]) & known_models[drive_models[series_drives]]
+
+        findings = []
+        for kind, flagged in ((PROJECTION, projected), (OUTLIER, outliers)):
+            for i in numpy.nonzero(flagged)[0].tolist():
+                findings.append({
+                    "uuid" : uuids[series_drives[i]],
+                    "model" : models[drive_models[series_drives[i]]],
+                    "attribute" : names[series_attributes[i]],
+                    "kind" : kind,
+                    "value" : int(latest_values[i]),
+                    "rate" : float(rates[i]),
+                    "days" : float(days[i]),
+                    "median" : float(medians[groups[i]])})
+
+        return findings
+
+    # Turn findings of the given devices into alerts for the message queue; one alert per drive
+    # Devices have the format of the disks configuration ({"uuid", "name", "group"})
+    def get_alerts(self, findings, devices):
+        by_uuid = {}
+        for finding in findings:
+            by_uuid.setdefault(finding["uuid"], []).append(finding)
+
+        alerts = []
+        for device in devices:
+            uuid = device["uuid"].lower()
+            if uuid not in by_uuid:
+                continue
+
+            drive_findings = sorted(by_uuid[uuid], key = lambda finding: (finding["kind"], finding["attribute"]))
+            sections = []
+
+            projections = [finding for finding in drive_findings if finding["kind"] == PROJECTION]
+            if projections:
+                sections.append({
+                    "title" : "At their current rate of growth, the following attributes are expected to exceed their configured threshold soon:",
+                    "columns" : ["ATTRIBUTE_NAME", "CURRENT_VALUE", "GROWTH_PER_DAY", "DAYS_LEFT"],
+                    "rows" : [[finding["attribute"], finding["value"], "{:.2f}".format(finding["rate"]), "{:.0f}".format(finding["days"])] for finding in projections]})
+
+            outliers = [finding for finding in drive_findings if finding["kind"] == OUTLIER]
+            if outliers:
+                sections.append({
+                    "title" : "The following attributes are well above those of other drives of the same model ({}):".format(outliers[0]["model"]),
+                    "columns" : ["ATTRIBUTE_NAME", "CURRENT_VALUE", "MODEL_MEDIAN"],
+                    "rows" : [[finding["attribute"], finding["value"], "{:g}".format(finding["median"])] for finding in outliers]})
+
+            # The condition is identified by what was flagged, not by the exact values, so it is mailed once while it lasts
+            fingerprint = hashlib.sha1("|".join([uuid, "trend"] + ["{}:{}".format(finding["kind"], finding["attribute"]) for finding in drive_findings]).encode()).hexdigest()
+
+            alerts.append({
+                "subject" : "PREDICTED! SMART Monitor Trend Report: {}".format(device["name"]),
+                "sections" : sections,
+                "report" : None,
+                "severity" : SEVERITY_PREDICTED,
+                "fingerprint" : fingerprint,
+                "uuid" : uuid,
+                "name" : device["name"],
+                "group" : device["group"]})
+
+        return alerts
@@ -3,67 +3,121 @@ import logging
 import logging.handlers
 import traceback
 import sys
+import time
+import signal
+import argparse
 import threading
+import cProfile
+import atexit
 
-from queue import Queue
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
 from distutils.util import strtobool
-from services.DriveService import get_service as get_drive_service
+from services.DriveService import get_service as get_drive_service, STATE_COLUMNS
 from services.MailService import get_service as get_mail_service
+from services.HistoryService import get_service as get_history_service
+from services.OutboxService import get_service as get_outbox_service
+from services.AlertService import get_service as get_alert_service
+from services.DigestService import get_service as get_digest_service
+from services.DiscoveryService import get_service as get_discovery_service
+from services.IngestService import get_service as get_ingest_service
+from services.CollectorService import get_service as get_collector_service
+from services.ConfigService import get_service as get_config_service, get_diff as get_config_diff
+from services.SelfTestService import get_service as get_self_test_service
+from services.EventBus import get_bus as get_event_bus, get_priority as get_alert_priority
+from services.ScheduleService import get_service as get_schedule_service, DEFAULT_BACKOFF, DEFAULT_WINDOW
+from services.TrendService import get_service as get_trend_service, is_available as is_trend_available
+from services.AttributeParser import get_parser as get_attribute_parser
+from services.LoggingService import get_formatter as get_log_formatter, get_handler as get_log_handler, get_listener as get_log_listener
+from services.ProfileService import timer as phase_timer, set_label as set_phase_label, enable as enable_profile, get_report as get_profile_report
 from threads.DriveThread import get_thread as get_drive_thread
+from threads.DriveMonitor import get_monitor as get_drive_monitor, STATUS_STANDBY
+from threads.WorkerPool import get_pool as get_worker_pool
+from threads.AsyncEngine import get_engine as get_async_engine
+from threads.WriterThread import get_writer as get_database_writer
+from threads.MailThread import get_thread as get_mail_thread
+from threads.MetricsThread import get_thread as get_metrics_thread
+from threads.AggregatorThread import get_thread as get_aggregator_thread
+from threads.SelfTestThread import get_thread as get_self_test_thread
+from threads.CollectorMonitor import get_monitor as get_collector_monitor, STATUS_MISSING
 
 LOGGER = logging.getLogger()
 CONFIG_FILENAME = b"config.yml"
 DATABASE_FILENAME = b"sqlite:///database.db"
+DEFAULT_WORKERS = 4
+DEFAULT_INTERVAL = 3600
+RETENTION_INTERVAL = 3600
+DEFAULT_STANDBY_MAX_AGE = 86400
+DEFAULT_RELOAD_INTERVAL = 10
+DEFAULT_MAX_PENDING_ALERTS = 10000
 
 config = None
+config_filename = None
 
 # Set global config variable
-def __load_config():
-    global config
-    config = yaml.load(open(CONFIG_FILENAME.decode()))
+def __load_config(filename):
+    global config, config_filename
+    config_filename = filename
+    with open(filename) as config_file:
+        config = yaml.safe_load(config_file)
 
 # Set global logging
+# Records are queued by the calling thread and written by a background listener, so slow console or file I/O never blocks workers
 def __setup_logger():
     # Add custom debug level
     logging.FINE_DEBUG = 5
     logging.addLevelName(logging.FINE_DEBUG, "FINE_DEBUG")
 
-    # Set logging format
-    log_format = logging.Formatter("%(asctime)s [%(levelname)-6.6s] %(message)s")
-    if config["logging"]["format"]:
-        log_format = logging.Formatter(config["logging"]["format"])
+    # Set logging format; "json" writes one JSON object per line with drive and phase fields
+    log_format = get_log_formatter(config["logging"].get("format"))
 
     # Create console logger
     console_logger = logging.StreamHandler(sys.stdout)
     console_logger.setFormatter(log_format)
-    
-    # Add console logger to root logger
-    root_logger = logging.getLogger()
-    level = logging.getLevelName(config["logging"]["level"].upper())
-    root_logger.setLevel(level)
-    root_logger.addHandler(console_logger)
+    handlers = [console_logger]
 
-    # If file logger is specified in configuration, add file logger to root logger
+    # If file logger is specified in configuration, add file logger; a maxsize of 0 disables rotation
     if config["logging"]["file"]:
-        max_log_size = min(config["logging"]["maxsize"], 0) * 1024
+        max_log_size = max(int(config["logging"].get("maxsize") or 0), 0) * 1024
         file_logger = logging.handlers.RotatingFileHandler(
             config["logging"]["file"],
             maxBytes = max_log_size,
             backupCount = 9)
         file_logger.setFormatter(log_format)
-        root_logger.addHandler(file_logger)
+        handlers.append(file_logger)
+
+    # Add queue handler to root logger; the listener is stopped at exit after writing every queued record
+    queue_logger = get_log_handler()
+    root_logger = logging.getLogger()
+    level = logging.getLevelName(config["logging"]["level"].upper())
+    root_logger.setLevel(level)
+    root_logger.addHandler(queue_logger)
+    atexit.register(get_log_listener(queue_logger.queue, handlers).stop)
 
 def __to_bool(value):
     return value if isinstance(value, bool) else strtobool(value)
 
+def __parse_arguments():
+    parser = argparse.ArgumentParser(description = "Monitor SMART attributes of configured disks")
+    parser.add_argument("--config", default = CONFIG_FILENAME.decode(), help = "path of the configuration file (default: %(default)s)")
+    parser.add_argument("--daemon", action = "store_true", help = "keep running and poll each disk group on its configured interval")
+    parser.add_argument("--collect", action = "store_true", help = "only probe disks and push their attributes to the aggregator; combine with --daemon to keep running")
+    parser.add_argument("--aggregate", action = "store_true", help = "receive attributes pushed by collectors and own the database, history and alerting")
+    parser.add_argument("--ingest", metavar = "PATH", help = "process smartctl outputs captured on other hosts from a directory or tarball instead of probing local disks")
+    parser.add_argument("--profile", action = "store_true", help = "time every phase of the run and print a per-drive and aggregate report on exit")
+    parser.add_argument("--profile-output", metavar = "FILE", help = "with --profile, also write a cProfile dump of the main thread to FILE")
+
+    return parser.parse_args()
+
 # Main
 def main():
+    arguments = __parse_arguments()
+
     # Load configuration file
     try:
-        __load_config()
+        __load_config(arguments.config)
     except:
-        print("Unexpected exception while loading configuration: {}".format(CONFIG_FILENAME.decode()))
+        print("Unexpected exception while loading configuration: {}".format(arguments.config))
         print(traceback.format_exc())
         sys.exit(2)
 
@@ -83,14 +137,45 @@ def main():
 #       print(traceback.format_exc())
 #       sys.exit(2)
 
+    # Phase timers stay disabled unless a profile is requested
+    profile = None
+    if arguments.profile:
+        enable_profile()
+        if arguments.profile_output:
+            profile = cProfile.Profile()
+            profile.enable()
+
     # Run script logic
     try:
-        __run()
+        if arguments.ingest:
+            __run_ingest(arguments.ingest)
+        elif arguments.aggregate:
+            __run_aggregator()
+        elif arguments.collect:
+            __run_collector(arguments.daemon)
+        elif arguments.daemon:
+            __run_daemon()
+        else:
+            __run()
     except Exception:
         LOGGER.exception("Unexpected exception caused failure to properly run")
+    finally:
+        if arguments.profile:
+            __write_profile(profile, arguments.profile_output)
+
+def __write_profile(profile, filename):
+    if profile is not None:
+        profile.disable()
+        profile.dump_stats(filename)
+        print("cProfile dump written to {}".format(filename))
+
+    print(get_profile_report())
+
+def __get_attribute_names():
+    return list(set().union(*(d.keys() for d in config["smart"].get("attributes"))))
 
 def __validate_database(database):
-    with database.connect() as connection:
+    with phase_timer("validate_database"), database.begin() as connection:
         drive_service = get_drive_service(connection)
 
         # Make sure table exists
@@ -105,68 +190,890 @@ def __validate_database(database):
             for column in columns:
                 column_names.append(column["name"])
 
-            config_names = set().union(*(d.keys() for d in config["smart"].get("attributes")))
+            config_names = set(__get_attribute_names())
             missing = list(config_names.difference(set(column_names)))
 
             for column in missing:
                 drive_service.add_table_column(column)
 
-        connection.close()
+            # Databases created by older versions do not track when a drive was last read
+            for column in STATE_COLUMNS:
+                if column not in column_names:
+                    drive_service.add_state_column(column)
 
-def __get_queue_size():
-    queue_size = 0
+        # Databases created by older versions have no unique index on uuid
+        if not drive_service.has_uuid_index():
+            LOGGER.info("Main -> Adding unique uuid index to drives table...")
+            drive_service.create_uuid_index()
 
-    for group in config["disks"]:
-        queue_size += len(config["disks"][group])
+        # Make sure attribute history tables exist
+        if __get_history_config()["enabled"]:
+            get_history_service(connection).create_tables()
 
-    return queue_size
+        # Make sure mail outbox and record of sent alerts exist
+        get_outbox_service(connection).create_table()
+        get_alert_service(connection).create_table()
 
-def __run():
-    # Loop through configurations and spawn thread for each listed disk
-    messages = []
-    threads = []
+        # Make sure record of self-tests exists
+        if __get_self_test_config()["enabled"]:
+            get_self_test_service(connection).create_table()
 
-    lock = threading.Lock()
-    engine = create_engine(DATABASE_FILENAME.decode())
-    message_queue = Queue(maxsize = __get_queue_size())
+# Add columns for attributes added to a running configuration without reflecting the rest of the schema
+def __migrate_columns(database, names):
+    with database.begin() as connection:
+        drive_service = get_drive_service(connection)
+        column_names = set(column["name"] for column in database.dialect.get_columns(connection, "drives"))
 
-    # Ensure that database has been created properly
-    __validate_database(engine)
+        for column in names:
+            if column not in column_names:
+                LOGGER.info("Main -> Adding column for attribute %s to drives table...", column)
+                drive_service.add_table_column(column)
 
-    # Process configured disks
-    LOGGER.debug("Main -> Spawning threads to process disks in configuration file...")
+def __load_drives(database, devices, state):
+    # Read stored attributes of every drive that is not known yet with a single query
+    uuids = [device["uuid"].lower() for device in devices if device["uuid"].lower() not in state]
+
+    if uuids:
+        with phase_timer("load_state"), database.connect() as connection:
+            state.update(get_drive_service(connection).get_drives(uuids, __get_attribute_names() + ["last_seen", "report_digest", "health"]))
+
+def __get_history_config():
+    history = config.get("history") or {}
+
+    return {
+        "enabled" : __to_bool(history.get("enabled", True)),
+        "raw_days" : int(history.get("raw_days") or 0),
+        "hourly_days" : int(history.get("hourly_days") or 0),
+        "daily_days" : int(history.get("daily_days") or 0)}
+
+def __apply_history_retention(writer):
+    history = __get_history_config()
+
+    # Retention runs on the writer thread so it never competes with other writes
+    if history["enabled"]:
+        writer.put(lambda connection: get_history_service(connection).apply_retention(
+            time.time(), history["raw_days"], history["hourly_days"], history["daily_days"]))
+        writer.flush()
+
+def __get_trend_config():
+    trend = config.get("trend") or {}
+
+    return {
+        "enabled" : __to_bool(trend.get("enabled", False)),
+        "window_days" : float(trend.get("window_days") or 90),
+        "horizon_days" : float(trend.get("horizon_days") or 30),
+        "outlier_z" : float(trend.get("outlier_z") or 3.5),
+        "min_peers" : int(trend.get("min_peers") or 5)}
+
+def __analyze_trends(engine, devices, thresholds):
+    settings = __get_trend_config()
+
+    if not settings["enabled"] or not __get_history_config()["enabled"]:
+        return []
+    if not is_trend_available():
+        LOGGER.warning("Main -> Trend analysis is enabled but NumPy is not installed; skipping trend analysis")
+        return []
+
+    # The analysis covers the whole fleet so drives can be compared with others of the same model; only drives of this run are alerted on
+    started = time.monotonic()
+    with engine.connect() as connection:
+        trend_service = get_trend_service(connection)
+        findings = trend_service.analyze(thresholds, settings, time.time())
+        alerts = trend_service.get_alerts(findings, devices)
+
+    LOGGER.info("Main -> Analyzed attribute trends in %.2fs; %s findings, %s drives flagged", time.monotonic() - started, len(findings), len(alerts))
+
+    return alerts
+
+def __get_database_config():
+    database = config.get("database") or {}
+
+    return {
+        "journal_mode" : str(database.get("journal_mode") or "WAL").upper(),
+        "synchronous" : str(database.get("synchronous") or "NORMAL").upper(),
+        "cache_size" : int(database.get("cache_size") or -16000),
+        "busy_timeout" : int(database.get("busy_timeout") or 5000),
+        "batch_size" : int(database.get("batch_size") or 500),
+        "flush_interval" : float(database.get("flush_interval") or 1.0)}
+
+def __create_engine():
+    settings = __get_database_config()
+
+    # Pragmas cannot be bound as parameters, so only known values are accepted
+    if settings["journal_mode"] not in ("WAL", "DELETE", "TRUNCATE", "PERSIST", "MEMORY"):
+        raise ValueError("Invalid database journal_mode: {}".format(settings["journal_mode"]))
+    if settings["synchronous"] not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+        raise ValueError("Invalid database synchronous setting: {}".format(settings["synchronous"]))
+
+    # Readers get a pooled connection per worker; the extra connection is used by the writer thread
+    engine = create_engine(
+        DATABASE_FILENAME.decode(),
+        poolclass = QueuePool,
+        pool_size = __get_scheduler_config()["workers"] + 1,
+        max_overflow = 2,
+        connect_args = {"check_same_thread" : False})
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode = {}".format(settings["journal_mode"]))
+        cursor.execute("PRAGMA synchronous = {}".format(settings["synchronous"]))
+        cursor.execute("PRAGMA cache_size = {}".format(settings["cache_size"]))
+        cursor.execute("PRAGMA busy_timeout = {}".format(settings["busy_timeout"]))
+        cursor.close()
+
+    event.listen(engine, "connect", set_pragmas)
+
+    return engine
+
+def __start_writer(engine, state = None):
+    settings = __get_database_config()
+
+    writer = get_database_writer(engine, __get_history_config()["enabled"], settings["batch_size"], settings["flush_interval"], state)
+    writer.start()
+
+    return writer
+
+def __get_mail_config():
+    email = config.get("email") or {}
+
+    return {
+        "retry_delay" : float(email.get("retry_delay") or 30),
+        "max_retry_delay" : float(email.get("max_retry_delay") or 3600),
+        "max_attempts" : int(email.get("max_attempts", 20) or 0),
+        "drain_timeout" : float(email.get("drain_timeout") or 60),
+        "digest" : str(email.get("digest") or "none").lower(),
+        "format" : str(email.get("format") or "plain").lower(),
+        "suppress_repeats" : __to_bool(email.get("suppress_repeats", True)),
+        "immediate" : [str(severity).upper() for severity in email.get("immediate", ["FAILING"] if str(email.get("digest") or "none").lower() == "none" else []) or []],
+        "max_pending_alerts" : int(email.get("max_pending_alerts") or DEFAULT_MAX_PENDING_ALERTS)}
+
+def __start_mail_sender(engine, writer):
+    settings = __get_mail_config()
+
+    mail_service = get_mail_service(config["smtp"]["hostname"], int(config["smtp"]["port"]), __to_bool(config["smtp"]["ssl"]), config["smtp"]["username"], config["smtp"]["password"])
+    # Alerts mailed as soon as they are published (email.immediate) are put in the outbox by the sender thread, never by a worker
+    sender = get_mail_thread(engine, writer, mail_service, settings["retry_delay"], settings["max_retry_delay"], settings["max_attempts"],
+        lambda alerts: __enqueue_alerts(engine, writer, sender, [], alerts))
+    sender.start()
+
+    return sender
+
+def __get_metrics_config():
+    metrics = config.get("metrics") or {}
 
+    return {
+        "enabled" : __to_bool(metrics.get("enabled", False)),
+        "address" : str(metrics.get("address") or "127.0.0.1"),
+        "port" : int(metrics.get("port") or 9633)}
+
+def __start_metrics_exporter():
+    settings = __get_metrics_config()
+
+    if not settings["enabled"]:
+        return None
+
+    exporter = get_metrics_thread(settings["address"], settings["port"])
+    exporter.start()
+
+    return exporter
+
+def __update_metrics(engine, exporter, devices, state, run):
+    # Group labels use the names from the disks configuration rather than the upper cased names used in reports
+    group_names = {group.upper() : group for group in config.get("disks") or {}}
+    attribute_names = __get_attribute_names()
+
+    drives = []
+    for device in devices:
+        uuid = device["uuid"].lower()
+        if uuid not in state:
+            continue
+
+        drives.append({
+            "name" : device["name"],
+            "group" : group_names.get(device["group"], device["group"]),
+            "uuid" : uuid,
+            "attributes" : {name : state[uuid].get(name) for name in attribute_names},
+            "last_seen" : state[uuid].get("last_seen")})
+
+    # The outbox is counted here, once per run, so scrapes stay free of database queries
+    with engine.connect() as connection:
+        pending = get_outbox_service(connection).count_pending()
+
+    exporter.update(drives, {
+        "smart_monitor_mail_queue_depth" : ("Messages waiting in the outbox at the end of the last run", pending),
+        "smart_monitor_last_run_seconds" : ("Time at which the last run completed", repr(time.time())),
+        "smart_monitor_last_run_duration_seconds" : ("Duration of the last run", repr(run["duration"])),
+        "smart_monitor_last_run_disks" : ("Disks processed by the last run", run["disks"]),
+        "smart_monitor_last_run_unchanged_disks" : ("Disks of the last run whose report was unchanged", run["unchanged"])})
+
+def __get_standby_max_age():
+    # Drives in standby are only woken up once their last full read is older than max_age seconds
+    if not __to_bool(config["smart"].get("skip_standby", True)):
+        return None
+
+    return int(config["smart"].get("max_age") or DEFAULT_STANDBY_MAX_AGE)
+
+def __get_discovery_service():
+    discovery = config.get("discovery") or {}
+
+    return get_discovery_service(discovery.get("by_uuid"), discovery.get("sysfs"))
+
+def __get_scheduler_config():
+    scheduler = config.get("scheduler") or {}
+
+    return {
+        "engine" : str(scheduler.get("engine") or "threads").lower(),
+        "workers" : int(scheduler.get("workers") or DEFAULT_WORKERS),
+        "groups" : scheduler.get("groups") or {},
+        "controllers" : scheduler.get("controllers") or {}}
+
+def __get_thresholds():
+    # Build list of thresholds from configuration file
+    thresholds = {}
+
+    for attribute in config["smart"]["attributes"]:
+        for key in attribute.keys():
+            thresholds[key] = attribute[key]["threshold"]
+
+    return thresholds
+
+# Thresholds and the attribute parser compiled from the current configuration
+# They are replaced together as one reference, so a run always uses a consistent set even when the configuration is reloaded
+def __get_rules():
+    return {"thresholds" : __get_thresholds(), "parser" : get_attribute_parser(config["smart"])}
+
+def __get_intervals():
+    # Build polling interval (in seconds) of each group for daemon mode
+    daemon = config.get("daemon") or {}
+    default_interval = int(daemon.get("interval") or DEFAULT_INTERVAL)
+    group_intervals = daemon.get("groups") or {}
+
+    intervals = {}
     for group in config["disks"]:
+        intervals[group] = int(group_intervals.get(group) or default_interval)
+
+    return intervals
+
+def __get_schedule_config():
+    # Adaptive polling moves every drive's interval between the floor and ceiling of its group based on the drive's health
+    # Floors default to a quarter and ceilings to eight times the polling interval of the group
+    adaptive = (config.get("daemon") or {}).get("adaptive") or {}
+    group_limits = adaptive.get("groups") or {}
+
+    groups = {}
+    for group, interval in __get_intervals().items():
+        limits = group_limits.get(group) or {}
+        floor = min(int(limits.get("floor") or adaptive.get("floor") or max(interval // 4, 1)), interval)
+        ceiling = max(int(limits.get("ceiling") or adaptive.get("ceiling") or interval * 8), interval)
+        groups[group.upper()] = {"interval" : interval, "floor" : floor, "ceiling" : ceiling}
+
+    return {
+        "groups" : groups,
+        "adaptive" : __to_bool(adaptive.get("enabled", False)),
+        "backoff" : float(adaptive.get("backoff") or DEFAULT_BACKOFF),
+        "window" : float(DEFAULT_WINDOW if adaptive.get("window") is None else adaptive.get("window"))}
+
+def __parse_time_of_day(value):
+    hours, separator, minutes = str(value).partition(":")
+    return int(hours) * 60 + int(minutes or 0)
+
+def __get_self_test_config():
+    # Self-tests are started by the daemon within an optional maintenance window
+    # Each group runs one test at a time by default so a parity group never has all its drives under test at once
+    self_tests = config.get("self_tests") or {}
+    window = self_tests.get("window") or {}
+
+    return {
+        "enabled" : __to_bool(self_tests.get("enabled", False)),
+        "intervals" : {
+            "short" : int(self_tests.get("short_interval") or 0),
+            "long" : int(self_tests.get("long_interval") or 0)},
+        "max_concurrent" : int(self_tests.get("max_concurrent") or 2),
+        "max_group_concurrent" : int(self_tests.get("max_group_concurrent") or 1),
+        "groups" : {group.upper() : int(limit) for group, limit in (self_tests.get("groups") or {}).items()},
+        "window" : (__parse_time_of_day(window["start"]), __parse_time_of_day(window["end"])) if window.get("start") and window.get("end") else None,
+        "poll_interval" : int(self_tests.get("poll_interval") or 300),
+        "timeout" : config["smart"].get("timeout")}
+
+# Drives that may run a self-test, one per physical device since a test always covers the whole device
+def __get_self_test_drives():
+    devices = __get_devices(list(config["disks"]))
+    locations = __get_discovery_service().discover(device["uuid"].lower() for device in devices)
+
+    drives = {}
+    for device in devices:
+        device_location = locations[device["uuid"].lower()]
+        if device_location is not None and device_location not in drives:
+            drives[device_location] = {
+                "uuid" : device["uuid"].lower(),
+                "name" : device["name"],
+                "group" : device["group"],
+                "mount_point" : device.get("mount_point"),
+                "location" : device_location}
+
+    return list(drives.values())
+
+def __start_self_tests(engine, writer, sender):
+    settings = __get_self_test_config()
+    if not settings["enabled"]:
+        return None
+
+    # Failed tests are mailed through the same outbox, digest and suppression as attribute alerts
+    alert = lambda messages: __enqueue_alerts(engine, writer, sender, [], messages)
+    self_tests = get_self_test_thread(engine, writer, __get_self_test_drives, alert, settings)
+    self_tests.start()
+
+    return self_tests
+
+def __get_devices(groups):
+    devices = []
+
+    for group in groups:
         for disk in config["disks"][group]:
             for key, value in disk.items():
                 disk[key]["name"] = key
                 disk[key]["group"] = group.upper()
-                thread = get_drive_thread(disk[key], config["smart"], engine, lock, message_queue)
-                threads.append(thread)
-                thread.start()
+                devices.append(disk[key])
+
+    return devices
+
+# Suppress repeated alerts, build the outgoing mail and store both in one transaction of the database writer
+# Alerts of the drives in uuids that are neither in messages nor in dispatched have cleared and are forgotten
+# Dispatched alerts were mailed earlier in the run; they only count as still raised
+def __enqueue_alerts(engine, writer, sender, uuids, messages, dispatched = ()):
+    settings = __get_mail_config()
+
+    # Alerts whose condition has not changed since they were last sent are not mailed again
+    alerts = messages
+    if settings["suppress_repeats"] and messages:
+        with engine.connect() as connection:
+            sent = get_alert_service(connection).get_sent(set(uuids) | set(message["uuid"] for message in messages))
+
+        alerts = [message for message in messages if message["fingerprint"] not in sent]
+        if len(alerts) < len(messages):
+            LOGGER.info("Main -> Suppressed %s alerts that were already sent", len(messages) - len(alerts))
+
+    outgoing = get_digest_service(settings["digest"], settings["format"]).build(alerts)
+
+    # Messages are stored in the outbox before delivery so they survive SMTP outages and restarts
+    def record(connection):
+        get_alert_service(connection).update(uuids, list(messages) + list(dispatched), time.time())
+        get_outbox_service(connection).enqueue(config["email"]["sender"], config["email"]["destination"], outgoing, time.time())
+
+    with phase_timer("outbox_enqueue"):
+        writer.execute(record)
+
+    if outgoing:
+        LOGGER.debug("Main -> Queued %s messages for %s alerts in outbox", len(outgoing), len(alerts))
+        sender.notify()
+
+# Alert bus of a run; severities listed under email.immediate are handed to the mail sender as they are published instead of waiting for the run to end
+def __get_event_bus(sender):
+    settings = __get_mail_config()
+    events = get_event_bus(settings["max_pending_alerts"])
+
+    if settings["immediate"]:
+        events.subscribe(sender.queue_alerts, settings["immediate"])
+
+    return events
+
+def __send_messages(engine, writer, sender, events, devices, alerts = None):
+    # Collect the alerts published during the run; trend and ingest alerts are merged in so the most severe still go first
+    messages = sorted(list(alerts or []) + events.drain(), key = lambda message: get_alert_priority(message["severity"]))
+    if messages:
+        LOGGER.debug("Main -> Alert bus not empty; queueing messages to admin in outbox...")
+
+    stats = events.get_stats()
+    if stats["dropped"]:
+        LOGGER.error("Main -> Alert bus dropped %s alerts (%s) while full", sum(stats["dropped"].values()),
+            ", ".join("{} {}".format(count, severity) for severity, count in stats["dropped"].items()))
+
+    __enqueue_alerts(engine, writer, sender, [device["uuid"].lower() for device in devices], messages, events.get_dispatched())
+
+# Discover the physical device of every monitor, probe each device once and hand its report to the monitors on it
+# Returns the pool statistics and the monitors of every probed device
+def __probe_devices(monitors):
+    scheduler = __get_scheduler_config()
+    if scheduler["engine"] == "asyncio":
+        pool = get_async_engine(scheduler["workers"], scheduler["groups"], scheduler["controllers"], config["smart"].get("timeout"), __get_standby_max_age())
+    else:
+        pool = get_worker_pool(scheduler["workers"], scheduler["groups"], scheduler["controllers"])
+
+    # Map every configured disk to its physical device so each device is probed only once
+    discovery = __get_discovery_service()
+    with phase_timer("discovery"):
+        locations = discovery.discover(monitor.get_uuid() for monitor in monitors)
 
-    # Wait for threads to exit
-    for t in threads:
-        t.join()
+    probes = {}
+    for monitor in monitors:
+        device_location = locations[monitor.get_uuid()]
 
-    # Send any messages that the threads put in the queue
-    if not message_queue.empty():
-        LOGGER.debug("Main -> Message queue not empty; sending messages to admin...")
+        if device_location is None:
+            monitor.report_missing(discovery.get_link(monitor.get_uuid()))
+        else:
+            probes.setdefault(device_location, []).append(monitor)
 
-        # Add queue items to messages array
-        lock.acquire()
-        while not message_queue.empty():
-            messages.append(message_queue.get())
-        lock.release()
+    LOGGER.debug("Main -> Resolved %s disks to %s physical devices", len(monitors), len(probes))
 
-        # Send messages in bulk
-        mail_service = get_mail_service(config["smtp"]["hostname"], int(config["smtp"]["port"]), __to_bool(config["smtp"]["ssl"]), config["smtp"]["username"], config["smtp"]["password"])
-        mail_service.bulk_message(config["email"]["sender"], config["email"]["sender"], messages)
+    # Devices shared by several disks are scheduled under the group and controller of the first one
+    for device_location, device_monitors in probes.items():
+        device = device_monitors[0].device
+        set_phase_label(device_location, ", ".join(monitor.device["name"] for monitor in device_monitors))
+        if scheduler["engine"] == "asyncio":
+            pool.submit(device_location, device_monitors, device["group"], device.get("controller"))
+        else:
+            pool.submit(get_drive_thread(device_location, device_monitors, config["smart"], __get_standby_max_age()), device["group"], device.get("controller"))
+
+    # Wait for all disks to be processed
+    return pool.run(), probes
+
+# Commit the results of a run, add trend alerts, queue mail and refresh the metrics
+def __complete_run(engine, writer, sender, events, devices, thresholds, state, exporter, run):
+    # Wait for the writer to commit the results of this run
+    stats = writer.flush()
+    LOGGER.info("Main -> Committed %s drives and %s attribute samples in %s commits (commit time: %.1fms total, %.1fms max; max queue depth: %s)",
+        stats["rows"], stats["samples"], stats["commits"], stats["commit_time"] * 1000, stats["max_commit_time"] * 1000, stats["max_queue_depth"])
+
+    # Flag drives whose history predicts trouble before any threshold is crossed
+    try:
+        with phase_timer("trend_analysis"):
+            alerts = __analyze_trends(engine, devices, thresholds)
+    except Exception:
+        LOGGER.exception("Main -> Unexpected exception while analyzing attribute trends")
+        alerts = []
+
+    __send_messages(engine, writer, sender, events, devices, alerts)
+
+    if exporter is not None:
+        __update_metrics(engine, exporter, devices, state, {"duration" : time.monotonic() - run["started"], "disks" : len(devices), "unchanged" : run["unchanged"]})
+
+# Devices limits the run to some disks of the groups; every disk of the groups is processed when it is None
+def __process_groups(engine, writer, sender, groups, thresholds = None, state = None, parser = None, exporter = None, devices = None):
+    started = time.monotonic()
+    events = __get_event_bus(sender)
+    if devices is None:
+        devices = __get_devices(groups)
+
+    if thresholds is None:
+        thresholds = __get_thresholds()
+    if state is None:
+        state = {}
+
+    # Load stored attributes of the drives up front so workers do not query the database
+    __load_drives(engine, devices, state)
+
+    # Attribute watch list and column layout are compiled once for every disk of the run
+    if parser is None:
+        parser = get_attribute_parser(config["smart"])
+
+    # Process configured disks
+    LOGGER.debug("Main -> Queueing disks of groups %s for processing...", ", ".join(groups))
+
+    monitors = [get_drive_monitor(device, config["smart"], writer, events, thresholds, state, parser) for device in devices]
+    stats, probes = __probe_devices(monitors)
+    unchanged = sum(1 for monitor in monitors if monitor.unchanged)
+    LOGGER.info("Main -> Processed %s disks (%s unchanged) on %s devices with %s workers in %.2fs (queue wait: %.2fs total, %.2fs max)",
+        len(devices), unchanged, stats["jobs"], stats["workers"], stats["total_time"], stats["queue_wait"], stats["max_queue_wait"])
+
+    __complete_run(engine, writer, sender, events, devices, thresholds, state, exporter, {"started" : started, "unchanged" : unchanged})
+
+    return monitors
+
+def __run():
+    engine = __create_engine()
+
+    # Ensure that database has been created properly
+    __validate_database(engine)
+    state = {}
+    writer = __start_writer(engine, state)
+    sender = __start_mail_sender(engine, writer)
+
+    # Process all configured disks once
+    try:
+        __process_groups(engine, writer, sender, list(config["disks"]), state = state)
+        __apply_history_retention(writer)
+
+        # Give the outbox a chance to deliver before exiting; anything left is retried on the next run
+        if not sender.drain(__get_mail_config()["drain_timeout"]):
+            LOGGER.warning("Main -> Outbox not drained before timeout; remaining messages will be sent on the next run")
+    finally:
+        sender.stop()
+        writer.stop()
 
     LOGGER.debug("Main -> Finished processing drives; now exiting...")
 
+def __run_ingest(path):
+    engine = __create_engine()
+
+    # Ensure that database has been created properly
+    __validate_database(engine)
+    state = {}
+    writer = __start_writer(engine, state)
+    sender = __start_mail_sender(engine, writer)
+
+    # Captures are matched to configured disks by uuid and go through the same monitor logic as probed disks
+    events = __get_event_bus(sender)
+    devices = __get_devices(list(config["disks"]))
+    thresholds = __get_thresholds()
+    parser = get_attribute_parser(config["smart"])
+    __load_drives(engine, devices, state)
+
+    monitors = {}
+    for device in devices:
+        monitor = get_drive_monitor(device, config["smart"], writer, events, thresholds, state, parser)
+        monitors[monitor.get_uuid()] = monitor
+
+    settings = __get_database_config()
+    ingest_service = get_ingest_service(config["smart"], __get_scheduler_config()["workers"])
+    counts = {"processed" : 0, "unknown" : 0, "failed" : 0, "rows" : 0, "commits" : 0}
+    ingested = {}
+    window = {}
+    started = time.monotonic()
+
+    try:
+        for name, uuid, smart_report in ingest_service.parse(path):
+            if smart_report is None:
+                counts["failed"] += 1
+                continue
+            if uuid not in monitors:
+                LOGGER.warning("Ingest -> No configured disk has uuid %s; skipping %s...", uuid, name)
+                counts["unknown"] += 1
+                continue
+
+            monitors[uuid].process(name, smart_report)
+            ingested[uuid] = monitors[uuid].device
+            window[uuid] = monitors[uuid].device
+            counts["processed"] += 1
+
+            # Wait for the writer every batch so queued rows cannot pile up faster than they are committed
+            # Alerts of the batch are queued in the outbox once its rows are committed, so they never pile up either
+            if counts["processed"] % settings["batch_size"] == 0:
+                stats = writer.flush()
+                counts["rows"] += stats["rows"]
+                counts["commits"] += stats["commits"]
+                __send_messages(engine, writer, sender, events, list(window.values()))
+                window = {}
+
+        stats = writer.flush()
+        counts["rows"] += stats["rows"]
+        counts["commits"] += stats["commits"]
+        LOGGER.info("Main -> Ingested %s captures of %s disks in %.2fs (%s unknown, %s unreadable); committed %s drive rows in %s commits",
+            counts["processed"], len(ingested), time.monotonic() - started, counts["unknown"], counts["failed"], counts["rows"], counts["commits"])
+
+        __send_messages(engine, writer, sender, events, list(window.values()))
+        __apply_history_retention(writer)
+
+        if not sender.drain(__get_mail_config()["drain_timeout"]):
+            LOGGER.warning("Main -> Outbox not drained before timeout; remaining messages will be sent on the next run")
+    finally:
+        sender.stop()
+        writer.stop()
+
+# Stop event set by SIGTERM and SIGINT; the current poll finishes before the loop exits
+def __get_stop_event():
+    stop = threading.Event()
+
+    def handle_signal(signum, frame):
+        LOGGER.info("Main -> Received signal %s; shutting down after current poll...", signum)
+        stop.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    return stop
+
+# Call poll(groups) whenever groups are due according to their intervals and maintain() every maintenance_interval seconds in between
+def __schedule(stop, poll, maintain, maintenance_interval):
+    intervals = __get_intervals()
+
+    next_poll = {}
+    for group in intervals:
+        next_poll[group] = time.monotonic()
+    next_maintenance = time.monotonic()
+
+    LOGGER.info("Main -> Running as daemon with polling intervals: %s",
+        ", ".join("{} every {}s".format(group, interval) for group, interval in intervals.items()))
+
+    while not stop.is_set():
+        now = time.monotonic()
+        due = [group for group in next_poll if next_poll[group] <= now]
+
+        if due:
+            try:
+                poll(due)
+            except Exception:
+                LOGGER.exception("Main -> Unexpected exception while polling groups %s", ", ".join(due))
+
+            for group in due:
+                next_poll[group] = now + intervals[group]
+        elif next_maintenance <= now:
+            try:
+                maintain()
+            except Exception:
+                LOGGER.exception("Main -> Unexpected exception during periodic maintenance")
+
+            next_maintenance = now + maintenance_interval
+        else:
+            stop.wait(min(min(next_poll.values()), next_maintenance) - now)
+
+# Poll every drive when the schedule says it is due, maintain() every maintenance_interval seconds in between
+# and reload() every reload_interval seconds; reload() returns True when the configured disks or their intervals changed
+def __schedule_drives(stop, schedule, poll, maintain, maintenance_interval, reload = None, reload_interval = None):
+    schedule.sync(__get_devices(list(config["disks"])), time.monotonic())
+    next_maintenance = time.monotonic()
+    next_reload = time.monotonic() + reload_interval if reload is not None else float("inf")
+
+    while not stop.is_set():
+        now = time.monotonic()
+        next_poll = schedule.get_next()
+
+        if next_reload <= now:
+            try:
+                added = reload()
+                if added is not None:
+                    # Drives keep their due time; added drives are due right away
+                    settings = __get_schedule_config()
+                    schedule.configure(settings["groups"], settings["adaptive"], settings["backoff"], settings["window"])
+                    schedule.sync(__get_devices(list(config["disks"])), now, added)
+            except Exception:
+                LOGGER.exception("Main -> Unexpected exception while reloading configuration")
+
+            next_reload = now + reload_interval
+        elif next_poll is not None and next_poll <= now:
+            due = schedule.pop_due(now)
+            health = {}
+
+            try:
+                for monitor in poll(due):
+                    health[monitor.get_uuid()] = monitor.health
+            except Exception:
+                LOGGER.exception("Main -> Unexpected exception while polling %s drives", len(due))
+
+            # Drives whose health is unknown, including those of a failed poll, return to the interval of their group
+            finished = time.monotonic()
+            for uuid in due:
+                interval = schedule.reschedule(uuid, health.get(uuid), finished)
+                LOGGER.debug("Main -> Next poll of %s in %.0fs (health: %s)", uuid, interval, health.get(uuid) or "unknown")
+        elif next_maintenance <= now:
+            try:
+                maintain()
+            except Exception:
+                LOGGER.exception("Main -> Unexpected exception during periodic maintenance")
+
+            next_maintenance = now + maintenance_interval
+        else:
+            stop.wait(min(next_poll if next_poll is not None else next_maintenance, next_maintenance, next_reload) - now)
+
+def __get_reload_interval():
+    # Seconds between checks of the configuration file for changes; 0 disables reloading
+    daemon = config.get("daemon") or {}
+    reload_interval = daemon.get("reload_interval")
+
+    return int(DEFAULT_RELOAD_INTERVAL if reload_interval is None else reload_interval)
+
+# Apply a changed configuration file to the running daemon
+# Only the difference is applied: removed disks are retired and only new attribute columns are migrated
+# Returns None when the file did not change and the uuids of added disks otherwise; the caller schedules those right away
+def __reload_config(watcher, engine, runtime, state, exporter):
+    global config
+
+    changed = watcher.poll()
+    if changed is None:
+        return None
+
+    diff = get_config_diff(config, changed)
+    if diff["restart"]:
+        LOGGER.warning("Main -> Changes to %s only take effect after a restart", ", ".join(diff["restart"]))
+
+    # Columns exist before any run sees the new attributes
+    if diff["columns"]:
+        __migrate_columns(engine, diff["columns"])
+
+    config = changed
+    if diff["smart"]:
+        runtime["rules"] = __get_rules()
+
+    for key, (old, new) in sorted(diff["thresholds"].items()):
+        LOGGER.info("Main -> Threshold of %s changed from %s to %s", key, old, new)
+
+    # Retired disks are forgotten so a disk configured again later is loaded from the database
+    for uuid in diff["removed"]:
+        state.pop(uuid, None)
+    if exporter is not None and diff["removed"]:
+        exporter.remove(list(diff["removed"]))
+
+    LOGGER.info("Main -> Reloaded configuration: %s disks added, %s disks retired, %s thresholds changed, %s columns added",
+        len(diff["added"]), len(diff["removed"]), len(diff["thresholds"]), len(diff["columns"]))
+
+    return set(diff["added"])
+
+def __run_daemon():
+    stop = __get_stop_event()
+
+    # Engine, schema validation and thresholds are only set up once for the lifetime of the daemon
+    # Later changes of the configuration file are applied as a diff by __reload_config
+    engine = __create_engine()
+    __validate_database(engine)
+    state = {}
+    writer = __start_writer(engine, state)
+    sender = __start_mail_sender(engine, writer)
+    exporter = __start_metrics_exporter()
+    self_tests = __start_self_tests(engine, writer, sender)
+
+    runtime = {"rules" : __get_rules()}
+    watcher = get_config_service(config_filename)
+    reload_interval = __get_reload_interval()
+
+    settings = __get_schedule_config()
+    schedule = get_schedule_service(settings["groups"], settings["adaptive"], settings["backoff"], settings["window"])
+    LOGGER.info("Main -> Running as daemon with %s polling: %s", "adaptive" if settings["adaptive"] else "fixed",
+        ", ".join("{} every {}s".format(group, limits["interval"]) + (" ({}s to {}s)".format(limits["floor"], limits["ceiling"]) if settings["adaptive"] else "") for group, limits in settings["groups"].items()))
+
+    # Every run reads the rules once, so a reload never mixes thresholds of two configurations within a run
+    def poll(uuids):
+        rules = runtime["rules"]
+        devices = [device for device in __get_devices(list(config["disks"])) if device["uuid"].lower() in uuids]
+        groups = [group for group in config["disks"] if any(device["group"] == group.upper() for device in devices)]
+        return __process_groups(engine, writer, sender, groups, rules["thresholds"], state, rules["parser"], exporter, devices)
+
+    reload = None
+    if reload_interval > 0:
+        reload = lambda: __reload_config(watcher, engine, runtime, state, exporter)
+
+    # Old attribute history is rolled up at most once per hour
+    __schedule_drives(stop, schedule, poll, lambda: __apply_history_retention(writer), RETENTION_INTERVAL, reload, reload_interval)
+
+    if self_tests is not None:
+        self_tests.stop()
+    if exporter is not None:
+        exporter.stop()
+    sender.stop()
+    writer.stop()
+    engine.dispose()
+    LOGGER.debug("Main -> Daemon stopped; now exiting...")
+
+def __get_aggregator_config():
+    aggregator = config.get("aggregator") or {}
+
+    return {
+        "address" : str(aggregator.get("address") or "127.0.0.1"),
+        "port" : int(aggregator.get("port") or 9634),
+        "token" : aggregator.get("token") or None,
+        "timeout" : float(aggregator.get("timeout") or 10),
+        "host" : aggregator.get("host") or None,
+        "spool" : str(aggregator.get("spool") or "spool"),
+        "max_spool_batches" : int(aggregator.get("max_spool_batches") or 1000),
+        "retry_interval" : int(aggregator.get("retry_interval") or 60)}
+
+def __collect_groups(collector, groups, state, parser):
+    started = time.monotonic()
+    lock = threading.Lock()
+    snapshots = []
+    devices = __get_devices(groups)
+
+    monitors = [get_collector_monitor(device, snapshots, lock, state, parser) for device in devices]
+    stats, probes = __probe_devices(monitors)
+
+    # The batch is spooled before it is pushed so it survives an unreachable aggregator
+    collector.spool(snapshots)
+    sent, remaining = collector.push()
+
+    LOGGER.info("Main -> Collected %s disks (%s unchanged) on %s devices in %.2fs; pushed %s batches (%s still spooled)",
+        len(devices), sum(1 for monitor in monitors if monitor.unchanged), stats["jobs"], time.monotonic() - started, sent, remaining)
+
+def __run_collector(daemon):
+    settings = __get_aggregator_config()
+    collector = get_collector_service(settings["address"], settings["port"], settings["spool"], settings["host"], settings["token"], settings["timeout"], settings["max_spool_batches"])
+    parser = get_attribute_parser(config["smart"])
+    state = {}
+
+    if not daemon:
+        __collect_groups(collector, list(config["disks"]), state, parser)
+        return
+
+    # Batches left in the spool are retried between polls
+    stop = __get_stop_event()
+    __schedule(stop, lambda groups: __collect_groups(collector, groups, state, parser), collector.push, settings["retry_interval"])
+    LOGGER.debug("Main -> Collector stopped; now exiting...")
+
+def __get_aggregated_device(configured, snapshot):
+    # Disks configured on the aggregator keep their configured name and group; other disks are described by their collector
+    if snapshot["uuid"] in configured:
+        return configured[snapshot["uuid"]]
+
+    return {"uuid" : snapshot["uuid"], "name" : snapshot["name"], "group" : snapshot["group"], "mount_point" : snapshot.get("mount_point") or ""}
+
+def __apply_batch(engine, writer, sender, batch, configured, thresholds, state, parser, exporter):
+    started = time.monotonic()
+    events = __get_event_bus(sender)
+    devices = [__get_aggregated_device(configured, snapshot) for snapshot in batch["snapshots"]]
+
+    __load_drives(engine, devices, state)
+
+    unchanged = 0
+    for snapshot, device in zip(batch["snapshots"], devices):
+        monitor = get_drive_monitor(device, config["smart"], writer, events, thresholds, state, parser)
+        device_location = "{}:{}".format(batch["host"], snapshot["location"])
+
+        if snapshot["status"] == STATUS_STANDBY:
+            monitor.report_standby()
+        elif snapshot["status"] == STATUS_MISSING:
+            monitor.report_missing(device_location)
+        else:
+            # Collectors leave out the smartctl text of reports that did not change since their previous batch
+            smart_report = snapshot["report"]
+            if smart_report["report"] is None:
+                smart_report["information"] = ""
+                smart_report["report"] = ""
+
+            monitor.process(device_location, smart_report)
+            unchanged += 1 if monitor.unchanged else 0
+
+    LOGGER.info("Main -> Applied %s snapshots (%s unchanged) from %s collected %.0fs ago",
+        len(devices), unchanged, batch["host"], max(time.time() - batch["created"], 0))
+
+    # The batch is only acknowledged once this returns, so everything is committed first
+    __complete_run(engine, writer, sender, events, devices, thresholds, state, exporter, {"started" : started, "unchanged" : unchanged})
+
+def __run_aggregator():
+    stop = __get_stop_event()
+    settings = __get_aggregator_config()
+
+    engine = __create_engine()
+    __validate_database(engine)
+    state = {}
+    writer = __start_writer(engine, state)
+    sender = __start_mail_sender(engine, writer)
+    exporter = __start_metrics_exporter()
+
+    thresholds = __get_thresholds()
+    parser = get_attribute_parser(config["smart"])
+    configured = {device["uuid"].lower() : device for device in __get_devices(list(config.get("disks") or {}))}
+
+    aggregator = get_aggregator_thread(settings["address"], settings["port"],
+        lambda batch: __apply_batch(engine, writer, sender, batch, configured, thresholds, state, parser, exporter), settings["token"])
+    aggregator.start()
+
+    # Collectors are served on their own threads; the main thread only rolls up old attribute history
+    while not stop.is_set():
+        try:
+            __apply_history_retention(writer)
+        except Exception:
+            LOGGER.exception("Main -> Unexpected exception while applying attribute history retention")
+
+        stop.wait(RETENTION_INTERVAL)
+
+    aggregator.stop()
+    if exporter is not None:
+        exporter.stop()
+    sender.stop()
+    writer.stop()
+    engine.dispose()
+    LOGGER.debug("Main -> Aggregator stopped; now exiting...")
+
 
 #################################################################################################
 # Run main application
 #################################################################################################
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file
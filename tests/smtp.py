@@ -0,0 +1,39 @@
+import socketserver
+import threading
+
+# Minimal SMTP server that accepts and counts every message
+# The next rejects messages are answered with a temporary failure instead so retries can be exercised
+class SmtpSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0), SmtpHandler)
+        self.messages = 0
+        self.rejects = 0
+        self.lock = threading.Lock()
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write(b"220 sink ESMTP\r\n")
+
+        for line in self.rfile:
+            command = line.strip().upper()
+
+            if command.startswith(b"DATA"):
+                self.wfile.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                for data in self.rfile:
+                    if data in (b".\r\n", b".\n"):
+                        break
+                with self.server.lock:
+                    rejected = self.server.rejects > 0
+                    if rejected:
+                        self.server.rejects -= 1
+                    else:
+                        self.server.messages += 1
+                self.wfile.write(b"451 Try again later\r\n" if rejected else b"250 OK\r\n")
+            elif command.startswith(b"QUIT"):
+                self.wfile.write(b"221 Bye\r\n")
+                return
+            else:
+                self.wfile.write(b"250 OK\r\n")
@@ -0,0 +1,89 @@
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from services.CollectorService import get_service as get_collector_service, SPOOL_SUFFIX
+from threads.AggregatorThread import get_thread as get_aggregator_thread
+
+TOKEN = "secret"
+
+def get_closed_port():
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        return listener.getsockname()[1]
+
+def get_snapshot(name, value):
+    return {"uuid" : name, "status" : "active", "report" : {"attributes" : [{"id" : 5, "name" : "reallocated_sector_ct", "when_failed" : "-", "raw_value" : value}]}}
+
+# Pushes spooled batches from a collector to an aggregator listening on localhost
+class CollectorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.batches = []
+        self.aggregator = None
+
+    def tearDown(self):
+        if self.aggregator is not None:
+            self.aggregator.stop()
+
+        shutil.rmtree(self.directory)
+
+    def __start_aggregator(self, token = TOKEN):
+        self.aggregator = get_aggregator_thread("127.0.0.1", 0, self.batches.append, token)
+        self.aggregator.start()
+        return self.aggregator.server.server_address[1]
+
+    def __get_collector(self, port, token = TOKEN):
+        return get_collector_service("127.0.0.1", port, self.directory, "collector", token, timeout = 5)
+
+    def __get_spooled(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(SPOOL_SUFFIX))
+
+    def test_spools_while_aggregator_is_down(self):
+        collector = self.__get_collector(get_closed_port())
+        collector.spool([get_snapshot("disk1", 0)])
+        collector.spool([get_snapshot("disk1", 1)])
+
+        self.assertEqual(collector.push(), (0, 2))
+        self.assertEqual(len(self.__get_spooled()), 2)
+
+    def test_delivers_spooled_batches_once_acknowledged(self):
+        collector = self.__get_collector(get_closed_port())
+        first = collector.spool([get_snapshot("disk1", 0)])
+        second = collector.spool([get_snapshot("disk1", 1)])
+        self.assertEqual(collector.push(), (0, 2))
+
+        # The aggregator comes up on another port; batches are sent oldest first and removed once acknowledged
+        collector.port = self.__start_aggregator()
+        self.assertEqual(collector.push(), (2, 0))
+        self.assertEqual(self.__get_spooled(), [])
+        self.assertEqual([batch["id"] for batch in self.batches], [first, second])
+        self.assertEqual(self.batches[1]["snapshots"][0]["report"]["attributes"][0]["raw_value"], 1)
+        self.assertEqual(collector.push(), (0, 0))
+
+    def test_replayed_batch_is_applied_once(self):
+        collector = self.__get_collector(self.__start_aggregator())
+        collector.spool([get_snapshot("disk1", 3)])
+        name = self.__get_spooled()[0]
+        with open(os.path.join(self.directory, name), "rb") as batch:
+            frame = batch.read()
+
+        self.assertEqual(collector.push(), (1, 0))
+
+        # A batch resent after its acknowledgement was lost is acknowledged again without being applied
+        with open(os.path.join(self.directory, name), "wb") as batch:
+            batch.write(frame)
+
+        self.assertEqual(collector.push(), (1, 0))
+        self.assertEqual(self.__get_spooled(), [])
+        self.assertEqual(len(self.batches), 1)
+
+    def test_rejects_batch_with_wrong_token(self):
+        collector = self.__get_collector(self.__start_aggregator(), token = "wrong")
+        collector.spool([get_snapshot("disk1", 0)])
+
+        self.assertEqual(collector.push(), (0, 1))
+        self.assertEqual(len(self.__get_spooled()), 1)
+        self.assertEqual(self.batches, [])
@@ -0,0 +1,23 @@
+import unittest
+
+from services.DigestService import get_service as get_digest_service
+
+def get_alert(severity, uuid, name, report = True):
+    return {
+        "subject" : "{}! {}".format(severity, name),
+        "severity" : severity,
+        "fingerprint" : severity + uuid,
+        "uuid" : uuid,
+        "name" : name,
+        "group" : "ARRAY",
+        "sections" : [{"title" : "Attributes:", "columns" : ["ATTRIBUTE_NAME", "CURRENT_VALUE"], "rows" : [["reallocated_sector_ct", 3]]}],
+        "report" : {"output" : "report of " + name} if report else None}
+
+class DigestTest(unittest.TestCase):
+    def test_attaches_report_once_per_drive(self):
+        alerts = [get_alert("WARNING", "aaaa", "disk1"), get_alert("FAILING", "aaaa", "disk1"), get_alert("INITIAL", "bbbb", "disk2"), get_alert("PREDICTED", "aaaa", "disk1", report = False)]
+        message = get_digest_service("run").build(alerts)[0]
+
+        self.assertEqual([attachment["filename"] for attachment in message["attachments"]], ["array-disk1-smartctl.txt", "array-disk2-smartctl.txt"])
+        self.assertEqual(message["attachments"][0]["content"], "report of disk1")
+        self.assertEqual(message["body"].count("Full SMART report attached as array-disk1-smartctl.txt"), 2)
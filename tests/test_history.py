@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine, text
+from services.DriveService import get_service as get_drive_service
+from services.HistoryService import get_service as get_history_service
+
+# Writes attribute samples through the history service the way the database writer does, one transaction per batch
+class HistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = create_engine("sqlite:///" + os.path.join(self.directory, "database.db"))
+        with self.database.begin() as connection:
+            get_drive_service(connection).create_table()
+            get_history_service(connection).create_tables()
+            connection.execute(text("INSERT INTO drives (uuid, name, code_group) VALUES ('aaaa', 'disk1', 'ARRAY')"))
+
+    def tearDown(self):
+        self.database.dispose()
+        shutil.rmtree(self.directory)
+
+    def __write(self, attributes, timestamp):
+        with self.database.begin() as connection:
+            history_service = get_history_service(connection)
+            history_service.write_samples([{"uuid" : "aaaa", "timestamp" : timestamp, "attributes" : attributes}])
+
+        history_service.cache_attribute_ids()
+
+    def __get_latest(self):
+        with self.database.connect() as connection:
+            return dict(connection.execute(text("SELECT a.name, l.raw_value FROM attribute_latest l JOIN attributes a ON a.id = l.attribute_id")).fetchall())
+
+    def test_ids_of_rolled_back_batch_are_not_cached(self):
+        with self.assertRaises(RuntimeError), self.database.begin() as connection:
+            get_history_service(connection).write_samples([{"uuid" : "aaaa", "timestamp" : 1, "attributes" : {"rolled_back_attribute" : 7}}])
+            raise RuntimeError("commit failed")
+
+        # The id handed out in the rolled back batch is assigned again to the next new attribute
+        self.__write({"reallocated_sector_ct" : 3}, 2)
+        self.__write({"rolled_back_attribute" : 7}, 3)
+
+        self.assertEqual(self.__get_latest(), {"reallocated_sector_ct" : 3, "rolled_back_attribute" : 7})
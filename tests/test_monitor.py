@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine, text
+from services.DriveService import get_service as get_drive_service, STATE_COLUMNS
+from services.EventBus import get_bus
+from services.ScheduleService import get_service as get_schedule_service, HEALTH_FAILING
+from threads.DriveMonitor import get_monitor, STATUS_STANDBY
+from threads.WriterThread import get_writer as get_database_writer
+
+DEVICE = {"uuid" : "AAAA-BBBB", "name" : "disk1", "group" : "ARRAY", "mount_point" : "/mnt/disk1"}
+SMART = {"attributes" : [{"reallocated_sector_ct" : {"threshold" : 10}}], "report_values" : False, "report_initial_values" : False, "report_updated_values" : False}
+GROUPS = {"ARRAY" : {"interval" : 600, "floor" : 60, "ceiling" : 3600}}
+
+def get_report(when_failed):
+    return {
+        "identity" : {"model" : "Test Disk"},
+        "health" : "PASSED",
+        "attributes" : [
+            {"id" : 5, "name" : "reallocated_sector_ct", "when_failed" : "-", "raw_value" : 3},
+            {"id" : 184, "name" : "end_to_end_error", "when_failed" : when_failed, "raw_value" : 1}],
+        "information" : "Device Model: Test Disk",
+        "report" : "report of disk1"}
+
+# Runs the drive monitor of one monitor process against a test database and reads the state back like a restarted process
+class MonitorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = create_engine("sqlite:///" + os.path.join(self.directory, "database.db"))
+        with self.database.begin() as connection:
+            drive_service = get_drive_service(connection)
+            drive_service.create_table()
+            drive_service.add_table_column("reallocated_sector_ct")
+
+        self.state = {}
+        self.writer = get_database_writer(self.database, history = False, state = self.state)
+        self.writer.start()
+
+    def tearDown(self):
+        self.writer.stop()
+        self.database.dispose()
+        shutil.rmtree(self.directory)
+
+    def __load_state(self):
+        with self.database.connect() as connection:
+            return get_drive_service(connection).get_drives(["aaaa-bbbb"], ["reallocated_sector_ct"] + list(STATE_COLUMNS))
+
+    def __process(self, state, report):
+        monitor = get_monitor(DEVICE, SMART, self.writer, get_bus(), {"reallocated_sector_ct" : 10}, state)
+        monitor.process("/dev/sda", report)
+        self.writer.flush()
+        return monitor
+
+    def test_failing_drive_stays_failing_after_restart(self):
+        first = self.__process({}, get_report("FAILING_NOW"))
+        self.__process(first.state, get_report("FAILING_NOW"))
+        self.assertEqual(self.__load_state()["aaaa-bbbb"]["health"], HEALTH_FAILING)
+
+        # The restarted process reads the unchanged report on the fast path and keeps polling the drive at the floor
+        restarted = self.__process(self.__load_state(), get_report("FAILING_NOW"))
+        self.assertTrue(restarted.unchanged)
+        self.assertEqual(restarted.health, HEALTH_FAILING)
+
+        schedule = get_schedule_service(GROUPS, adaptive = True)
+        schedule.sync([DEVICE], 0)
+        self.assertEqual(schedule.reschedule("aaaa-bbbb", restarted.health, 0), 60)
+        self.assertEqual(schedule.reschedule("aaaa-bbbb", restarted.health, 60), 60)
+
+    def test_recovered_drive_is_no_longer_failing(self):
+        self.__process({}, get_report("FAILING_NOW"))
+
+        restarted = self.__process(self.__load_state(), get_report("-"))
+        self.assertFalse(restarted.unchanged)
+        self.assertNotEqual(restarted.health, HEALTH_FAILING)
+        self.assertNotEqual(self.__load_state()["aaaa-bbbb"]["health"], HEALTH_FAILING)
+
+    def test_drive_of_failed_commit_is_reloaded(self):
+        self.__process(self.state, get_report("-"))
+        self.assertIn("aaaa-bbbb", self.state)
+
+        # The row of the next read cannot be written; the drive is dropped from the state so it is not compared against unwritten values
+        with self.database.begin() as connection:
+            connection.execute(text("ALTER TABLE drives RENAME TO drives_moved"))
+        with self.assertLogs(level = "ERROR"):
+            self.__process(self.state, get_report("FAILING_NOW"))
+        self.assertNotIn("aaaa-bbbb", self.state)
+
+    def test_standby_keeps_last_full_read(self):
+        monitor = self.__process(self.state, get_report("-"))
+        last_seen = self.__load_state()["aaaa-bbbb"]["last_seen"]
+
+        # Only the status records the skip; last_seen stays at the last full read that max_age is counted from
+        monitor.report_standby()
+        self.writer.flush()
+        stored = self.__load_state()["aaaa-bbbb"]
+        self.assertEqual(stored["status"], STATUS_STANDBY)
+        self.assertEqual(stored["last_seen"], last_seen)
+        self.assertEqual(self.state["aaaa-bbbb"]["last_seen"], last_seen)
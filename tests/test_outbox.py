@@ -0,0 +1,158 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from sqlalchemy import create_engine, text
+from services.MailService import MailService
+from services.OutboxService import get_service as get_outbox_service
+from threads.MailThread import get_thread as get_mail_thread
+from threads.WriterThread import get_writer as get_database_writer
+from tests.smtp import SmtpSink
+
+TIMEOUT = 10
+
+# Mail service that records when each delivery was attempted
+class RecordingMailService(MailService):
+    def __init__(self, port):
+        MailService.__init__(self, "127.0.0.1", port, False, None, None)
+        self.attempts = []
+
+    def deliver(self, sender, destination, subject, body, attachments = None, subtype = "plain"):
+        self.attempts.append(time.monotonic())
+        MailService.deliver(self, sender, destination, subject, body, attachments, subtype)
+
+def get_closed_port():
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        return listener.getsockname()[1]
+
+def wait_for(condition, timeout = TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+
+    return condition()
+
+# Runs the outbox, database writer and mail sender of one monitor process against a local SMTP sink
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sink = SmtpSink()
+        threading.Thread(target = self.sink.serve_forever, daemon = True).start()
+        self.processes = []
+
+    def tearDown(self):
+        for process in self.processes:
+            self.__stop(process)
+
+        self.sink.shutdown()
+        self.sink.server_close()
+        shutil.rmtree(self.directory)
+
+    # Start the mail pipeline of a monitor process on the test database
+    def __start(self, port, retry_delay = 0.05, max_retry_delay = 3600, max_attempts = 20, alert_handler = None):
+        database = create_engine("sqlite:///" + os.path.join(self.directory, "database.db"))
+        with database.begin() as connection:
+            get_outbox_service(connection).create_table()
+
+        writer = get_database_writer(database, history = False)
+        writer.start()
+        mail_service = RecordingMailService(port)
+        sender = get_mail_thread(database, writer, mail_service, retry_delay, max_retry_delay, max_attempts, alert_handler)
+        sender.start()
+
+        process = {"database" : database, "writer" : writer, "sender" : sender, "mail_service" : mail_service}
+        self.processes.append(process)
+        return process
+
+    def __stop(self, process):
+        if process in self.processes:
+            self.processes.remove(process)
+            process["sender"].stop()
+            process["writer"].stop()
+            process["database"].dispose()
+
+    def __enqueue(self, process, subjects):
+        messages = [{"subject" : subject, "body" : "Test message"} for subject in subjects]
+        process["writer"].execute(lambda connection: get_outbox_service(connection).enqueue("sender@test", "admin@test", messages, time.time()))
+        process["sender"].notify()
+
+    def __get_outbox(self, process):
+        with process["database"].connect() as connection:
+            return [dict(row._mapping) for row in connection.execute(text("SELECT subject, status, attempts, last_error, delivered FROM outbox ORDER BY id"))]
+
+    def test_delivers_queued_messages(self):
+        process = self.__start(self.sink.server_address[1])
+        self.__enqueue(process, ["first", "second", "third"])
+
+        self.assertTrue(wait_for(lambda: all(message["status"] == "sent" for message in self.__get_outbox(process))))
+        self.assertEqual(self.sink.messages, 3)
+        self.assertEqual([message["attempts"] for message in self.__get_outbox(process)], [1, 1, 1])
+
+    def test_retries_with_exponential_backoff(self):
+        self.sink.rejects = 4
+        process = self.__start(self.sink.server_address[1], retry_delay = 0.2, max_retry_delay = 0.5, max_attempts = 0)
+        self.__enqueue(process, ["retried"])
+
+        self.assertTrue(wait_for(lambda: self.__get_outbox(process)[0]["status"] == "sent"))
+        self.assertEqual(self.sink.messages, 1)
+        self.assertEqual(self.__get_outbox(process)[0]["attempts"], 5)
+
+        # Delays double from retry_delay and are capped at max_retry_delay; the sender may wake up slightly late
+        attempts = process["mail_service"].attempts
+        gaps = [later - earlier for earlier, later in zip(attempts, attempts[1:])]
+        self.assertEqual(len(gaps), 4)
+        for gap, expected in zip(gaps, [0.2, 0.4, 0.5, 0.5]):
+            self.assertGreaterEqual(gap, expected - 0.02)
+            self.assertLess(gap, expected + 0.5)
+
+    def test_gives_up_after_max_attempts(self):
+        self.sink.rejects = 100
+        process = self.__start(self.sink.server_address[1], retry_delay = 0.05, max_retry_delay = 0.1, max_attempts = 3)
+        self.__enqueue(process, ["abandoned"])
+
+        self.assertTrue(wait_for(lambda: self.__get_outbox(process)[0]["status"] == "failed"))
+        message = self.__get_outbox(process)[0]
+        self.assertEqual(message["attempts"], 3)
+        self.assertIn("Try again later", message["last_error"])
+
+        # Failed messages are not attempted again
+        time.sleep(0.3)
+        self.assertEqual(len(process["mail_service"].attempts), 3)
+        self.assertEqual(self.sink.messages, 0)
+
+    def test_queued_messages_survive_restart(self):
+        # The SMTP server cannot be reached while the first process runs
+        process = self.__start(get_closed_port(), retry_delay = 0.05, max_retry_delay = 0.05)
+        self.__enqueue(process, ["survivor"])
+        self.assertTrue(wait_for(lambda: self.__get_outbox(process)[0]["attempts"] >= 1))
+        self.__stop(process)
+
+        self.assertEqual(self.sink.messages, 0)
+
+        restarted = self.__start(self.sink.server_address[1])
+        self.assertTrue(wait_for(lambda: self.__get_outbox(restarted)[0]["status"] == "sent"))
+        self.assertEqual(self.sink.messages, 1)
+        self.assertGreaterEqual(self.__get_outbox(restarted)[0]["attempts"], 2)
+
+    def test_queued_alerts_are_enqueued_by_sender(self):
+        handled = []
+
+        def handle_alerts(alerts):
+            handled.append(threading.current_thread().name)
+            self.__enqueue(process, [alert["subject"] for alert in alerts])
+
+        process = self.__start(self.sink.server_address[1], alert_handler = handle_alerts)
+
+        # Publishing workers only queue the alerts; the outbox is written from the sender thread
+        process["sender"].queue_alerts([{"subject" : "FAILING! disk1"}, {"subject" : "FAILING! disk2"}])
+
+        self.assertTrue(wait_for(lambda: [message["status"] for message in self.__get_outbox(process)] == ["sent", "sent"]))
+        self.assertEqual([message["subject"] for message in self.__get_outbox(process)], ["FAILING! disk1", "FAILING! disk2"])
+        self.assertEqual(set(handled), {"mail-sender"})
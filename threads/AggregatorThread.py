@@ -0,0 +1,100 @@
+import socketserver
+import threading
+import logging
+import hmac
+import collections
+
+from services.CollectorService import read_frame, encode_frame, PROTOCOL_VERSION
+
+LOGGER = logging.getLogger()
+
+# Number of recently applied batch ids kept to recognise batches resent after a lost acknowledgement
+RECENT_BATCHES = 10000
+
+def get_thread(address, port, handler, token = None):
+    return AggregatorThread(address, port, handler, token)
+
+# Receives snapshot batches from collectors and acknowledges each one after handler(batch) returned
+# Batches are applied one at a time; handler must only return once the batch is committed
+class AggregatorThread(threading.Thread):
+    def __init__(self, address, port, handler, token):
+        threading.Thread.__init__(self, name = "aggregator")
+        self.daemon = True
+        self.handler = handler
+        self.token = token
+        self.apply_lock = threading.Lock()
+        self.recent = collections.OrderedDict()
+        self.server = socketserver.ThreadingTCPServer((address, int(port)), self.__get_request_handler(), bind_and_activate = False)
+        self.server.daemon_threads = True
+        self.server.allow_reuse_address = True
+        self.server.server_bind()
+        self.server.server_activate()
+
+    def __check(self, batch):
+        if batch.get("version") != PROTOCOL_VERSION:
+            return "unsupported protocol version {}".format(batch.get("version"))
+        if self.token and not hmac.compare_digest(str(batch.get("token") or ""), str(self.token)):
+            return "invalid token"
+
+        return None
+
+    def __apply(self, batch):
+        with self.apply_lock:
+            if batch["id"] in self.recent:
+                LOGGER.debug("Aggregator -> Batch %s was already applied; acknowledging again", batch["id"])
+                return
+
+            self.handler(batch)
+
+            self.recent[batch["id"]] = True
+            while len(self.recent) > RECENT_BATCHES:
+                self.recent.popitem(last = False)
+
+    # Apply a batch received from peer and return the reply for the collector
+    def receive(self, batch, peer):
+        error = self.__check(batch)
+        if error is not None:
+            LOGGER.warning("Aggregator -> Rejected batch from %s: %s", peer, error)
+            return {"error" : error}
+
+        try:
+            self.__apply(batch)
+        except Exception:
+            LOGGER.exception("Aggregator -> Unexpected exception while applying batch %s from %s", batch.get("id"), peer)
+            return {"error" : "batch could not be applied"}
+
+        return {"ack" : batch["id"]}
+
+    def __get_request_handler(self):
+        aggregator = self
+
+        class BatchHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                peer = "{}:{}".format(*self.client_address[:2])
+
+                while True:
+                    try:
+                        batch = read_frame(self.rfile)
+                    except (OSError, EOFError, ValueError) as exception:
+                        LOGGER.warning("Aggregator -> Dropping connection from %s: %s", peer, exception)
+                        return
+
+                    if batch is None:
+                        return
+
+                    reply = aggregator.receive(batch, peer)
+                    self.wfile.write(encode_frame(reply))
+
+                    if "ack" not in reply:
+                        return
+
+        return BatchHandler
+
+    def run(self):
+        LOGGER.info("Aggregator -> Listening for collectors on %s:%s", *self.server.server_address[:2])
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.join()
@@ -0,0 +1,98 @@
+import contextlib
+import asyncio
+import logging
+import time
+
+from services.SmartService import get_service as get_smart_service, DeviceStandby
+from threads.WorkerPool import build_limits
+
+LOGGER = logging.getLogger()
+
+def get_engine(workers, group_limits = None, controller_limits = None, timeout = None, standby_max_age = None):
+    return AsyncEngine(workers, group_limits, controller_limits, timeout, standby_max_age)
+
+# Collects SMART reports for many drives from a single event loop
+# Jobs are a physical device and the DriveMonitor of every configured disk on it
+class AsyncEngine():
+    # Devices in standby are left alone unless one of their disks was not read for standby_max_age seconds; None always reads
+    def __init__(self, workers, group_limits, controller_limits, timeout, standby_max_age):
+        self.workers = max(int(workers), 1)
+        self.group_limits = build_limits(group_limits)
+        self.controller_limits = build_limits(controller_limits)
+        self.smart_service = get_smart_service(timeout)
+        self.timeout = timeout
+        self.standby_max_age = standby_max_age
+        self.pending = []
+        self.wait_times = []
+        self.timeouts = 0
+
+    async def __collect(self, device_location, monitors, group, controller, queued, semaphores):
+        loop = asyncio.get_running_loop()
+
+        # Group and controller slots are taken before the global slot so waiting jobs never hold a worker
+        async with contextlib.AsyncExitStack() as stack:
+            if group in semaphores["groups"]:
+                await stack.enter_async_context(semaphores["groups"][group])
+            if controller in semaphores["controllers"]:
+                await stack.enter_async_context(semaphores["controllers"][controller])
+            await stack.enter_async_context(semaphores["workers"])
+
+            self.wait_times.append(time.monotonic() - queued)
+
+            standby = self.standby_max_age is not None and all(monitor.may_skip_standby(self.standby_max_age) for monitor in monitors)
+
+            # Get SMART report; the smartctl process is killed when it exceeds its timeout
+            try:
+                smart_report = await self.smart_service.get_report_async(device_location, standby)
+            except DeviceStandby:
+                for monitor in monitors:
+                    await loop.run_in_executor(None, monitor.report_standby)
+                return
+            except asyncio.TimeoutError:
+                names = ", ".join(monitor.device["name"] for monitor in monitors)
+                LOGGER.warning("Thread %s -> smartctl did not respond within %ss; skipping drive...", names, self.timeout, extra = {"drive" : names, "phase" : "smartctl"})
+                self.timeouts += 1
+                return
+
+        # Database and alert handling is blocking, so it runs outside the event loop
+        for monitor in monitors:
+            await loop.run_in_executor(None, monitor.process, device_location, smart_report)
+
+    async def __run_all(self):
+        semaphores = {
+            "workers" : asyncio.Semaphore(self.workers),
+            "groups" : {key : asyncio.Semaphore(value) for key, value in self.group_limits.items()},
+            "controllers" : {key : asyncio.Semaphore(value) for key, value in self.controller_limits.items()}}
+
+        tasks = [self.__collect(device_location, monitors, group, controller, queued, semaphores) for device_location, monitors, group, controller, queued in self.pending]
+        results = await asyncio.gather(*tasks, return_exceptions = True)
+
+        for (device_location, monitors, group, controller, queued), result in zip(self.pending, results):
+            if isinstance(result, BaseException):
+                LOGGER.error("Thread %s -> Unexpected exception while processing drive: %r", device_location, result)
+
+    # Queue a physical device and the DriveMonitors of the disks on it for processing
+    def submit(self, device_location, monitors, group = None, controller = None):
+        group = str(group).upper() if group is not None else None
+        controller = str(controller).upper() if controller is not None else None
+        self.pending.append((device_location, monitors, group, controller, time.monotonic()))
+
+    # Process all queued drives and block until they are finished
+    def run(self):
+        started = time.monotonic()
+        jobs = len(self.pending)
+
+        asyncio.run(self.__run_all())
+
+        stats = {
+            "jobs" : jobs,
+            "workers" : min(self.workers, jobs),
+            "total_time" : time.monotonic() - started,
+            "queue_wait" : sum(self.wait_times),
+            "max_queue_wait" : max(self.wait_times) if self.wait_times else 0.0,
+            "timeouts" : self.timeouts}
+        self.pending = []
+        self.wait_times = []
+        self.timeouts = 0
+
+        return stats
@@ -0,0 +1,68 @@
+import logging
+import time
+
+from threads.DriveMonitor import STATUS_ACTIVE, STATUS_STANDBY
+
+LOGGER = logging.getLogger()
+
+STATUS_MISSING = "missing"
+
+def get_monitor(device, snapshots, lock, state, parser):
+    return CollectorMonitor(device, snapshots, lock, state, parser)
+
+# Stands in for DriveMonitor on a collector: instead of comparing and alerting, every outcome becomes a snapshot for the aggregator
+# Snapshots have the format {"uuid", "name", "group", "mount_point", "location", "status", "report", "digest"}
+# The smartctl text is only included when the report changed since the previous snapshot of the drive
+class CollectorMonitor():
+    def __init__(self, device, snapshots, lock, state, parser):
+        self.device = device
+        self.snapshots = snapshots
+        self.lock = lock
+        self.state = state
+        self.parser = parser
+        self.unchanged = False
+
+    def __add(self, status, location = None, report = None, digest = None):
+        with self.lock:
+            self.snapshots.append({
+                "uuid" : self.get_uuid(),
+                "name" : self.device["name"],
+                "group" : self.device["group"],
+                "mount_point" : self.device.get("mount_point"),
+                "location" : location,
+                "status" : status,
+                "report" : report,
+                "digest" : digest})
+
+    def get_uuid(self):
+        return self.device["uuid"].lower()
+
+    # Collectors have no database; drives count as read once they were read by this process
+    def may_skip_standby(self, max_age):
+        last_seen = self.state.get(self.get_uuid(), {}).get("last_seen")
+        return last_seen is not None and time.time() - last_seen < max_age
+
+    def report_standby(self):
+        LOGGER.info("Thread %s -> Drive is in standby; keeping previously stored values...", self.device["name"], extra = {"drive" : self.device["name"], "phase" : "standby"})
+        self.__add(STATUS_STANDBY)
+
+    def report_missing(self, device_location):
+        LOGGER.warning("Thread %s -> Drive location cannot be found using the following path: %s", self.device["name"], device_location, extra = {"drive" : self.device["name"], "phase" : "discovery"})
+        self.__add(STATUS_MISSING, device_location)
+
+    def process(self, device_location, smart_report):
+        uuid = self.get_uuid()
+        report = dict(smart_report)
+
+        # Text reports are parsed here so the aggregator only receives attribute rows
+        if report["attributes"] is None:
+            report["attributes"] = self.parser.parse(report["report"])["rows"]
+
+        digest = self.parser.digest(report)
+        self.unchanged = self.state.get(uuid, {}).get("report_digest") == digest
+        if self.unchanged:
+            report["information"] = None
+            report["report"] = None
+
+        self.__add(STATUS_ACTIVE, device_location, report, digest)
+        self.state[uuid] = {"last_seen" : time.time(), "report_digest" : digest}
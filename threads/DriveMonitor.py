@@ -0,0 +1,344 @@
+import logging
+import hashlib
+import time
+
+from distutils.util import strtobool
+from services.AttributeParser import get_parser as get_attribute_parser
+from services.RenderService import get_renderer
+from services.MetricsService import get_histogram
+from services.ProfileService import timer as phase_timer, record as record_phase
+from services.ScheduleService import HEALTH_FAILING, HEALTH_DEGRADING, HEALTH_CHANGED, HEALTH_STATIC
+
+LOGGER = logging.getLogger()
+FINE_DEBUG = 5
+
+FAILING_NOW = 0
+UPDATED_VALUE = 1
+EXCEEDS_THRESHOLD = 2
+REPORT = 3
+DATABASE = 4
+THRESHOLDS = 5
+
+STATUS_ACTIVE = "active"
+STATUS_STANDBY = "skipped: standby"
+
+SEVERITY_FAILING = "FAILING"
+SEVERITY_WARNING = "WARNING"
+SEVERITY_MISSING = "MISSING"
+SEVERITY_INITIAL = "INITIAL"
+
+# Digest of a report without any watched or failing attribute
+EMPTY_DIGEST = hashlib.sha1().hexdigest()
+
+PARSE_SECONDS = get_histogram("smart_monitor_parse_seconds", "Time taken to digest and parse a SMART report")
+
+def get_monitor(device, smart, writes, events, thresholds = None, state = None, parser = None):
+    return DriveMonitor(device, smart, writes, events, thresholds, state, parser)
+
+# Holds the compare, update and alert logic for a drive; shared by every collection engine
+class DriveMonitor():
+    # Database rows are not written here; they are put on the writes queue (the database writer thread) and committed in batches
+    # State holds the stored attributes of every known drive ({uuid : {column : value}}) and is kept up to date
+    # Alerts are published on events (an EventBus) and mailed by whoever drains or subscribes to it
+    def __init__(self, device, smart, writes, events, thresholds = None, state = None, parser = None):
+        self.device = device
+        self.smart = smart
+        self.writes = writes
+        self.events = events
+        self.thresholds = thresholds
+        self.state = state if state is not None else {}
+        self.parser = parser if parser is not None else get_attribute_parser(smart)
+        self.unchanged = False
+        self.health = None
+
+    # Log with the drive name prefixed and the drive and phase attached for structured log formats
+    # Arguments are only formatted once a handler accepts the record
+    def __log(self, level, phase, message, *args):
+        LOGGER.log(level, "Thread %s -> " + message, self.device["name"], *args, extra = {"drive" : self.device["name"], "phase" : phase})
+
+    def __to_bool(self, value):
+        return value if isinstance(value, bool) else strtobool(value)
+
+    def __update_needed(self, database_attributes, report_attributes):
+        # Compare report values to database
+        for key in report_attributes:
+            if int(report_attributes[key]) > int(database_attributes[key]):
+                return True
+
+        return False
+
+    def __get_thresholds(self):
+        # Use thresholds parsed ahead of time when provided
+        if self.thresholds is not None:
+            return self.thresholds
+
+        # Build list of thresholds from configuration file
+        thresholds = {}
+
+        for attribute in self.smart["attributes"]:
+            for key in attribute.keys():
+                thresholds[key] = attribute[key]["threshold"]
+
+        return thresholds
+
+    def __message_needed(self, report_attributes, thresholds):
+        # Compare report values to thresholds
+        for key in report_attributes:
+            if int(report_attributes[key]) > int(thresholds[key]):
+                return True
+
+        return False
+
+    def __get_database_attributes(self, uuid, watched_attributes):
+        # Drives missing from the state do not exist in the database yet
+        if uuid not in self.state:
+            return None
+
+        # Columns added after a drive was stored are NULL until the drive is next updated
+        return {key : self.state[uuid].get(key) or 0 for key in watched_attributes}
+
+    def __get_health(self, watched_attributes, database_attributes, thresholds, failing_attributes):
+        if len(failing_attributes) > 0:
+            return HEALTH_FAILING
+        if self.__message_needed({key : value for key, value in watched_attributes.items() if key in thresholds}, thresholds):
+            return HEALTH_DEGRADING
+        if database_attributes is not None and self.__update_needed(database_attributes, watched_attributes):
+            return HEALTH_CHANGED
+
+        return HEALTH_STATIC
+
+    def __write(self, uuid, attributes, update = True, status = STATUS_ACTIVE, report_digest = None, model = None, health = None):
+        # Every processed drive is queued for the attribute history; update marks drives whose row must be written
+        # Drives that were skipped keep their stored values, last_seen time, report digest and health; only their status changes
+        now = time.time()
+        last_seen = now if status == STATUS_ACTIVE else None
+        self.writes.put({
+            "uuid" : uuid,
+            "name" : self.device["name"],
+            "group" : self.device["group"],
+            "attributes" : attributes,
+            "update" : update,
+            "status" : status,
+            "last_seen" : last_seen,
+            "report_digest" : report_digest,
+            "model" : model,
+            "health" : health,
+            "timestamp" : int(now)})
+
+        if update:
+            self.state[uuid] = dict(self.state.get(uuid, {}), **attributes)
+        if last_seen is not None and uuid in self.state:
+            self.state[uuid]["last_seen"] = last_seen
+        if report_digest is not None and uuid in self.state:
+            self.state[uuid]["report_digest"] = report_digest
+        # Stored with the drive so reads that take the fast path, also after a restart, know whether the drive was failing or degrading
+        if health is not None and uuid in self.state:
+            self.state[uuid]["health"] = health
+
+    def __get_fingerprint(self, *parts):
+        # Identifies the condition an alert is about so an unchanged condition is only mailed once
+        return hashlib.sha1("|".join(str(part) for part in (self.get_uuid(),) + parts).encode()).hexdigest()
+
+    # The smartctl dump is kept apart from the sections so digests can attach it instead of pasting it inline
+    # Both stay unrendered until the alert is mailed, so alerts that are suppressed or dropped cost no formatting
+    def __send_message(self, subject, sections, severity, fingerprint, report = None):
+        self.__log(FINE_DEBUG, "queue_message", "Publishing %s alert...", severity)
+        self.__log(FINE_DEBUG, "queue_message", "Subject:\n%s", subject)
+        if LOGGER.isEnabledFor(FINE_DEBUG):
+            self.__log(FINE_DEBUG, "queue_message", "\n%s", get_renderer().render_sections(sections))
+
+        with phase_timer("queue_message", self.device["name"]):
+            self.events.publish({
+                "subject" : subject,
+                "sections" : sections,
+                "report" : report,
+                "severity" : severity,
+                "fingerprint" : fingerprint,
+                "uuid" : self.get_uuid(),
+                "name" : self.device["name"],
+                "group" : self.device["group"]})
+
+    def __get_report(self, device_location, information, report):
+        return {"information" : information, "device_location" : device_location, "mount_point" : self.device["mount_point"], "output" : report}
+
+    # Table of attributes with their current value, the stored value when previous is set and the configured threshold
+    def __get_table(self, title, attributes, organized_attributes, previous = False):
+        database_attributes = organized_attributes[DATABASE]
+        threshold_attributes = organized_attributes[THRESHOLDS]
+
+        columns = ["ATTRIBUTE_NAME", "CURRENT_VALUE"] + (["PREVIOUS_VALUE"] if previous else []) + ["CONFIGURED_THRESHOLD"]
+        rows = []
+        for key in attributes:
+            row = [key, attributes[key]]
+            if previous:
+                row.append(database_attributes[key] if key in database_attributes else "-")
+            row.append(threshold_attributes[key] if key in threshold_attributes else "-")
+            rows.append(row)
+
+        return {"title" : title, "columns" : columns, "rows" : rows}
+
+    def __send_initial_report(self, device_location, information, report, organized_attributes):
+        subject = "INITIAL REPORT! SMART Monitor Report: {}".format(self.device["name"])
+        severity = SEVERITY_INITIAL
+
+        if len(organized_attributes[EXCEEDS_THRESHOLD]) > 0:
+            subject = "WARNING! INITIAL REPORT! SMART Monitor Report: {}".format(self.device["name"])
+            severity = SEVERITY_WARNING
+        if len(organized_attributes[FAILING_NOW]) > 0:
+            subject = "FAILING! INITIAL REPORT! SMART Monitor Report: {}".format(self.device["name"])
+            severity = SEVERITY_FAILING
+
+        sections = []
+        if len(organized_attributes[FAILING_NOW]) > 0:
+            sections.append(self.__get_table("The following attributes are currently marked as FAILING_NOW:", organized_attributes[FAILING_NOW], organized_attributes))
+        if len(organized_attributes[EXCEEDS_THRESHOLD]) > 0:
+            sections.append(self.__get_table("The following attributes currently exceed their configured threshold:", organized_attributes[EXCEEDS_THRESHOLD], organized_attributes))
+        if len(organized_attributes[REPORT]) > 0:
+            sections.append(self.__get_table("The following attributes are being monitored and will generate a report whenever their value changes and the new value exceeds their configured threshold:", organized_attributes[REPORT], organized_attributes))
+
+        self.__send_message(subject, sections, severity, self.__get_fingerprint("initial"), self.__get_report(device_location, information, report))
+
+    def __send_update_report(self, device_location, information, report, organized_attributes):
+        subject = "WARNING! SMART Monitor Report: {}".format(self.device["name"])
+        severity = SEVERITY_WARNING
+
+        if len(organized_attributes[FAILING_NOW]) > 0:
+            subject = "FAILING! SMART Monitor Report: {}".format(self.device["name"])
+            severity = SEVERITY_FAILING
+
+        sections = []
+        if len(organized_attributes[FAILING_NOW]) > 0:
+            sections.append(self.__get_table("The following attributes are currently marked as FAILING_NOW:", organized_attributes[FAILING_NOW], organized_attributes, True))
+        if len(organized_attributes[UPDATED_VALUE]) > 0:
+            sections.append(self.__get_table("After comparing against their previously stored value, it has been determinted that the following attributes have changed/been updated:", organized_attributes[UPDATED_VALUE], organized_attributes, True))
+        if len(organized_attributes[EXCEEDS_THRESHOLD]) > 0:
+            sections.append(self.__get_table("The following attributes currently exceed their configured threshold:", organized_attributes[EXCEEDS_THRESHOLD], organized_attributes, True))
+
+        fingerprint = self.__get_fingerprint(severity, sorted(organized_attributes[REPORT].items()), sorted(organized_attributes[FAILING_NOW]))
+        self.__send_message(subject, sections, severity, fingerprint, self.__get_report(device_location, information, report))
+
+    def __send_missing_drive_report(self, device_location):
+        subject = "ISSUE! Missing Drive Report: {}".format(self.device["name"])
+
+        sections = [
+            {"title" : "Device could not be found using the following UUID path: {}".format(device_location)},
+            {"title" : "The following list are possibly reasons this event may have occurred:", "items" : [
+                "UUID was not properly listed in configuration file. Please check the configuration file to guarantee the UUID for this device is correct.",
+                "Device has been ejected from machine, therefore it is no longer accessibly. This may have occurred through an user manually ejecting the device or the machine no longer recognizes the device because something is wrong with either the machine or the device hardware.",
+                "Per Python documentation, the os.path.exists() function may not have permission to execute an os.stat() call on the requested path."]}]
+
+        self.__send_message(subject, sections, SEVERITY_MISSING, self.__get_fingerprint("missing"))
+
+    def __organize_attributes(self, watched_attributes, database_attributes, threshold_attributes, failing_attributes):
+        updated_attributes = {}
+        exceeded_attributes = {}
+
+        for key in watched_attributes:
+            if key in database_attributes and int(watched_attributes[key]) > int(database_attributes[key]):
+                updated_attributes[key] = watched_attributes[key]
+
+            if key in threshold_attributes and int(watched_attributes[key]) > int(threshold_attributes[key]):
+                exceeded_attributes[key] = watched_attributes[key]
+
+        return {FAILING_NOW : failing_attributes, UPDATED_VALUE : updated_attributes, EXCEEDS_THRESHOLD : exceeded_attributes, REPORT : watched_attributes, DATABASE : database_attributes, THRESHOLDS : threshold_attributes}
+
+    def get_uuid(self):
+        return self.device["uuid"].lower()
+
+    # A drive may be left in standby when it was fully read within max_age seconds; new drives are always read
+    def may_skip_standby(self, max_age):
+        last_seen = self.state.get(self.get_uuid(), {}).get("last_seen")
+        return last_seen is not None and time.time() - last_seen < max_age
+
+    # Only the status of a skipped drive changes; it gets no history sample and last_seen stays at its last full read,
+    # which is what may_skip_standby() counts max_age from
+    def report_standby(self):
+        self.__log(logging.INFO, "standby", "Drive is in standby; keeping previously stored values...")
+        self.__write(self.get_uuid(), {}, update = False, status = STATUS_STANDBY)
+
+    def report_missing(self, device_location):
+        self.__log(logging.WARNING, "discovery", "Drive location cannot be found using the following path: %s; adding message to queue...", device_location)
+
+        # Add message to queue for later processing
+        self.__send_missing_drive_report(device_location)
+
+    # Compare a collected SMART report against the database, update the drive and queue alerts
+    # Sets unchanged when the report matched the stored digest and the drive took the fast path
+    # Sets health to one of the ScheduleService HEALTH_ values; it stays None for drives that are new, unreadable, in standby or missing
+    def process(self, device_location, smart_report):
+        uuid = self.get_uuid()
+        started = time.monotonic()
+        report_digest = self.parser.digest(smart_report)
+        model = smart_report["identity"].get("model")
+        self.unchanged = False
+
+        # Nothing a decision depends on changed since the last read; only record that the drive was seen
+        # Failing and degrading drives stay so until a read shows otherwise, anything else counts as static
+        # Reports without any watched or failing attribute all share one digest and are checked in full below
+        if uuid in self.state and self.state[uuid].get("report_digest") == report_digest and report_digest != EMPTY_DIGEST:
+            PARSE_SECONDS.observe(time.monotonic() - started)
+            record_phase("parse", time.monotonic() - started, self.device["name"])
+            self.__log(logging.DEBUG, "compare", "Drive report unchanged since last read; skipping comparison...")
+            self.__write(uuid, {}, update = False, report_digest = report_digest, model = model)
+            self.health = self.state[uuid].get("health") if self.state[uuid].get("health") in (HEALTH_FAILING, HEALTH_DEGRADING) else HEALTH_STATIC
+            self.unchanged = True
+            return
+
+        information = smart_report["information"]
+        report = smart_report["report"]
+
+        # Use structured attributes when available; otherwise parse the text report
+        if smart_report["attributes"] is not None:
+            attributes = self.parser.select(smart_report["attributes"])
+        else:
+            attributes = self.parser.parse(report)
+        PARSE_SECONDS.observe(time.monotonic() - started)
+        record_phase("parse", time.monotonic() - started, self.device["name"])
+
+        # Devices that could not be opened return no attribute table; there is nothing to store or compare
+        if not attributes["rows"]:
+            self.__log(logging.WARNING, "compare", "Drive report contains no SMART attributes; skipping drive...")
+            return
+
+        watched_attributes = attributes["watched"]
+        failing_attributes = attributes["failing"]
+        thresholds = self.__get_thresholds()
+
+        # Get drive's database stats
+        database_attributes = self.__get_database_attributes(uuid, watched_attributes)
+        health = self.__get_health(watched_attributes, database_attributes, thresholds, failing_attributes)
+        if database_attributes is not None or health in (HEALTH_FAILING, HEALTH_DEGRADING):
+            self.health = health
+
+        # Check if entry already exists for drive in database
+        if database_attributes is not None:
+            self.__log(logging.DEBUG, "compare", "Drive currently exists in database; checking if drive needs updating...")
+
+            # Check if update to database is needed
+            if self.__update_needed(database_attributes, watched_attributes):
+                self.__log(logging.DEBUG, "compare", "Drive report attributes differ from database; updating database entry for drive...")
+
+                #Update database entry for drive
+                self.__write(uuid, watched_attributes, report_digest = report_digest, model = model, health = health)
+
+                # Check if email to admin is needed
+                if self.__to_bool(self.smart["report_values"]) and self.__to_bool(self.smart["report_updated_values"]) and self.__message_needed(watched_attributes, thresholds):
+                    self.__log(logging.DEBUG, "compare", "Mail requested by admin for updated values of drive; adding message to queue...")
+
+                    # Add message to queue for later processing
+                    self.__send_update_report(device_location, information, report, self.__organize_attributes(watched_attributes, database_attributes, thresholds, failing_attributes))
+            else:
+                # Drive row stays unchanged; values are still recorded in the attribute history
+                self.__write(uuid, watched_attributes, update = False, report_digest = report_digest, model = model, health = health)
+        else:
+            self.__log(logging.DEBUG, "compare", "Drive does not currently exist in database; adding drive to database...")
+
+            # Insert new entry for drive since it doesn't currently exist in database
+            self.__write(uuid, watched_attributes, report_digest = report_digest, model = model, health = health)
+
+            # Check if email with initally values for drive is wanted
+            if self.__to_bool(self.smart["report_values"]) and self.__to_bool(self.smart["report_initial_values"]):
+                self.__log(logging.DEBUG, "compare", "Mail requested by admin for initial values of drive; adding message to queue...")
+
+                # Add message to queue for later processing
+                self.__send_initial_report(device_location, information, report, self.__organize_attributes(watched_attributes, {}, thresholds, failing_attributes))
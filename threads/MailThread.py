@@ -0,0 +1,160 @@
+import threading
+import logging
+import smtplib
+import time
+
+from queue import SimpleQueue, Empty
+from services.OutboxService import get_service as get_outbox_service
+from services.ProfileService import timer as phase_timer
+
+LOGGER = logging.getLogger()
+
+IDLE_INTERVAL = 60
+BATCH_SIZE = 50
+SENT_RETENTION = 30 * 86400
+
+def get_thread(database, writer, mail_service, retry_delay = 30, max_retry_delay = 3600, max_attempts = 20, alert_handler = None):
+    return MailThread(database, writer, mail_service, retry_delay, max_retry_delay, max_attempts, alert_handler)
+
+# Delivers mail from the outbox in the background over one reused SMTP connection
+# Failed messages are retried with exponential backoff; outbox updates go through the database writer thread
+# Alerts passed to queue_alerts() are handed to alert_handler(alerts) in batches on this thread, which puts their mail in the outbox
+class MailThread(threading.Thread):
+    def __init__(self, database, writer, mail_service, retry_delay, max_retry_delay, max_attempts, alert_handler):
+        threading.Thread.__init__(self, name = "mail-sender")
+        self.daemon = True
+        self.database = database
+        self.writer = writer
+        self.mail_service = mail_service
+        self.retry_delay = float(retry_delay)
+        self.max_retry_delay = float(max_retry_delay)
+        self.max_attempts = int(max_attempts or 0)
+        self.alert_handler = alert_handler
+        self.alerts = SimpleQueue()
+        self.pending_alerts = []
+        self.wake = threading.Event()
+        self.idle = threading.Event()
+        self.stopping = threading.Event()
+        self.idle_lock = threading.Lock()
+        self.backoff_until = 0.0
+
+    def __set_idle(self):
+        # Mail queued while the outbox was being read is still pending, so only report idle when not woken since
+        with self.idle_lock:
+            if not self.wake.is_set():
+                self.idle.set()
+
+    def __get_retry_delay(self, attempts):
+        return min(self.retry_delay * (2 ** (attempts - 1)), self.max_retry_delay)
+
+    def __handle_alerts(self):
+        while True:
+            try:
+                self.pending_alerts.append(self.alerts.get_nowait())
+            except Empty:
+                break
+
+        # Alerts stay pending when the handler fails and are handed over again on the next wake up
+        if self.pending_alerts and self.alert_handler is not None:
+            self.alert_handler(self.pending_alerts)
+            self.pending_alerts = []
+
+    def __send_due(self):
+        now = time.time()
+
+        # Stay away from the SMTP server after a failure until the backoff passes
+        if now < self.backoff_until:
+            self.__set_idle()
+            return self.backoff_until - now
+
+        with self.database.connect() as connection:
+            outbox_service = get_outbox_service(connection)
+            due = outbox_service.get_due(now, BATCH_SIZE)
+            next_attempt = outbox_service.get_next_attempt() if not due else None
+
+        if not due:
+            # Nothing left to send right now; release the connection until there is
+            self.mail_service.close()
+            self.__set_idle()
+            return max(next_attempt - now, 0.1) if next_attempt else IDLE_INTERVAL
+
+        updates = []
+        for message in due:
+            if self.stopping.is_set():
+                break
+
+            attempts = message["attempts"] + 1
+            try:
+                with phase_timer("mail_delivery"):
+                    self.mail_service.deliver(message["sender"], message["destination"], message["subject"], message["body"], message["attachments"], message["subtype"])
+            except (smtplib.SMTPException, OSError) as exception:
+                delay = self.__get_retry_delay(attempts)
+                give_up = self.max_attempts and attempts >= self.max_attempts
+
+                if isinstance(exception, smtplib.SMTPAuthenticationError):
+                    LOGGER.error("Issue with login to SMTP server -> Authentication to SMTP server failed. Please check your username and password.")
+                if give_up:
+                    LOGGER.error("Mail -> Giving up on message '%s' after %s attempts: %s", message["subject"], attempts, exception)
+                else:
+                    LOGGER.warning("Mail -> Unable to send message '%s' (attempt %s): %s; retrying in %.0fs...", message["subject"], attempts, exception, delay)
+
+                updates.append(lambda outbox_service, message = message, attempts = attempts, delay = delay, error = str(exception), give_up = give_up:
+                    outbox_service.mark_failed(message["id"], attempts, time.time() + delay, error, give_up))
+                self.backoff_until = time.time() + delay
+                break
+
+            delivered = time.time()
+            LOGGER.debug("Mail -> Delivered message '%s' after %s attempts (latency: %.1fs)", message["subject"], attempts, delivered - message["created"])
+            updates.append(lambda outbox_service, message = message, attempts = attempts, delivered = delivered:
+                outbox_service.mark_sent(message["id"], attempts, delivered))
+
+        # Record the outcome of the whole batch in one transaction
+        self.writer.execute(lambda connection: [update(get_outbox_service(connection)) for update in updates])
+
+        return 0
+
+    def run(self):
+        self.writer.put(lambda connection: get_outbox_service(connection).purge_sent(time.time() - SENT_RETENTION))
+
+        while not self.stopping.is_set():
+            try:
+                self.__handle_alerts()
+                delay = self.__send_due()
+            except Exception:
+                LOGGER.exception("Mail -> Unexpected exception while sending mail from outbox")
+                delay = IDLE_INTERVAL
+
+            if delay > 0:
+                self.wake.wait(delay)
+                self.wake.clear()
+
+        # Alerts queued while stopping are still put in the outbox; they are delivered by the next run
+        try:
+            self.__handle_alerts()
+        except Exception:
+            LOGGER.exception("Mail -> Unexpected exception while queueing %s alerts in outbox", len(self.pending_alerts))
+
+        self.mail_service.close()
+
+    # Wake the sender after new mail was added to the outbox
+    def notify(self):
+        with self.idle_lock:
+            self.idle.clear()
+            self.wake.set()
+
+    # Queue alerts to be put in the outbox by this thread; safe to call from any thread and never blocks
+    def queue_alerts(self, alerts):
+        for alert in alerts:
+            self.alerts.put(alert)
+
+        self.notify()
+
+    # Wait until nothing in the outbox is due anymore (or its retry is backing off); returns False on timeout
+    def drain(self, timeout):
+        self.notify()
+        return self.idle.wait(timeout)
+
+    def stop(self):
+        self.stopping.set()
+        self.wake.set()
+        self.join()
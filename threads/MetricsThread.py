@@ -0,0 +1,76 @@
+import threading
+import logging
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from services.MetricsService import render, CONTENT_TYPE
+
+LOGGER = logging.getLogger()
+
+def get_thread(address = "127.0.0.1", port = 9633):
+    return MetricsThread(address, port)
+
+# Serves OpenMetrics text over HTTP
+# Responses come from a cache rebuilt at the end of every run, so a scrape never calls smartctl or queries the database
+class MetricsThread(threading.Thread):
+    def __init__(self, address, port):
+        threading.Thread.__init__(self, name = "metrics-exporter")
+        self.daemon = True
+        self.drives = {}
+        self.drives_lock = threading.Lock()
+        self.gauges = {}
+        self.body = render([], {}).encode()
+        self.server = ThreadingHTTPServer((address, int(port)), self.__get_handler())
+        self.server.daemon_threads = True
+
+    def __get_handler(self):
+        exporter = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+
+                # The cached body is replaced as a whole, so reading the reference needs no lock
+                body = exporter.body
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                LOGGER.debug("Metrics -> %s %s", self.address_string(), format % args)
+
+        return MetricsHandler
+
+    # Drives have the format expected by MetricsService.render and are merged with those of earlier runs by uuid
+    # Gauges have the following format: {name : (description, value)}
+    def update(self, drives, gauges):
+        with self.drives_lock:
+            for drive in drives:
+                self.drives[drive["uuid"]] = drive
+
+            self.gauges = gauges
+            body = render(sorted(self.drives.values(), key = lambda drive: (drive["group"], drive["name"])), gauges)
+
+        self.body = body.encode()
+
+    # Drop drives that are no longer configured; the gauges of the last update are kept
+    def remove(self, uuids):
+        with self.drives_lock:
+            for uuid in uuids:
+                self.drives.pop(uuid, None)
+
+            body = render(sorted(self.drives.values(), key = lambda drive: (drive["group"], drive["name"])), self.gauges)
+
+        self.body = body.encode()
+
+    def run(self):
+        LOGGER.info("Metrics -> Serving metrics on http://%s:%s/metrics", *self.server.server_address[:2])
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.join()
@@ -0,0 +1,194 @@
+import threading
+import hashlib
+import logging
+import time
+
+from services.SmartService import get_service as get_smart_service
+from services.SelfTestService import get_service as get_self_test_service, RUNNING, COMPLETED, REJECTED
+
+LOGGER = logging.getLogger()
+
+SEVERITY_FAILING = "FAILING"
+
+def get_thread(database, writer, get_drives, alert, settings):
+    return SelfTestThread(database, writer, get_drives, alert, settings)
+
+# Starts SMART self-tests in the background and records their results
+# Tests run in the drives' firmware; this thread only starts them and checks their progress every poll interval, so nothing waits on a test
+# get_drives() returns the drives that may be tested ([{"uuid", "name", "group", "mount_point", "location"}], one per physical device)
+# alert(messages) queues alerts for failed tests; messages have the format published by DriveMonitor
+# Settings have the format {"intervals" : {type : seconds}, "max_concurrent" : int, "max_group_concurrent" : int, "groups" : {GROUP : int},
+# "window" : (start minute, end minute) or None, "poll_interval" : seconds, "timeout" : seconds}
+class SelfTestThread(threading.Thread):
+    def __init__(self, database, writer, get_drives, alert, settings):
+        threading.Thread.__init__(self, name = "self-tests")
+        self.daemon = True
+        self.database = database
+        self.writer = writer
+        self.get_drives = get_drives
+        self.alert = alert
+        self.settings = settings
+        self.smart = get_smart_service(settings["timeout"])
+        self.stopping = threading.Event()
+
+    def __in_window(self, now):
+        if self.settings["window"] is None:
+            return True
+
+        # Minutes since local midnight; a window that ends before it starts spans midnight
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        start, end = self.settings["window"]
+        if start <= end:
+            return start <= minute < end
+
+        return minute >= start or minute < end
+
+    def __get_due(self, drive, test, now):
+        # Long tests are started before short ones; a drive runs at most one test at a time
+        for test_type in ("long", "short"):
+            interval = self.settings["intervals"].get(test_type)
+            if not interval:
+                continue
+
+            last = test.get("last_" + test_type) or 0
+            if now - last >= interval:
+                return test_type, now - last - interval
+
+        return None, None
+
+    def __get_message(self, drive, test, entry, output):
+        subject = "FAILING! SMART Self-Test Report: {}".format(drive["name"])
+
+        sections = [{"title" : "A {} self-test of this drive did not complete successfully:".format(test["test_type"]), "fields" : [
+            ["Result", entry["status"]],
+            ["Remaining", "{}%".format(entry["remaining_percent"])],
+            ["Lifetime hours", entry["lifetime_hours"] if entry["lifetime_hours"] is not None else "-"],
+            ["Device Location", drive["location"]],
+            ["Mount Location", drive.get("mount_point")]]}]
+
+        # Every failed test is its own condition, so a later failure is mailed even while an earlier one is remembered
+        fingerprint = hashlib.sha1("|".join(str(part) for part in (drive["uuid"], "self-test", test["test_type"], test["started"], entry["lifetime_hours"])).encode()).hexdigest()
+
+        return {
+            "subject" : subject,
+            "sections" : sections,
+            "report" : {"output" : output},
+            "severity" : SEVERITY_FAILING,
+            "fingerprint" : fingerprint,
+            "uuid" : drive["uuid"],
+            "name" : drive["name"],
+            "group" : drive["group"]}
+
+    # Check the progress of running tests; returns the alerts for tests that failed
+    def __check_running(self, drives, tests, changed, now):
+        messages = []
+
+        for uuid, test in tests.items():
+            if test["status"] != RUNNING or uuid not in drives:
+                continue
+
+            drive = drives[uuid]
+            try:
+                status = self.smart.get_self_test_status(drive["location"])
+            except Exception as exception:
+                LOGGER.warning("Self-test -> Unable to read self-test status of %s: %s", drive["name"], exception, extra = {"drive" : drive["name"], "phase" : "self_test"})
+                continue
+
+            if status["running"]:
+                test["remaining_percent"] = status["remaining_percent"]
+                changed.append(test)
+                continue
+
+            entry = status["log"][0] if status["log"] else None
+            test["status"] = COMPLETED
+            test["completed"] = now
+            test["result"] = entry["status"] if entry else None
+            test["passed"] = entry["passed"] if entry else None
+            test["remaining_percent"] = entry["remaining_percent"] if entry else None
+            test["lifetime_hours"] = entry["lifetime_hours"] if entry else None
+            changed.append(test)
+
+            if entry is not None and not entry["passed"]:
+                LOGGER.warning("Self-test -> %s self-test of %s failed: %s", test["test_type"], drive["name"], entry["status"], extra = {"drive" : drive["name"], "phase" : "self_test"})
+                messages.append(self.__get_message(drive, test, entry, status["output"]))
+            else:
+                LOGGER.info("Self-test -> %s self-test of %s finished: %s", test["test_type"], drive["name"], test["result"] or "no log entry", extra = {"drive" : drive["name"], "phase" : "self_test"})
+
+        return messages
+
+    # Start due tests, most overdue first, without exceeding the global and per-group limits
+    def __start_due(self, drives, tests, changed, now):
+        running = [uuid for uuid, test in tests.items() if test["status"] == RUNNING and uuid in drives]
+        per_group = {}
+        for uuid in running:
+            per_group[drives[uuid]["group"]] = per_group.get(drives[uuid]["group"], 0) + 1
+
+        candidates = []
+        for uuid, drive in drives.items():
+            test = tests.get(uuid) or {}
+            if test.get("status") == RUNNING:
+                continue
+
+            test_type, overdue = self.__get_due(drive, test, now)
+            if test_type is not None:
+                candidates.append((-overdue, drive["name"], uuid, test_type))
+
+        for _, name, uuid, test_type in sorted(candidates):
+            drive = drives[uuid]
+            group = drive["group"]
+            if len(running) >= self.settings["max_concurrent"]:
+                break
+            if per_group.get(group, 0) >= self.settings["groups"].get(group, self.settings["max_group_concurrent"]):
+                continue
+
+            test = tests.setdefault(uuid, {"uuid" : uuid})
+            test.update({"name" : drive["name"], "test_type" : test_type, "started" : now, "completed" : None, "result" : None, "passed" : None, "remaining_percent" : None})
+            test["last_" + test_type] = now
+
+            try:
+                started = self.smart.start_self_test(drive["location"], test_type)
+            except Exception as exception:
+                # Drives that cannot run self-tests are retried once the interval passed again rather than on every poll
+                LOGGER.warning("Self-test -> Unable to start %s self-test of %s: %s", test_type, drive["name"], exception, extra = {"drive" : drive["name"], "phase" : "self_test"})
+                test["status"] = REJECTED
+                test["result"] = str(exception)
+                changed.append(test)
+                continue
+
+            # A test started elsewhere is followed like our own so its result is recorded as well
+            LOGGER.info("Self-test -> %s %s self-test of %s", "Started" if started else "Following running", test_type, drive["name"], extra = {"drive" : drive["name"], "phase" : "self_test"})
+            test["status"] = RUNNING
+            changed.append(test)
+            running.append(uuid)
+            per_group[group] = per_group.get(group, 0) + 1
+
+    def __cycle(self):
+        now = time.time()
+        drives = {drive["uuid"] : drive for drive in self.get_drives()}
+
+        with self.database.connect() as connection:
+            tests = get_self_test_service(connection).get_tests(drives.keys())
+
+        changed = []
+        messages = self.__check_running(drives, tests, changed, now)
+        if self.__in_window(now):
+            self.__start_due(drives, tests, changed, now)
+
+        if changed:
+            self.writer.execute(lambda connection: get_self_test_service(connection).save(changed))
+        if messages:
+            self.alert(messages)
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                self.__cycle()
+            except Exception:
+                LOGGER.exception("Self-test -> Unexpected exception while scheduling self-tests")
+
+            self.stopping.wait(self.settings["poll_interval"])
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
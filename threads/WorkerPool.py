@@ -0,0 +1,108 @@
+import threading
+import logging
+import time
+
+LOGGER = logging.getLogger()
+
+def get_pool(workers, group_limits = None, controller_limits = None):
+    return WorkerPool(workers, group_limits, controller_limits)
+
+# Normalize configured group or controller limits; missing or non-positive limits mean no cap
+# Shared by the thread pool and the asyncio engine so both read scheduler.groups and scheduler.controllers alike
+def build_limits(limits):
+    normalized = {}
+
+    for key, value in (limits or {}).items():
+        if value is not None and int(value) > 0:
+            normalized[str(key).upper()] = int(value)
+
+    return normalized
+
+class WorkerPool():
+    def __init__(self, workers, group_limits, controller_limits):
+        self.workers = max(int(workers), 1)
+        self.group_limits = build_limits(group_limits)
+        self.controller_limits = build_limits(controller_limits)
+        self.condition = threading.Condition()
+        self.pending = []
+        self.group_counts = {}
+        self.controller_counts = {}
+        self.wait_times = []
+
+    def __is_eligible(self, group, controller):
+        if group in self.group_limits and self.group_counts.get(group, 0) >= self.group_limits[group]:
+            return False
+
+        if controller in self.controller_limits and self.controller_counts.get(controller, 0) >= self.controller_limits[controller]:
+            return False
+
+        return True
+
+    def __next_job(self):
+        # Take the first pending job whose group and controller both have capacity left
+        with self.condition:
+            while self.pending:
+                for i, (job, group, controller, queued) in enumerate(self.pending):
+                    if self.__is_eligible(group, controller):
+                        del self.pending[i]
+                        self.group_counts[group] = self.group_counts.get(group, 0) + 1
+                        self.controller_counts[controller] = self.controller_counts.get(controller, 0) + 1
+                        self.wait_times.append(time.monotonic() - queued)
+                        return job, group, controller
+
+                self.condition.wait()
+
+        return None
+
+    def __release(self, group, controller):
+        with self.condition:
+            self.group_counts[group] -= 1
+            self.controller_counts[controller] -= 1
+            self.condition.notify_all()
+
+    def __work(self):
+        while True:
+            entry = self.__next_job()
+            if entry is None:
+                return
+
+            job, group, controller = entry
+            try:
+                job.run()
+            except Exception:
+                LOGGER.exception("Pool -> Unexpected exception while processing job for group %s", group)
+            finally:
+                self.__release(group, controller)
+
+    # Queue a job for processing; the job only needs to provide a run() method
+    def submit(self, job, group = None, controller = None):
+        group = str(group).upper() if group is not None else None
+        controller = str(controller).upper() if controller is not None else None
+
+        with self.condition:
+            self.pending.append((job, group, controller, time.monotonic()))
+            self.condition.notify_all()
+
+    # Process all queued jobs and block until they are finished
+    def run(self):
+        started = time.monotonic()
+        jobs = len(self.pending)
+        workers = []
+
+        for i in range(min(self.workers, jobs)):
+            worker = threading.Thread(target = self.__work, name = "worker-{}".format(i))
+            workers.append(worker)
+            worker.start()
+
+        for worker in workers:
+            worker.join()
+
+        stats = {
+            "jobs" : jobs,
+            "workers" : len(workers),
+            "total_time" : time.monotonic() - started,
+            "queue_wait" : sum(self.wait_times),
+            "max_queue_wait" : max(self.wait_times) if self.wait_times else 0.0}
+        self.wait_times = []
+
+        return stats
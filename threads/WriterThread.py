@@ -0,0 +1,167 @@
+import threading
+import logging
+import time
+
+from queue import Queue, Empty
+from services.DriveService import get_service as get_drive_service
+from services.HistoryService import get_service as get_history_service
+from services.MetricsService import get_histogram
+from services.ProfileService import record as record_phase
+
+LOGGER = logging.getLogger()
+
+STOP = object()
+FLUSH = object()
+
+COMMIT_SECONDS = get_histogram("smart_monitor_database_commit_seconds", "Time taken by a database writer commit")
+
+# Function queued through execute(); the caller waits on done until the function's transaction is committed
+class Task():
+    def __init__(self, function):
+        self.function = function
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def __call__(self, connection):
+        self.result = self.function(connection)
+
+def get_writer(database, history = True, batch_size = 500, flush_interval = 1.0, state = None):
+    return WriterThread(database, history, batch_size, flush_interval, state)
+
+# Only thread that writes to the database; collectors put their results on its queue and it commits them in batches
+# Queue items are drive rows ({"uuid", "name", "group", "attributes", "update", "status", "last_seen", "timestamp"}) or callables taking a connection
+# Rows without update only change the drive's status; their attributes still go to the history
+# State is the stored drive state shared with the drive monitors; drives of a batch that could not be committed are removed from it
+# so they are loaded from the database again instead of being compared against values that were never written
+class WriterThread(threading.Thread):
+    def __init__(self, database, history, batch_size, flush_interval, state):
+        threading.Thread.__init__(self, name = "database-writer")
+        self.daemon = True
+        self.database = database
+        self.history = history
+        self.batch_size = max(int(batch_size), 1)
+        self.flush_interval = float(flush_interval)
+        self.state = state if state is not None else {}
+        self.queue = Queue()
+        self.stats_lock = threading.Lock()
+        self.__reset_stats()
+
+    def __reset_stats(self):
+        self.stats = {"commits" : 0, "rows" : 0, "samples" : 0, "commit_time" : 0.0, "max_commit_time" : 0.0, "max_queue_depth" : 0}
+
+    def __commit(self, batch):
+        rows = [item for item in batch if isinstance(item, dict)]
+        tasks = [item for item in batch if not isinstance(item, dict)]
+        depth = self.queue.qsize()
+        started = time.monotonic()
+        samples = 0
+        history_service = None
+
+        with self.database.begin() as connection:
+            if rows:
+                drive_service = get_drive_service(connection)
+                drive_service.bulk_upsert([row for row in rows if row["update"]])
+                drive_service.touch_drives([row for row in rows if not row["update"]])
+                if self.history:
+                    history_service = get_history_service(connection)
+                    samples = history_service.write_samples(rows)
+
+            for task in tasks:
+                task(connection)
+
+        # Attribute ids assigned by a batch that was rolled back must not be reused
+        if history_service is not None:
+            history_service.cache_attribute_ids()
+
+        # Callers waiting in execute() are released once their task is committed
+        for task in tasks:
+            if isinstance(task, Task):
+                task.done.set()
+
+        elapsed = time.monotonic() - started
+        COMMIT_SECONDS.observe(elapsed)
+        record_phase("database_commit", elapsed)
+        LOGGER.debug("Writer -> Committed %s rows, %s attribute samples and %s tasks in %.1fms (queue depth: %s)", len(rows), samples, len(tasks), elapsed * 1000, depth)
+
+        with self.stats_lock:
+            self.stats["commits"] += 1
+            self.stats["rows"] += len(rows)
+            self.stats["samples"] += samples
+            self.stats["commit_time"] += elapsed
+            self.stats["max_commit_time"] = max(self.stats["max_commit_time"], elapsed)
+            self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], depth + len(batch))
+
+    def __next_batch(self):
+        # Block for the first item, then gather more until the batch is full or the flush interval passes
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+
+        while batch[-1] is not STOP and batch[-1] is not FLUSH and len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            try:
+                batch.append(self.queue.get(timeout = remaining))
+            except Empty:
+                break
+
+        return batch
+
+    def run(self):
+        stopping = False
+
+        while not stopping:
+            batch = self.__next_batch()
+            if batch[-1] is STOP:
+                stopping = True
+
+            items = [item for item in batch if item is not STOP and item is not FLUSH]
+            try:
+                if items:
+                    self.__commit(items)
+            except Exception as exception:
+                LOGGER.exception("Writer -> Unexpected exception while committing %s queued items; items were dropped", len(items))
+
+                for uuid in set(item["uuid"] for item in items if isinstance(item, dict)):
+                    self.state.pop(uuid, None)
+
+                for item in items:
+                    if isinstance(item, Task):
+                        item.error = exception
+                        item.done.set()
+            finally:
+                for item in batch:
+                    self.queue.task_done()
+
+    def put(self, item):
+        self.queue.put(item)
+
+    # Run a function taking a connection on the writer thread and wait until it is committed; returns its result
+    def execute(self, function):
+        task = Task(function)
+        self.queue.put(task)
+        self.queue.put(FLUSH)
+        task.done.wait()
+
+        if task.error is not None:
+            raise task.error
+
+        return task.result
+
+    # Block until everything queued so far has been committed; returns and resets the writer statistics
+    def flush(self):
+        # The marker makes the writer commit its partial batch right away instead of waiting for the flush interval
+        self.queue.put(FLUSH)
+        self.queue.join()
+
+        with self.stats_lock:
+            stats = self.stats
+            self.__reset_stats()
+
+        return stats
+
+    def stop(self):
+        self.queue.put(STOP)
+        self.join()